@@ -3,10 +3,13 @@
 __version__=0.01
 
 """Module docstring....
-Usage: adsclassic2rdf.py bibcodefile [format]
+Usage: adsclassic2rdf.py [--jobs N] [datapath] bibcodefile [format]
+
+--jobs N converts the records with N worker processes.
 """
 
 import getopt
+import multiprocessing
 import re
 import sys
 import os, os.path
@@ -24,7 +27,6 @@ import HTMLParser
 
 DATA="../mast_hut-rdf"
 DATA="../chandra-rdf"
-SORTEDYEARLIST='../AstroExplorer/filebibs/sortedyearlist.txt'
 
 def _xmlcharref_encode(unicode_data, encoding="ascii"):
     """Emulate Python 2.3's 'xmlcharrefreplace' encoding error handler."""
@@ -360,62 +362,134 @@ def record_as_graph_from_xml(bibcode, incuuid, node, baseUrl=None, thegraph=None
 
 
 
-def record_as_rdf(datapath, bibcodefile, format='xml', baseUrl=None):
+def iterrecords(xmlfile):
+    """Return the record elements of the ADS export one at a time,
+    using iterparse so that the whole file is never held in memory.
+    Each record is cleared once the caller has finished with it, so
+    it must not be used after the next one has been returned."""
+    depth=0
+    root=None
+    for (event, elem) in ElementTree.iterparse(xmlfile, events=('start', 'end')):
+        if event=='start':
+            if root is None:
+                root=elem
+            depth+=1
+            continue
+        depth-=1
+        # records are the children of the root element; anything
+        # deeper is part of a record and is left for it to use
+        if depth==1 and elem.tag=='record':
+            yield elem
+            root.clear()
+
+def record_to_file(rec, dbhash, odir, format='xml', baseUrl=None):
+    "Convert the record element to RDF and write it to odir."
+    node=RecordObj(rec)
+    bibcode=node.bibcode
+    print "BIBCODE", bibcode
+    h= HTMLParser.HTMLParser()
+    bibcode=h.unescape(bibcode)
+
+    # Doug has added this as a safety check (the publications
+    # data for Chandra uses %26 rather than &amp; for the bibcode).
+    if bibcode.find('%') != -1:
+        raise ValueError("bibcode={0} contains a % character".format(bibcode))
+
+    incuuid=dbhash[bibcode]
+    node.bibcode=bibcode
+    graph = record_as_graph_from_xml(bibcode, incuuid, node, baseUrl)
+    dformat=format
+    if format=="pretty-xml":
+        dformat='xml'
+    serializedstuff=graph.serialize(format=format)
+    #print serializedstuff
+    fd=open(odir+"/"+quote_plus(bibcode)+"."+dformat, "w")
+    fd.write(serializedstuff)
+    fd.close()
+    print "-----------------------------------------------"
+
+# The settings used by each process when run with --jobs; set up by
+# initworker. The bibcode->uuid map is built once, by the reader, and
+# handed to the workers when they start.
+worker = None
+
+def initworker(dbhash, odir, format, baseUrl):
+    global worker
+    worker = {'dbhash': dbhash, 'odir': odir, 'format': format, 'baseUrl': baseUrl}
+
+def convertchunk(xmlrecords):
+    """Convert a list of serialized record elements, returning the
+    number converted."""
+    for xmlrecord in xmlrecords:
+        record_to_file(ElementTree.fromstring(xmlrecord), worker['dbhash'], worker['odir'],
+                       worker['format'], worker['baseUrl'])
+    return len(xmlrecords)
+
+def records_to_files_parallel(xmlfile, dbhash, odir, format, baseUrl, njobs, chunksize=10):
+    """Read the records from xmlfile and convert them with njobs worker
+    processes, sending chunksize records to a worker at a time. Only a
+    couple of chunks per worker are allowed to be waiting, so that the
+    reader does not run ahead and hold the whole file in memory."""
+    pool=multiprocessing.Pool(njobs, initworker, (dbhash, odir, format, baseUrl))
+    pending=[]
+    chunk=[]
+    try:
+        for rec in iterrecords(xmlfile):
+            chunk.append(ElementTree.tostring(rec))
+            if len(chunk) < chunksize:
+                continue
+            pending.append(pool.apply_async(convertchunk, (chunk,)))
+            chunk=[]
+            while len(pending) >= 2*njobs:
+                pending.pop(0).get()
+        if len(chunk) > 0:
+            pending.append(pool.apply_async(convertchunk, (chunk,)))
+        for res in pending:
+            res.get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    pool.join()
+
+def record_as_rdf(datapath, bibcodefile, format='xml', baseUrl=None, njobs=1):
 
     odir = datapath + "/data/rdf"
     if not os.path.isdir(odir):
             os.makedirs(odir)
    
     xmlfile=bibcodefile.replace('biblist.txt', 'bibcodes.xml')
-    yhash=getuuid4bibcode.storeYears(SORTEDYEARLIST)
-    dbhash=getuuid4bibcode.setsFromBibcodes(bibcodefile,  yhash)
-    print "LOADING XML FILE", xmlfile
-    recordstree=ElementTree.parse(xmlfile)
-    print "LOOPING OVER RECORDS"
-    for rec in recordstree.findall('record'):
-        node=RecordObj(rec)
-        bibcode=node.bibcode
-        print "BIBCODE", bibcode
-        h= HTMLParser.HTMLParser()
-        bibcode=h.unescape(bibcode)
-
-        # Doug has added this as a safety check (the publications
-        # data for Chandra uses %26 rather than &amp; for the bibcode).
-        if bibcode.find('%') != -1:
-            raise ValueError("bibcode={0} contains a % character".format(bibcode))
-        
-        incuuid=dbhash[bibcode]
-        node.bibcode=bibcode
-        graph = record_as_graph_from_xml(bibcode, incuuid, node, baseUrl)
-        dformat=format
-        if format=="pretty-xml":
-            dformat='xml'
-        serializedstuff=graph.serialize(format=format)
-        #print serializedstuff
-        fd=open(odir+"/"+quote_plus(bibcode)+"."+dformat, "w")
-        fd.write(serializedstuff)
-        fd.close()
-        print "-----------------------------------------------"
+    dbhash=getuuid4bibcode.setsFromBibcodes(bibcodefile)
+    print "LOOPING OVER RECORDS IN", xmlfile
+    if njobs > 1:
+        records_to_files_parallel(xmlfile, dbhash, odir, format, baseUrl, njobs)
+        return
+    for rec in iterrecords(xmlfile):
+        record_to_file(rec, dbhash, odir, format, baseUrl)
         
 def main():
     adsbaseurl=ads_baseurl
     try:
-        opts, args = getopt.getopt(sys.argv[1:], None)
+        opts, args = getopt.getopt(sys.argv[1:], "", ["jobs="])
     except getopt.error, msg:
         print msg 
         print __doc__
-        print "Usage: python adsclassic2rdf.py [datapath] bibcodefile [format]"
+        print "Usage: python adsclassic2rdf.py [--jobs N] [datapath] bibcodefile [format]"
         sys.exit(2)
+    njobs=1
+    for (opt, val) in opts:
+        if opt == "--jobs":
+            njobs=int(val)
     print "ARGS: ", args
     if len(args) == 3:
         datapath, bibcodefile, format = args
-        print record_as_rdf(datapath, bibcodefile, format, baseUrl=adsbaseurl)
+        print record_as_rdf(datapath, bibcodefile, format, baseUrl=adsbaseurl, njobs=njobs)
     elif len(args) == 2:
         datapath, bibcodefile = args
-        print record_as_rdf(datapath, bibcodefile, baseUrl=adsbaseurl)
+        print record_as_rdf(datapath, bibcodefile, baseUrl=adsbaseurl, njobs=njobs)
     else:
         datapath="../chandra-rdf"
-        print record_as_rdf(datapath, args[0], baseUrl=adsbaseurl)
+        print record_as_rdf(datapath, args[0], baseUrl=adsbaseurl, njobs=njobs)
 
 if __name__ == '__main__':
     main()
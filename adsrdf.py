@@ -1,9 +1,15 @@
 #layer for ads like things on top of pysesame and rdflib  or other. currently only pysesame.
-from pysesame import connection, SPJSON, SPXML, SPCXML
+from pysesame import connection, parse_ntriples, SPJSON, SPXML, SPCXML, SPCNT
 #from bib2rdf2 import record_as_rdf, InvalidBibcode
-import namespaces, types, StringIO
+import namespaces, types, StringIO, time, sys, ast
+import threading, Queue
+from urllib import quote_plus
+import rdflib
 from rdflib import plugin, URIRef, BNode
-from rdflib import ConjunctiveGraph
+from rdflib import ConjunctiveGraph, Graph
+from rdflib.compare import isomorphic, to_canonical_graph
+from rdflib.plugins.parsers.ntriples import NTriplesParser, r_nodeid
+from rdflib.plugins.parsers.nt import NTSink
 
 
 
@@ -11,6 +17,7 @@ SPJSON='application/sparql-results+json'
 SPXML='application/sparql-results+xml'
 SPCXML='application/rdf+xml'
 SPCN3='text/rdf+n3'
+SPCNT='text/plain'
 SPATXT='text/boolean'
 
 SPOC={
@@ -39,30 +46,372 @@ and by a long running web server
 #were in that context, and repost. This is under the assumption that multiple files or 
 #transactions go into the population of a context
 
+def _termBinding(term):
+    "The SPARQL JSON form of a rdflib term, as used by pysesame.transactionDocument."
+    if isinstance(term, URIRef):
+        return {'type': 'uri', 'value': unicode(term)}
+    elif isinstance(term, BNode):
+        return {'type': 'bnode', 'value': unicode(term)}
+    out={'type': 'literal', 'value': unicode(term)}
+    if term.language:
+        out['xml:lang']=term.language
+    elif term.datatype:
+        out['datatype']=unicode(term.datatype)
+    return out
+
+def _parseExact(graph, format, **args):
+    """Parse into graph (the args are as for Graph.parse) keeping the
+    lexical form of the literals, which rdflib would otherwise normalize
+    (e.g. "1.50"^^xsd:double to "1.5"), so that they can be compared
+    with - and removed from - the statements in Sesame."""
+    normalize=rdflib.NORMALIZE_LITERALS
+    rdflib.NORMALIZE_LITERALS=False
+    try:
+        graph.parse(format=format, **args)
+    finally:
+        rdflib.NORMALIZE_LITERALS=normalize
+
+class _NTriplesParser(NTriplesParser):
+    """A N-Triples parser that keeps the labels of the blank nodes, which
+    rdflib's parser replaces, so that statements read from Sesame can be
+    removed from it again."""
+
+    def nodeid(self):
+        if self.peek('_'):
+            return BNode(self.eat(r_nodeid).group(1))
+        return False
+
+def _parseStored(data):
+    """Return a graph of the N-Triples data returned by Sesame, keeping
+    the blank node labels and the lexical form of the literals."""
+    graph=Graph()
+    normalize=rdflib.NORMALIZE_LITERALS
+    rdflib.NORMALIZE_LITERALS=False
+    try:
+        _NTriplesParser(NTSink(graph)).parsestring(data)
+    finally:
+        rdflib.NORMALIZE_LITERALS=normalize
+    return graph
+
+def _splitBNodes(graph):
+    """Return the set of triples in graph that contain no blank nodes,
+    and a list of the rest."""
+    ground=set()
+    bnodes=[]
+    for triple in graph:
+        if isinstance(triple[0], BNode) or isinstance(triple[2], BNode):
+            bnodes.append(triple)
+        else:
+            ground.add(triple)
+    return (ground, bnodes)
+
+def _bnodeComponents(triples):
+    """Group the triples, which all contain a blank node, into the
+    connected components of their blank nodes - e.g. an abstract and the
+    statement linking it to the work - and return a dictionary mapping
+    the canonical form of a component (its triples, with the blank nodes
+    relabelled by to_canonical_graph) to the list of components (lists of
+    triples) with that form. Each component is canonicalized on its own,
+    since it is only a few triples while the whole context can be too
+    large for rdflib to compare."""
+    parent={}
+    def find(bnode):
+        while parent.setdefault(bnode, bnode)!=bnode:
+            parent[bnode]=parent[parent[bnode]]
+            bnode=parent[bnode]
+        return bnode
+    for (s, p, o) in triples:
+        if isinstance(s, BNode) and isinstance(o, BNode):
+            parent[find(s)]=find(o)
+    groups={}
+    for triple in triples:
+        if isinstance(triple[0], BNode):
+            root=find(triple[0])
+        else:
+            root=find(triple[2])
+        groups.setdefault(root, []).append(triple)
+    components={}
+    for group in groups.values():
+        graph=Graph()
+        for triple in group:
+            graph.add(triple)
+        components.setdefault(frozenset(to_canonical_graph(graph)), []).append(group)
+    return components
+
 #create as a delegate class with added translation functionality
 
-#TODO: We should create a cache for stuff like getSataBySP which does getDataByS and 
-#then caches results so we dont hit triplestore again and again
+def _sizeof(value):
+    """A rough estimate of the number of bytes used to hold value,
+    which is expected to be the output of one of the ADSConnection
+    query methods (strings, lists of strings, or the list of
+    dictionaries returned by a SPARQL JSON query).
+    """
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        return 64+sum([_sizeof(k)+_sizeof(v) for (k,v) in value.items()])
+    if isinstance(value, (list, tuple)):
+        return 32+sum([_sizeof(v) for v in value])
+    return 16
+
+class LRUCache:
+    """A bounded least-recently-used cache.
+
+    The cache holds at most maxentries items and, if maxbytes is
+    not None, at most maxbytes bytes (as estimated by _sizeof). If
+    ttl is not None then entries older than ttl seconds are treated
+    as missing. The least-recently used entries are evicted first.
+
+    Hits, misses, evictions and expirations are counted so that the
+    effectiveness of the cache can be reported at the end of a run.
+
+    The cache can be shared between threads.
+    """
+
+    def __init__(self, maxentries=10000, maxbytes=None, ttl=None):
+        self.maxentries=maxentries
+        self.maxbytes=maxbytes
+        self.ttl=ttl
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+        self.expirations=0
+        self.lock=threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Remove all entries (the statistics are not reset)."""
+        #each node is [prev, next, key, value, size, expiry]; root is a sentinel
+        #for a circular doubly-linked list, most-recently used at root[1]
+        self.lock.acquire()
+        try:
+            self.root=[None, None, None, None, 0, None]
+            self.root[0]=self.root
+            self.root[1]=self.root
+            self.nodes={}
+            self.nbytes=0
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, key):
+        return self.nodes.has_key(key)
+
+    def _unlink(self, node):
+        node[0][1]=node[1]
+        node[1][0]=node[0]
+
+    def _linkfront(self, node):
+        root=self.root
+        node[0]=root
+        node[1]=root[1]
+        root[1][0]=node
+        root[1]=node
+
+    def _remove(self, node):
+        self._unlink(node)
+        del self.nodes[node[2]]
+        self.nbytes-=node[4]
+
+    def get(self, key, default=None):
+        """Return the value stored for key, or default if it is
+        not present (or has expired)."""
+        self.lock.acquire()
+        try:
+            return self._get(key, default)
+        finally:
+            self.lock.release()
+
+    def _get(self, key, default):
+        node=self.nodes.get(key)
+        if node is None:
+            self.misses+=1
+            return default
+        if node[5] is not None and node[5] < time.time():
+            self._remove(node)
+            self.expirations+=1
+            self.misses+=1
+            return default
+        self._unlink(node)
+        self._linkfront(node)
+        self.hits+=1
+        return node[3]
+
+    def put(self, key, value):
+        """Store value under key, evicting the least-recently used
+        entries if the cache is now too large. Values that are larger
+        than maxbytes on their own are not stored."""
+        size=_sizeof(value)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        self.lock.acquire()
+        try:
+            self._put(key, value, size)
+        finally:
+            self.lock.release()
+
+    def _put(self, key, value, size):
+        node=self.nodes.get(key)
+        if node is not None:
+            self._remove(node)
+        if self.ttl is None:
+            expiry=None
+        else:
+            expiry=time.time()+self.ttl
+        node=[None, None, key, value, size, expiry]
+        self._linkfront(node)
+        self.nodes[key]=node
+        self.nbytes+=size
+        while len(self.nodes) > self.maxentries or \
+              (self.maxbytes is not None and self.nbytes > self.maxbytes):
+            self._remove(self.root[0])
+            self.evictions+=1
+
+    def discard(self, key):
+        """Remove key from the cache if it is present."""
+        self.lock.acquire()
+        try:
+            node=self.nodes.get(key)
+            if node is not None:
+                self._remove(node)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return a dictionary of the cache statistics."""
+        lookups=self.hits+self.misses
+        if lookups > 0:
+            hitrate=float(self.hits)/lookups
+        else:
+            hitrate=0.0
+        return {'hits':self.hits, 'misses':self.misses,
+                'evictions':self.evictions, 'expirations':self.expirations,
+                'entries':len(self.nodes), 'bytes':self.nbytes,
+                'hitrate':hitrate}
+
+    def report(self):
+        """Return the cache statistics as a single line of text."""
+        return "hits={hits} misses={misses} hitrate={hitrate:.3f} evictions={evictions} expirations={expirations} entries={entries} bytes={bytes}".format(**self.stats())
+
+def _sourceFromValues(ouri, values):
+    """Create the source dictionary returned by getSourcesForBibcodes
+    from the values of its name, otype, ra, dec and meta (metadata
+    string) fields, any of which may be missing."""
+    if not values.has_key('otype') and values.has_key('meta'):
+        odict=ast.literal_eval(values['meta'])
+        values['name']=odict['id']
+        values['otype']=odict['otype']
+        values['ra']=odict.get('ra')
+        values['dec']=odict.get('dec')
+    source={'ouri': ouri, 'oid': values.get('name'), 'otype': values.get('otype')}
+    for k in ['ra', 'dec']:
+        try:
+            source[k]=float(values[k])
+        except (KeyError, TypeError, ValueError):
+            source[k]=None
+    return source
+
+def _isXML(data):
+    "Is data RDF/XML rather than N-Triples?"
+    data=data.lstrip()
+    return data.startswith('<?xml') or data.startswith('<rdf:')
+
+def _isError(data):
+    "Does data look like the error marker returned by pysesame.connection.query?"
+    return type(data)==types.ListType and len(data)==1 and \
+           type(data[0])==types.DictType and data[0].has_key('error')
 
 class ADSConnection:
 
-    def __init__(self, sesameURL, repository):
-        c=connection(sesameURL)
+    def __init__(self, sesameURL, repository, cachesize=0, cachebytes=None, cachettl=None, prefetchsize=256, fastdecode=True, metrics=None):
+        """Connect to the given Sesame server and repository.
+
+        If cachesize is greater than zero then the results of makeQuery,
+        getDataBySP and getDataBySPO are stored in a LRUCache with at
+        most cachesize entries, cachebytes bytes and a time-to-live of
+        cachettl seconds (None means no limit for these last two).
+
+        The outgoing triples of up to prefetchsize subjects can be held
+        in memory by prefetchSubject; use None for no limit.
+
+        The caches are emptied whenever data is added to or removed
+        from the store via this connection.
+
+        If fastdecode is True then getDataBySP and getDataByType ask
+        for N-Triples and read them with pysesame.parse_ntriples, rather
+        than parsing RDF/XML into a rdflib graph. The RDF/XML path is
+        used if fastdecode is False, or if the store ignores the
+        request for N-Triples.
+
+        If metrics is a pysesame.Metrics object then the requests made
+        to Sesame are recorded in it.
+        """
+        c=connection(sesameURL, metrics=metrics)
         c.use_repository(repository)
         for ele in namespaces.namespace_dict.keys():
             #print ele, str(namespaces.namespace_dict[ele])
             c.addnamespace(ele, str(namespaces.namespace_dict[ele]))
         #tsc is triple store connection. we need to first write this, then translate to a driver architecture
         self.tsc=c
+        if cachesize > 0:
+            self.cache=LRUCache(cachesize, cachebytes, cachettl)
+        else:
+            self.cache=None
+        #prefetched subjects: (n3 subject, n3 context) -> {predicate uri: [objects]}
+        #blank nodes reached from a prefetched subject are stored as ('_:'+id, n3 context)
+        if prefetchsize is None:
+            prefetchsize=sys.maxint
+        self.subjects=LRUCache(prefetchsize)
+        # bibcode: [source dictionaries], filled by getSourcesForBibcodes
+        # (under sourceslock, since AsyncADSConnection calls it from
+        # several threads)
+        self.sources={}
+        self.sourceslock=threading.Lock()
+        self.fastdecode=fastdecode
         
-    
+    def _cacheGet(self, key):
+        if self.cache is None:
+            return None
+        return self.cache.get(key)
+
+    def _cachePut(self, key, data):
+        if self.cache is not None and not _isError(data):
+            self.cache.put(key, data)
+
+    def _cacheClear(self):
+        if self.cache is not None:
+            self.cache.clear()
+        self.subjects.clear()
+        self.sourceslock.acquire()
+        try:
+            self.sources.clear()
+        finally:
+            self.sourceslock.release()
+
+    def cacheReport(self):
+        """Return a one-line summary of the cache statistics."""
+        if self.cache is None:
+            out="cache disabled"
+        else:
+            out=self.cache.report()
+        return out+"; prefetch: "+self.subjects.report()
+
     #Build    
     
     def makeQuery(self, query, type=SPJSON):
-        data=self.tsc.querypost(query, type)
+        key=('Q', type, query)
+        data=self._cacheGet(key)
+        if data is None:
+            data=self.tsc.querypost(query, type)
+            self._cachePut(key, data)
+        if type==SPJSON:
+            data=list(data)
         return data
         
     def deleteData(self, context=None):
+        self._cacheClear()
         if context:
             self.tsc.deletedata(namespaces.n3encode(context))
         else:
@@ -74,6 +423,51 @@ class ADSConnection:
         else:
             data=self.tsc.get_in_context()
         return data
+
+    def syncContext(self, context, sources, format='xml'):
+        """Make the statements in the context the same as those read
+        from sources - a list of file names or file objects in the rdflib
+        format, e.g. the regenerated files for the context - by sending
+        only the statements that have been added or removed, in a single
+        transaction.
+
+        Blank nodes can not be matched between the store and the files,
+        so the statements containing them are compared by connected
+        component (the blank nodes reachable from a ground subject,
+        together with the statement linking them to it), and a component
+        that differs is removed - using the labels Sesame gives the blank
+        nodes - and added in full. If more statements have changed than
+        there are in sources, the context is replaced instead.
+
+        Returns (nadded, nremoved, replaced).
+        """
+        self._cacheClear()
+        new=Graph()
+        for source in sources:
+            _parseExact(new, format, source=source)
+        current=_parseStored(self.tsc.get_in_context(namespaces.n3encode(context), SPCNT))
+        (newground, newbnodes)=_splitBNodes(new)
+        (oldground, oldbnodes)=_splitBNodes(current)
+        added=newground - oldground
+        removed=oldground - newground
+        newcomponents=_bnodeComponents(newbnodes)
+        oldcomponents=_bnodeComponents(oldbnodes)
+        for key in set(newcomponents.keys()+oldcomponents.keys()):
+            newlist=newcomponents.get(key, [])
+            oldlist=oldcomponents.get(key, [])
+            nsame=min(len(newlist), len(oldlist))
+            for component in newlist[nsame:]:
+                added.update(component)
+            for component in oldlist[nsame:]:
+                removed.update(component)
+        if len(added)+len(removed) > len(new):
+            self.tsc.postdata(new.serialize(format='xml'), quote_plus(namespaces.n3encode(context)), 'PUT')
+            return (len(new), len(current), True)
+        if len(added)+len(removed) > 0:
+            self.tsc.transaction([[_termBinding(t) for t in triple] for triple in removed],
+                                 [[_termBinding(t) for t in triple] for triple in added],
+                                 [namespaces.n3encode(context)[1:-1]])
+        return (len(added), len(removed), False)
         
     def getDataBySPO(self, thingy, thingytype="s", context=None):
         qdict={}
@@ -81,7 +475,11 @@ class ADSConnection:
             qdict['c']=namespaces.n3encode(context)
         qdict[thingytype]=namespaces.n3encode(thingy)
         #print "QDICT", qdict
-        data=self.tsc.query_statements(qdict)
+        key=('SPO', thingytype, qdict[thingytype], qdict.get('c'))
+        data=self._cacheGet(key)
+        if data is None:
+            data=self.tsc.query_statements(qdict)
+            self._cachePut(key, data)
         return data
         
     #BUG do not handle if value corresponding to a key is a list, ie we dont handle two subjects for eg.
@@ -100,46 +498,634 @@ class ADSConnection:
         data=self.tsc.query_statements(qdict)
         return data
     
-    def getDataByType(self, thetype, context=None):
-        thedict={'p':'rdf:type', 'o':thetype}
-        data=self.getDataByDict(thedict, context)
+    def _statementColumn(self, qdict, column):
+        """Return column 0, 1 or 2 (subject, predicate or object) of the
+        statements matching qdict as a list of UTF-8 encoded strings.
+        Repeated statements are only included once."""
+        if self.fastdecode:
+            data=self.tsc.query_statements(qdict, SPCNT)
+            if not _isXML(data):
+                seen=set()
+                listofo=[]
+                for trip in parse_ntriples(data):
+                    if trip not in seen:
+                        seen.add(trip)
+                        listofo.append(str(trip[column].encode('utf-8')))
+                return listofo
+        else:
+            data=self.tsc.query_statements(qdict)
         bg=ConjunctiveGraph()
         namespaces.bindgraph(bg)
+        #abnode=BNode()
         res=bg.parse(StringIO.StringIO(data))
         listofo=[]
+        #this bnode crap is very fragile TODO:replace
         for trip in res:
-            listofo.append(str(trip[0].encode('utf-8')))
+            listofo.append(str(trip[column].encode('utf-8')))
         return listofo
+
+    def getDataByType(self, thetype, context=None):
+        qdict={'p':namespaces.n3encode('rdf:type'), 'o':namespaces.n3encode(thetype)}
+        if context:
+            qdict['c']=namespaces.n3encode(context)
+        return self._statementColumn(qdict, 0)
             
     def getDataBySP(self, thingy, propthingy, context=None):
-        qdict={}
         if context:
-            qdict['c']=namespaces.n3encode(context)
+            n3context=namespaces.n3encode(context)
+        else:
+            n3context=None
         #print "THINGY", thingy
         if len(thingy.split(':'))>1:
-            qdict['s']=namespaces.n3encode(thingy)
+            n3thingy=namespaces.n3encode(thingy)
         else:
-            qdict['s']=thingy
-        qdict['p']=namespaces.n3encode(propthingy)
+            n3thingy=thingy
+        return self._getDataByN3(n3thingy, namespaces.n3encode(propthingy), n3context)
+
+    def _getDataByN3(self, n3thingy, n3prop, n3context=None):
+        "getDataBySP for already-encoded subject, predicate and context."
+        #a single lookup, since a background prefetch can evict the entry at any time
+        preds=self.subjects.get((n3thingy, n3context))
+        if preds is not None:
+            return list(preds.get(n3prop[1:-1], []))
+        qdict={'s':n3thingy, 'p':n3prop}
+        if n3context:
+            qdict['c']=n3context
         #print "qdict", qdict
-        data=self.tsc.query_statements(qdict)
-        #print data
-        bg=ConjunctiveGraph()
-        namespaces.bindgraph(bg)
-        #abnode=BNode()
-        res=bg.parse(StringIO.StringIO(data))
-        listofo=[]
-        #this bnode crap is very fragile TODO:replace
-        for trip in res:
-            listofo.append(str(trip[2].encode('utf-8')))
-        return listofo
+        key=('SP', qdict['s'], qdict['p'], qdict.get('c'))
+        listofo=self._cacheGet(key)
+        if listofo is not None:
+            return list(listofo)
+        listofo=self._statementColumn(qdict, 2)
+        self._cachePut(key, listofo)
+        return list(listofo)
+
+    def prefetchSubject(self, thingy, context=None, refresh=False):
+        """Fetch all the triples with thingy as the subject with a
+        single query, and hold them in memory so that later calls to
+        getDataBySP (and getDataBySPPath) for this subject do not
+        need to contact the store. Blank nodes that are the object
+        of one of these triples (e.g. adsobsv:associatedPosition or
+        adsbib:hasAbstract) are expanded by one level.
+
+        Only the most-recent prefetchsize subjects are retained.
+        Nothing is done if the subject is already held, unless
+        refresh is True.
+        """
+        if context:
+            n3context=namespaces.n3encode(context)
+        else:
+            n3context=None
+        n3thingy=self._n3subject(thingy)
+        if not refresh and (n3thingy, n3context) in self.subjects:
+            return
+        pattern="%s ?p ?o . OPTIONAL { ?o ?bp ?bo . FILTER(isBlank(?o)) }" % n3thingy
+        if n3context:
+            pattern="GRAPH %s { %s }" % (n3context, pattern)
+        rows=self.tsc.querypost("SELECT ?p ?o ?bp ?bo WHERE { %s }" % pattern, SPJSON)
+        if _isError(rows):
+            raise IOError("prefetchSubject query failed for %s: %s" % (thingy, rows[0]['error']))
+        preds={}
+        bnodes={}
+        for row in rows:
+            p=str(row['p']['value'])
+            o=str(row['o']['value'].encode('utf-8'))
+            if not row.has_key('bp'):
+                preds.setdefault(p, []).append(o)
+                continue
+            #a blank node appears once for each of its own triples
+            if not bnodes.has_key(o):
+                bnodes[o]={}
+                preds.setdefault(p, []).append(o)
+            bnodes[o].setdefault(str(row['bp']['value']), []).append(str(row['bo']['value'].encode('utf-8')))
+        for (bnode, bpreds) in bnodes.items():
+            self.subjects.put(('_:'+bnode, n3context), bpreds)
+        self.subjects.put((n3thingy, n3context), preds)
+
+    def prefetchQuery(self, query):
+        """Run a SPARQL query that returns ?s ?p ?o and hold the
+        results in memory, as prefetchSubject does. The query must
+        return every triple of each subject it matches, since later
+        getDataBySP calls for those subjects are answered from these
+        results alone. Returns the number of subjects loaded.
+
+        This lets a caller gather the data for a whole document (or
+        set of documents) with a few composed queries.
+        """
+        rows=self.tsc.querypost(query, SPJSON)
+        if _isError(rows):
+            raise IOError("prefetchQuery failed: %s" % rows[0]['error'])
+        return self.storeSubjectRows(rows)
+
+    def storeSubjectRows(self, rows, context=None):
+        """Add the ?s ?p ?o rows (decoded SPARQL JSON bindings) to the
+        prefetched subjects. Repeated triples are only stored once."""
+        if context:
+            n3context=namespaces.n3encode(context)
+        else:
+            n3context=None
+        subjects={}
+        seen=set()
+        for row in rows:
+            if row['s']['type']=='bnode':
+                n3s='_:'+str(row['s']['value'])
+            else:
+                n3s='<'+str(row['s']['value'].encode('utf-8'))+'>'
+            p=str(row['p']['value'])
+            o=str(row['o']['value'].encode('utf-8'))
+            if (n3s, p, o) in seen:
+                continue
+            seen.add((n3s, p, o))
+            subjects.setdefault(n3s, {}).setdefault(p, []).append(o)
+        for (n3s, preds) in subjects.items():
+            self.subjects.put((n3s, n3context), preds)
+        return len(subjects)
+
+    def forgetSubject(self, thingy, context=None):
+        "Remove the prefetched triples for thingy, if any."
+        if context:
+            n3context=namespaces.n3encode(context)
+        else:
+            n3context=None
+        self.subjects.discard((self._n3subject(thingy), n3context))
+
+    def getDataBySPPath(self, thingy, propthingies, context=None):
+        """Return the objects reached by following the predicates in
+        propthingies from thingy; e.g.
+
+            getDataBySPPath('uri_obs:...', ['adsobsv:associatedPosition', 'adsobsv:ra'])
+
+        If every node along the path has been prefetched then the
+        answer comes from memory, otherwise a single SPARQL query
+        is made. The objects are encoded as for getDataBySP.
+        """
+        if context:
+            n3context=namespaces.n3encode(context)
+        else:
+            n3context=None
+        n3props=[namespaces.n3encode(p) for p in propthingies]
+        n3thingy=self._n3subject(thingy)
+        if len(n3props)==0:
+            return [n3thingy]
+        #the prefetched triples of each node along the path (None if it is not
+        #held), looked up once since a background prefetch can evict them
+        entries=[self.subjects.get((n3thingy, n3context))]
+        for (i, n3prop) in enumerate(n3props):
+            if None in entries:
+                return self._getDataByPathQuery(n3thingy, n3props, n3context)
+            objects=[]
+            for preds in entries:
+                objects.extend(preds.get(n3prop[1:-1], []))
+            if i==len(n3props)-1:
+                return objects
+            entries=[]
+            for o in objects:
+                preds=self.subjects.get(('_:'+o, n3context))
+                if preds is None:
+                    preds=self.subjects.get(('<'+o+'>', n3context))
+                entries.append(preds)
+
+    def _getDataByPathQuery(self, n3thingy, n3props, n3context=None):
+        nodes=[n3thingy]+['?v%d' % i for i in range(len(n3props))]
+        pattern=" ".join(["%s %s %s ." % (nodes[i], n3props[i], nodes[i+1]) for i in range(len(n3props))])
+        if n3context:
+            pattern="GRAPH %s { %s }" % (n3context, pattern)
+        rows=self.makeQuery("SELECT %s WHERE { %s }" % (nodes[-1], pattern))
+        if _isError(rows):
+            raise IOError("getDataBySPPath query failed for %s: %s" % (n3thingy, rows[0]['error']))
+        return [str(row[nodes[-1][1:]]['value'].encode('utf-8')) for row in rows]
+
+    def _n3subject(self, thingy):
+        "Encode a subject in the same way as getDataBySP does."
+        if thingy.startswith('<') or len(thingy.split(':'))<2:
+            return thingy
+        return namespaces.n3encode(thingy)
+
+    def getDataBySPMany(self, thingies, propthingies, context=None, chunksize=50, usevalues=False):
+        """Return the objects for each of the subjects in thingies
+        and each of the predicates in propthingies (a single predicate
+        can also be given) as a dictionary
+
+            {subject: {predicate: [objects]}}
+
+        where the subject and predicate keys are the values given
+        in the call, and the objects are encoded as for getDataBySP.
+        Every requested subject and predicate appears in the output,
+        with an empty list if there is no match.
+
+        Rather than one /statements call per subject, the subjects
+        are sent chunksize at a time as a single SPARQL query. The
+        default form uses UNION and sameTerm filters since the
+        SPARQL 1.0 engine in Sesame 2.4 does not support VALUES;
+        set usevalues to True to use a VALUES clause instead (SPARQL
+        1.1 stores such as Sesame 2.7 and later).
+
+        If the cache is enabled, results are read from and stored
+        under the same keys as getDataBySP. As with getDataBySP, an
+        object is only listed once even if the statement is in several
+        contexts.
+        """
+        if isinstance(propthingies, basestring):
+            propthingies=[propthingies]
+        if context:
+            n3context=namespaces.n3encode(context)
+        else:
+            n3context=None
+        pmap={}
+        for propthingy in propthingies:
+            pmap[namespaces.n3encode(propthingy)[1:-1]]=propthingy
+        result={}
+        smap={}
+        todo=[]
+        for thingy in thingies:
+            if result.has_key(thingy):
+                continue
+            result[thingy]=dict([(propthingy, []) for propthingy in propthingies])
+            n3thingy=self._n3subject(thingy)
+            preds=self.subjects.get((n3thingy, n3context))
+            if preds is not None:
+                for propthingy in propthingies:
+                    result[thingy][propthingy]=list(preds.get(namespaces.n3encode(propthingy)[1:-1], []))
+                continue
+            if self.cache is not None:
+                keys=[('SP', n3thingy, namespaces.n3encode(p), n3context) for p in propthingies]
+                cached=[self.cache.get(key) for key in keys]
+                if None not in cached:
+                    for (propthingy, listofo) in zip(propthingies, cached):
+                        result[thingy][propthingy]=list(listofo)
+                    continue
+            smap[n3thingy[1:-1]]=thingy
+            todo.append(n3thingy)
+
+        n3props=[namespaces.n3encode(p) for p in propthingies]
+        for i in range(0, len(todo), chunksize):
+            chunk=todo[i:i+chunksize]
+            if usevalues:
+                pattern="VALUES ?s { %s } VALUES ?p { %s } ?s ?p ?o ." % (" ".join(chunk), " ".join(n3props))
+            else:
+                pfilter="FILTER(%s)" % (" || ".join(["sameTerm(?p, %s)" % p for p in n3props]))
+                pattern=" UNION ".join(["{ ?s ?p ?o . FILTER(sameTerm(?s, %s)) %s }" % (n3thingy, pfilter) for n3thingy in chunk])
+            if n3context:
+                pattern="GRAPH %s { %s }" % (n3context, pattern)
+            query="SELECT DISTINCT ?s ?p ?o WHERE { %s }" % pattern
+            rows=self.tsc.querypost(query, SPJSON)
+            if _isError(rows):
+                raise IOError("getDataBySPMany query failed: %s" % rows[0]['error'])
+            #objects that differ only in datatype or language decode to the same value
+            seen=set()
+            for row in rows:
+                thingy=smap[row['s']['value']]
+                propthingy=pmap[row['p']['value']]
+                o=str(row['o']['value'].encode('utf-8'))
+                if (thingy, propthingy, o) in seen:
+                    continue
+                seen.add((thingy, propthingy, o))
+                result[thingy][propthingy].append(o)
+            if self.cache is not None:
+                for n3thingy in chunk:
+                    thingy=smap[n3thingy[1:-1]]
+                    for (propthingy, n3prop) in zip(propthingies, n3props):
+                        self.cache.put(('SP', n3thingy, n3prop, n3context), list(result[thingy][propthingy]))
+        return result
                 
+    def getSourcesForBibcodes(self, bibcodes, chunksize=50):
+        """Return the astronomical sources of each paper as a dictionary
+
+            {bibcode: [{'ouri':..., 'oid':..., 'otype':..., 'ra':..., 'dec':...}]}
+
+        where oid is the SIMBAD identifier and otype the object type
+        (unicode strings) and ra and dec are floats, or None if not
+        known. The papers are queried chunksize at a time, and the
+        results are kept, so the whole list can be loaded up front and
+        each paper then asked for separately. If chunksize is None then
+        a single query is made for the sources of all the papers in
+        the store, and those not in bibcodes are ignored.
+
+        The adsbase:name, adsbase:objectType, adsobsv:ra and adsobsv:dec
+        values of the source are used; for sources loaded before these
+        were added the adsbase:hasMetadataString value - the Python
+        dictionary from SIMBAD - is used instead.
+
+        The results are only kept once all the queries have succeeded.
+        """
+        self.sourceslock.acquire()
+        try:
+            todo=[bibcode for bibcode in bibcodes if not self.sources.has_key(bibcode)]
+        finally:
+            self.sourceslock.release()
+        bmap={}
+        found={}
+        for bibcode in todo:
+            bmap[namespaces.n3encode('uri_bib:'+bibcode)[1:-1]]=bibcode
+            found[bibcode]=[]
+        n3p=dict([(p, namespaces.n3encode(p)) for p in ['adsbase:hasAstronomicalSource', 'adsbase:name', 'adsbase:objectType', 'adsobsv:ra', 'adsobsv:dec', 'adsbase:hasMetadataString']])
+        keys=bmap.keys()
+        if chunksize is None:
+            patterns=["?bib %s ?src ." % n3p['adsbase:hasAstronomicalSource']]
+        else:
+            patterns=[" UNION ".join(["{ ?bib %s ?src . FILTER(sameTerm(?bib, <%s>)) }" % (n3p['adsbase:hasAstronomicalSource'], biburi) for biburi in keys[i:i+chunksize]])
+                      for i in range(0, len(keys), chunksize)]
+        if len(keys)==0:
+            patterns=[]
+        for pattern in patterns:
+            query="SELECT ?bib ?src ?name ?otype ?ra ?dec ?meta WHERE { %s OPTIONAL { ?src %s ?name } OPTIONAL { ?src %s ?otype } OPTIONAL { ?src %s ?ra } OPTIONAL { ?src %s ?dec } OPTIONAL { ?src %s ?meta } }" % (pattern, n3p['adsbase:name'], n3p['adsbase:objectType'], n3p['adsobsv:ra'], n3p['adsobsv:dec'], n3p['adsbase:hasMetadataString'])
+            rows=self.makeQuery(query)
+            if _isError(rows):
+                raise IOError("getSourcesForBibcodes query failed: %s" % rows[0]['error'])
+            # there can be several rows per source, e.g. when it has
+            # multiple metadata strings, so only the first is used
+            seen=set()
+            for row in rows:
+                if not bmap.has_key(row['bib']['value']):
+                    continue
+                bibcode=bmap[row['bib']['value']]
+                ouri=row['src']['value']
+                if (bibcode, ouri) in seen:
+                    continue
+                seen.add((bibcode, ouri))
+                values=dict([(k, row[k]['value']) for k in ['name', 'otype', 'ra', 'dec', 'meta'] if row.has_key(k)])
+                found[bibcode].append(_sourceFromValues(ouri, values))
+        self.sourceslock.acquire()
+        try:
+            self.sources.update(found)
+            return dict([(bibcode, self.sources[bibcode]) for bibcode in bibcodes])
+        finally:
+            self.sourceslock.release()
+
     def addFile(self, thefile,context=None):
+        self._cacheClear()
         if context:
             self.tsc.postfile(thefile, namespaces.n3encode(context))
         else:
             self.tsc.postfile(thefile)
             
+class Future:
+    """The result of a call made by AsyncADSConnection."""
+
+    def __init__(self):
+        self.event=threading.Event()
+        self.value=None
+        self.excinfo=None
+
+    def done(self):
+        return self.event.isSet()
+
+    def result(self, timeout=None):
+        """Wait for the call to finish and return its value, or raise
+        the exception it raised."""
+        self.event.wait(timeout)
+        if not self.event.isSet():
+            raise IOError("timed out waiting for a result")
+        if self.excinfo is not None:
+            raise self.excinfo[0], self.excinfo[1], self.excinfo[2]
+        return self.value
+
+class AsyncADSConnection:
+    """Make ADSConnection calls in background threads, so that several
+    queries can be waiting on Sesame at once. Each method starts the
+    call and returns a Future; use its result method to get the value.
+
+    At most maxinflight calls are made at the same time. The limit is a
+    semaphore, which can be shared between several AsyncADSConnection
+    instances (e.g. for different repositories) to give a global limit.
+    The HTTP connection pool of conn is enlarged to maxinflight if
+    necessary.
+
+    The calls share the caches of conn, which can still be used directly,
+    e.g. to build a document once its data has been prefetched.
+    """
+
+    def __init__(self, conn, maxinflight=8, semaphore=None):
+        self.conn=conn
+        if semaphore is None:
+            semaphore=threading.BoundedSemaphore(maxinflight)
+        self.semaphore=semaphore
+        pool=getattr(conn.tsc, 'pool', None)
+        if pool is not None and pool.maxsize < maxinflight:
+            pool.maxsize=maxinflight
+        self.queue=Queue.Queue()
+        self.threads=[]
+        for i in range(maxinflight):
+            t=threading.Thread(target=self._worker)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def __str__(self):
+        return "<AsyncADSConnection to %s with %d threads>" % (self.conn, len(self.threads))
+
+    def _worker(self):
+        while True:
+            item=self.queue.get()
+            if item is None:
+                return
+            (future, func, args)=item
+            self.semaphore.acquire()
+            try:
+                try:
+                    future.value=func(*args)
+                except:
+                    future.excinfo=sys.exc_info()
+            finally:
+                self.semaphore.release()
+                future.event.set()
+
+    def submit(self, func, *args):
+        """Call func(*args) in the background, returning a Future."""
+        future=Future()
+        self.queue.put((future, func, args))
+        return future
+
+    def makeQuery(self, query, type=SPJSON):
+        return self.submit(self.conn.makeQuery, query, type)
+
+    def getDataBySP(self, thingy, propthingy, context=None):
+        return self.submit(self.conn.getDataBySP, thingy, propthingy, context)
+
+    def getDataBySPPath(self, thingy, propthingies, context=None):
+        return self.submit(self.conn.getDataBySPPath, thingy, propthingies, context)
+
+    def prefetchSubject(self, thingy, context=None):
+        return self.submit(self.conn.prefetchSubject, thingy, context)
+
+    def prefetchQuery(self, query):
+        return self.submit(self.conn.prefetchQuery, query)
+
+    def getSourcesForBibcodes(self, bibcodes):
+        return self.submit(self.conn.getSourcesForBibcodes, bibcodes)
+
+    def close(self):
+        """Stop the threads once the calls already made have finished."""
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads=[]
+
+class TestClass:
+    """Check syncContext against the stand-in server (run with
+    nosetests adsrdf.py)."""
+
+    def setUp(self):
+        import tempfile, sesameserver
+        self.dir=tempfile.mkdtemp()
+        self.server=sesameserver.startServer()
+        self.conn=ADSConnection(self.server.baseurl, 'test')
+        self.context='uri_context:sync-test'
+        self.files=[self.dir+'/a.rdf', self.dir+'/b.rdf']
+        self.write(0, '1.50', 'http://example.org/b', 'x')
+        self.write(1, '2', 'http://example.org/c', 'y')
+        for fname in self.files:
+            self.conn.tsc.postfile(fname, quote_plus(namespaces.n3encode(self.context)))
+        self.conn.tsc.postfile(self.files[1], quote_plus(namespaces.n3encode('uri_context:other')))
+
+    def tearDown(self):
+        import shutil
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def write(self, i, number, obj, label):
+        out=open(self.files[i], 'w')
+        out.write('''<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:ex="http://example.org/">
+<rdf:Description rdf:about="http://example.org/s%d">
+<ex:n rdf:datatype="http://www.w3.org/2001/XMLSchema#double">%s</ex:n>
+<ex:o rdf:resource="%s"/>
+<ex:b><rdf:Description><ex:label>%s</ex:label></rdf:Description></ex:b>
+</rdf:Description></rdf:RDF>''' % (i, number, obj, label))
+        out.close()
+
+    def stored(self, context):
+        g=self.server.store.graph('test').get_context(URIRef(namespaces.n3encode(context)[1:-1]))
+        return Graph()+g
+
+    def same(self, graph, expected):
+        "Are the graphs the same, comparing the blank nodes by component?"
+        (ground, bnodes)=_splitBNodes(graph)
+        (eground, ebnodes)=_splitBNodes(expected)
+        count=lambda components: dict([(k, len(v)) for (k, v) in components.items()])
+        return ground==eground and count(_bnodeComponents(bnodes))==count(_bnodeComponents(ebnodes))
+
+    def check(self):
+        expected=Graph()
+        for fname in self.files:
+            _parseExact(expected, 'xml', source=fname)
+        assert self.same(self.stored(self.context), expected)
+        assert len(self.stored('uri_context:other'))==4
+
+    def test_sync(self):
+        assert self.conn.syncContext(self.context, self.files)==(0, 0, False)
+        before=self.server.requestCounts()
+        self.write(0, '1.50', 'http://example.org/d', 'x')
+        self.write(1, '2.0', 'http://example.org/c', 'y')
+        assert self.conn.syncContext(self.context, self.files)==(2, 2, False)
+        self.check()
+        # one read and one transaction
+        after=self.server.requestCounts()
+        assert after['GET statements']-before.get('GET statements', 0)==1
+        assert after['POST statements']-before['POST statements']==1
+        assert not after.has_key('PUT statements')
+
+        # only the component with the changed blank node is replaced
+        before=after
+        self.write(1, '2.0', 'http://example.org/c', 'z')
+        assert self.conn.syncContext(self.context, self.files)==(2, 2, False)
+        self.check()
+        after=self.server.requestCounts()
+        assert after['POST statements']-before['POST statements']==1
+        assert not after.has_key('PUT statements')
+
+    def test_many(self):
+        # records with nested blank nodes, all the same shape
+        fname=self.dir+'/many.rdf'
+        context='uri_context:sync-many'
+        def write(labels):
+            out=open(fname, 'w')
+            out.write('<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:ex="http://example.org/">\n')
+            for (i, label) in enumerate(labels):
+                out.write('''<rdf:Description rdf:about="http://example.org/r%d">
+<ex:o rdf:resource="http://example.org/o%d"/>
+<ex:b rdf:parseType="Resource"><ex:label>%s</ex:label><ex:c rdf:parseType="Resource"><ex:v>%d</ex:v></ex:c></ex:b>
+</rdf:Description>
+''' % (i, i % 7, label, i % 3))
+            out.write('</rdf:RDF>\n')
+            out.close()
+        labels=['abstract %d' % (i % 5) for i in range(500)]
+        write(labels)
+        self.conn.tsc.postfile(fname, quote_plus(namespaces.n3encode(context)))
+        assert self.conn.syncContext(context, [fname])==(0, 0, False)
+
+        labels[10]='changed'
+        labels[400]='abstract 1'
+        write(labels)
+        assert self.conn.syncContext(context, [fname])==(8, 8, False)
+        expected=Graph()
+        _parseExact(expected, 'xml', source=fname)
+        assert self.same(self.stored(context), expected)
+        assert self.conn.syncContext(context, [fname])==(0, 0, False)
+
+class TestManyClass:
+    """Check getDataBySPMany against getDataBySP using the stand-in
+    server (run with nosetests adsrdf.py)."""
+
+    def setUp(self):
+        import sesameserver
+        self.server=sesameserver.startServer()
+        (a, b, p)=[namespaces.n3encode(x) for x in ['uri_bib:a', 'uri_bib:b', 'adsbase:title']]
+        nt='%s %s "x" .\n%s %s "y" .\n%s %s "x" .\n' % (a, p, a, p, b, p)
+        # the statements are in two contexts (which Sesame, unlike the
+        # stand-in, returns once for each context), and in the second
+        # one of them has a language tag
+        self.server.store.load('test', nt, 'nt', [URIRef('http://example.org/c1')])
+        self.server.store.load('test', nt.replace('"x" .\n%s' % a, '"x"@en .\n%s' % a), 'nt', [URIRef('http://example.org/c2')])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_duplicates(self):
+        for usevalues in [False, True]:
+            conn=ADSConnection(self.server.baseurl, 'test', cachesize=10)
+            many=conn.getDataBySPMany(['uri_bib:a', 'uri_bib:b'], 'adsbase:title', usevalues=usevalues)
+            assert dict([(s, sorted(v['adsbase:title'])) for (s, v) in many.items()])=={'uri_bib:a': ['x', 'y'], 'uri_bib:b': ['x']}
+            # the cached results are the same as those from the store
+            for s in ['uri_bib:a', 'uri_bib:b']:
+                assert sorted(conn.getDataBySP(s, 'adsbase:title'))==sorted(many[s]['adsbase:title'])
+                assert sorted(ADSConnection(self.server.baseurl, 'test').getDataBySP(s, 'adsbase:title'))==sorted(many[s]['adsbase:title'])
+
+    def test_evicted(self):
+        conn=ADSConnection(self.server.baseurl, 'test')
+        conn.subjects=_EvictingCache()
+        assert sorted(conn.getDataBySP('uri_bib:a', 'adsbase:title'))==['x', 'y']
+        assert sorted(conn.getDataBySPPath('uri_bib:a', ['adsbase:title']))==['x', 'x', 'y']
+        assert conn.getDataBySPMany(['uri_bib:b'], 'adsbase:title')=={'uri_bib:b': {'adsbase:title': ['x']}}
+
+    def test_sources_failure(self):
+        (a, src, name)=[namespaces.n3encode(x) for x in ['uri_bib:a', 'adsbase:hasAstronomicalSource', 'adsbase:name']]
+        self.server.store.load('test', '%s %s <http://example.org/m31> .\n<http://example.org/m31> %s "M31" .\n' % (a, src, name), 'nt', [URIRef('http://example.org/c1')])
+        conn=ADSConnection(self.server.baseurl, 'test')
+        self.server.fail(1, 500)
+        try:
+            conn.getSourcesForBibcodes(['a'])
+            assert False, "the query did not fail"
+        except AssertionError:
+            raise
+        except:
+            pass
+        # nothing is kept from the failed call
+        sources=conn.getSourcesForBibcodes(['a'])
+        assert [source['oid'] for source in sources['a']]==[u'M31']
+
+class _EvictingCache(LRUCache):
+    """A cache whose entries are always evicted between a membership
+    test and the lookup, as a background prefetch can do."""
+
+    def __contains__(self, key):
+        return True
+
+    def get(self, key, default=None):
+        return default
+
 if __name__=="__main__":
     import sys
     c=ADSConnection('http://localhost:8081/openrdf-sesame/', 'testads3')
@@ -0,0 +1,415 @@
+"""
+Load many small RDF files into a Sesame context with one request per
+batch of files, rather than one request per file as with
+pysesame.connection.postfile:
+
+    loader=BatchLoader(c, context, maxfiles=500)
+    for fname in files:
+        loader.add(fname)
+    loader.close()
+    print loader.report()
+
+Each file is converted to N-Triples as it is added - unlike RDF/XML,
+N-Triples documents can just be concatenated, and the blank node labels
+written by rdflib are unique across files (N-Triples files are parsed
+too, so that a label such as _:b0 in two files names two blank nodes) -
+and a batch is sent, as a
+chunked POST and optionally gzip-compressed, when it reaches maxfiles
+files or maxbytes bytes of N-Triples. A file that can not be converted
+is sent on its own, as is.
+
+If each file is to be loaded into its own context (see
+loadmanifest.fileContext) the batch is sent as TriG, with the N-Triples
+for each file in a graph named by its context.
+
+The batches can be sent by a pool of threads, with a timeout for each
+request and retries for those that fail, as described for BatchLoader;
+only a couple of batches per thread are held in memory.
+"""
+
+import os.path, time, threading, Queue, urllib2, httplib, socket
+from urllib import unquote_plus
+
+import rdflib
+from rdflib import ConjunctiveGraph
+from rdflib.plugins.parsers.ntriples import NTriplesParser
+from rdflib.plugins.parsers.nt import NTSink
+
+import pysesame
+from pysesame import SPCNT, SPCXML, SPTRIG
+
+def _guessFormat(fname):
+    "The rdflib parser to use for the file."
+    ext=os.path.splitext(fname)[1]
+    if ext=='.nt':
+        return 'nt'
+    elif ext in ['.n3', '.ttl']:
+        return 'n3'
+    return 'xml'
+
+class _NTriplesParser(NTriplesParser):
+    """rdflib's N-Triples parser, with a new blank node for each label in
+    the file; rdflib 4.2 maps a label to the same blank node in every
+    file it parses."""
+
+    def __init__(self, sink=None):
+        NTriplesParser.__init__(self, sink)
+        self._bnode_ids={}
+
+def toNTriples(fname):
+    """Return the contents of the RDF file as N-Triples, or None if they
+    can not be written as N-Triples (e.g. a URI containing a space, which
+    the RDF/XML parsers accept). The blank nodes are given new labels,
+    and literals keep their lexical form, as when Sesame reads the file."""
+    g=ConjunctiveGraph()
+    normalize=rdflib.NORMALIZE_LITERALS
+    rdflib.NORMALIZE_LITERALS=False
+    try:
+        fmt=_guessFormat(fname)
+        if fmt=='nt':
+            fd=open(fname)
+            try:
+                _NTriplesParser(NTSink(g)).parse(fd)
+            finally:
+                fd.close()
+        else:
+            g.parse(fname, format=fmt)
+    finally:
+        rdflib.NORMALIZE_LITERALS=normalize
+    try:
+        return g.serialize(format='nt')
+    except Exception:
+        return None
+
+def _retryable(e):
+    """Is the error from poststream worth retrying: a failure to connect,
+    a timeout or a server (5xx) error, but not a rejected request."""
+    if isinstance(e, ValueError):
+        return len(e.args) > 0 and isinstance(e.args[0], int) and e.args[0] >= 500
+    return isinstance(e, (urllib2.URLError, httplib.HTTPException, socket.error))
+
+class BatchLoader:
+    """Collect RDF files and send them to the context of the Sesame
+    connection conn (as used by postdata, so the context should already
+    be quoted) in batches.
+
+    A batch is sent when it contains maxfiles files or the N-Triples for
+    them reaches maxbytes bytes. If compress is True each batch is sent
+    gzip-compressed (see pysesame.connection.poststream).
+
+    If nthreads is greater than zero then the batches are sent by that
+    many background threads, so that several uploads are in progress at
+    once while the caller converts the next files; otherwise they are
+    sent when the batch fills up. timeout is the socket timeout, in
+    seconds, for each request (None means no timeout). A batch that fails
+    because of a connection error, timeout or server error is retried up
+    to retries times, waiting backoff seconds before the first retry and
+    doubling the wait each time; note that a batch that timed out may
+    have been added, in which case any blank nodes in it are added twice.
+    Batches that still fail, or are rejected by Sesame, are recorded in
+    the failures field - a list of (files, message) pairs - rather than
+    stopping the load, and are written to failurefile, if given, by close.
+
+    If onsent is given it is called with the list of files in each batch
+    that Sesame accepts (from the sending thread, if there are threads),
+    e.g. LoadManifest.record.
+
+    If filecontext is given it is called with each file name and returns
+    the context (quoted, as for context) to load the file into, and the
+    batches are sent as TriG rather than to context.
+    """
+
+    def __init__(self, conn, context=None, maxfiles=500, maxbytes=8*1024*1024, compress=False,
+                 nthreads=0, retries=0, timeout=None, failurefile=None, backoff=1.0,
+                 onsent=None, filecontext=None):
+        self.context=context
+        self.filecontext=filecontext
+        self.maxfiles=maxfiles
+        self.maxbytes=maxbytes
+        self.compress=compress
+        self.retries=retries
+        self.backoff=backoff
+        self.failurefile=failurefile
+        self.onsent=onsent
+        if nthreads > 0 or timeout is not None:
+            # the threads share one pool of connections, with the timeout
+            self.conn=pysesame.connection(conn.baseurl, max(nthreads, 1), timeout, conn.metrics)
+            self.conn.use_repository(conn.repository)
+        else:
+            self.conn=conn
+        self.files=[]
+        self.chunks=[]
+        self.nbytes=0
+        # (nfiles, nbytes, seconds) for each request sent
+        self.timings=[]
+        self.nsingle=0
+        self.nretries=0
+        self.failures=[]
+        self.lock=threading.Lock()
+        self.threads=[]
+        self.queue=None
+        if nthreads > 0:
+            # the queue is bounded so that a slow Sesame holds up the
+            # caller rather than letting the batches pile up in memory
+            self.queue=Queue.Queue(2*nthreads)
+            for i in range(nthreads):
+                t=threading.Thread(target=self._sender)
+                t.setDaemon(True)
+                t.start()
+                self.threads.append(t)
+
+    def __str__(self):
+        return "<BatchLoader: maxfiles={0} maxbytes={1} compress={2} threads={3} retries={4}>".format(
+            self.maxfiles, self.maxbytes, self.compress, len(self.threads), self.retries)
+
+    def _send(self, files, chunks, nbytes, atype, context):
+        delay=self.backoff
+        attempt=0
+        while True:
+            t0=time.time()
+            try:
+                self.conn.poststream(chunks, context, atype, self.compress)
+                break
+            except Exception, e:
+                message="{0}: {1}".format(e.__class__.__name__, e)
+                if attempt >= self.retries or not _retryable(e):
+                    self.lock.acquire()
+                    try:
+                        self.failures.append((files, message))
+                    finally:
+                        self.lock.release()
+                    print "FAILED batch of {0} files starting {1}: {2}".format(len(files), files[0], message)
+                    return
+            print "RETRYING batch of {0} files starting {1} in {2}s: {3}".format(len(files), files[0], delay, message)
+            time.sleep(delay)
+            delay*=2
+            attempt+=1
+            self.lock.acquire()
+            self.nretries+=1
+            self.lock.release()
+        dt=time.time()-t0
+        self.lock.acquire()
+        try:
+            self.timings.append((len(files), nbytes, dt))
+        finally:
+            self.lock.release()
+        if self.onsent is not None:
+            self.onsent(files)
+
+    def _sender(self):
+        while True:
+            item=self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._send(*item)
+            finally:
+                self.queue.task_done()
+
+    def _queue(self, files, chunks, nbytes, atype, context):
+        if self.queue is None:
+            self._send(files, chunks, nbytes, atype, context)
+        else:
+            self.queue.put((files, chunks, nbytes, atype, context))
+
+    def _sendBatch(self):
+        if len(self.chunks)==0:
+            return
+        (files, chunks, nbytes)=(self.files, self.chunks, self.nbytes)
+        self.files=[]
+        self.chunks=[]
+        self.nbytes=0
+        if self.filecontext is None:
+            self._queue(files, chunks, nbytes, SPCNT, self.context)
+        else:
+            self._queue(files, chunks, nbytes, SPTRIG, None)
+
+    def add(self, fname):
+        """Add the file to the current batch, sending it if it is full."""
+        data=toNTriples(fname)
+        if self.filecontext is None:
+            context=self.context
+        else:
+            context=self.filecontext(fname)
+        if data is None:
+            fd=open(fname)
+            data=fd.read()
+            fd.close()
+            self.nsingle+=1
+            self._queue([fname], [data], len(data), SPCXML, context)
+            return
+        if self.filecontext is not None:
+            data=unquote_plus(context)+' {\n'+data+'}\n'
+        self.files.append(fname)
+        self.chunks.append(data)
+        self.nbytes+=len(data)
+        if len(self.chunks) >= self.maxfiles or self.nbytes >= self.maxbytes:
+            self._sendBatch()
+
+    def flush(self):
+        """Send the current batch and wait for all the batches to be sent."""
+        self._sendBatch()
+        if self.queue is not None:
+            self.queue.join()
+
+    def close(self):
+        """Send all the batches, stop the background threads and write
+        the failures to failurefile (if set); the loader should not be
+        used after this."""
+        try:
+            self.flush()
+        finally:
+            for t in self.threads:
+                self.queue.put(None)
+            for t in self.threads:
+                t.join()
+            self.threads=[]
+        if self.failurefile is not None:
+            out=open(self.failurefile, 'w')
+            out.write("# {0} failed batches, {1} files\n".format(
+                    len(self.failures), sum([len(files) for (files, message) in self.failures])))
+            for (files, message) in self.failures:
+                for fname in files:
+                    out.write("{0}\t{1}\n".format(fname, message))
+            out.close()
+
+    def report(self):
+        """Return a string summarizing the requests sent to Sesame."""
+        self.lock.acquire()
+        try:
+            timings=list(self.timings)
+        finally:
+            self.lock.release()
+        if len(timings)==0:
+            out="no requests"
+        else:
+            nfiles=sum([t[0] for t in timings])
+            nbytes=sum([t[1] for t in timings])
+            total=sum([t[2] for t in timings])
+            out="{0} files ({1} bytes) in {2} requests, {3} sent on their own, {4:.3f}s total, {5:.3f}s mean, {6:.3f}s max per request".format(
+                nfiles, nbytes, len(timings), self.nsingle, total, total/len(timings), max([t[2] for t in timings]))
+        return out+", {0} retries, {1} failed batches".format(self.nretries, len(self.failures))
+
+class TestClass:
+    """Load files through the stand-in server (run with nosetests
+    batchload.py)."""
+
+    def setUp(self):
+        import tempfile, pysesame, sesameserver
+        self.dir=tempfile.mkdtemp()
+        self.server=sesameserver.startServer()
+        self.conn=pysesame.connection(self.server.baseurl)
+        self.conn.use_repository('test')
+        self.files=[]
+        for i in range(5):
+            fname=os.path.join(self.dir, "f%d.xml" % i)
+            out=open(fname, 'w')
+            out.write('<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:ex="http://example.org/">' +
+                      '<rdf:Description rdf:about="http://example.org/a%d"><ex:p><rdf:Description><ex:q>%d</ex:q>' % (i, i) +
+                      '</rdf:Description></ex:p></rdf:Description></rdf:RDF>')
+            out.close()
+            self.files.append(fname)
+        fname=os.path.join(self.dir, "g.nt")
+        out=open(fname, 'w')
+        out.write('<http://example.org/b> <http://example.org/p> "caf\\u00E9" .\n' +
+                  '<http://example.org/b> <http://example.org/n> "1.50"^^<http://www.w3.org/2001/XMLSchema#double> .\n' +
+                  '<http://example.org/b> <http://example.org/r> _:b0 .\n_:b0 <http://example.org/q> "b" .')
+        out.close()
+        self.files.append(fname)
+        fname=os.path.join(self.dir, "h.nt")
+        out=open(fname, 'w')
+        out.write('<http://example.org/h> <http://example.org/r> _:b0 .\n_:b0 <http://example.org/q> "h" .')
+        out.close()
+        self.files.append(fname)
+
+    def tearDown(self):
+        import shutil
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def check(self, maxfiles, compress, **kw):
+        from urllib import quote_plus
+        self.server.store.repositories.clear()
+        loader=BatchLoader(self.conn, quote_plus('<http://example.org/c>'), maxfiles=maxfiles, compress=compress, **kw)
+        for fname in self.files:
+            loader.add(fname)
+        loader.close()
+        assert len(loader.timings)==(len(self.files)+maxfiles-1)/maxfiles
+        rows=self.conn.querypost('SELECT ?s ?q WHERE { GRAPH <http://example.org/c> { ?s <http://example.org/p> ?o . ?o ?p2 ?q } }')
+        # each file has its own blank node
+        assert sorted([(row['s']['value'], row['q']['value']) for row in rows])==[("http://example.org/a%d" % i, str(i)) for i in range(5)]
+        rows=self.conn.querypost('SELECT ?o WHERE { <http://example.org/b> <http://example.org/p> ?o }')
+        assert [row['o']['value'] for row in rows]==[u'caf\xe9']
+        rows=self.conn.querypost('SELECT ?o WHERE { <http://example.org/b> <http://example.org/n> ?o }')
+        assert [row['o']['value'] for row in rows]==[u'1.50']
+        # the files both label a blank node _:b0, which are not the same
+        rows=self.conn.querypost('SELECT ?s ?q WHERE { ?s <http://example.org/r> ?b . ?b <http://example.org/q> ?q }')
+        assert sorted([(row['s']['value'], row['q']['value']) for row in rows])==[("http://example.org/b", "b"), ("http://example.org/h", "h")]
+        return loader
+
+    def test_batches(self):
+        self.check(2, False)
+
+    def test_filecontext(self):
+        from urllib import quote_plus
+        filecontext=lambda fname: quote_plus('<http://example.org/c/'+os.path.basename(fname)+'>')
+        loader=BatchLoader(self.conn, None, maxfiles=4, filecontext=filecontext)
+        for fname in self.files:
+            loader.add(fname)
+        loader.close()
+        assert len(loader.timings)==2
+        rows=self.conn.querypost('SELECT ?g ?q WHERE { GRAPH ?g { ?s <http://example.org/p> ?o . ?o ?p2 ?q } }')
+        assert sorted([(row['g']['value'], row['q']['value']) for row in rows])==[("http://example.org/c/f%d.xml" % i, str(i)) for i in range(5)]
+        rows=self.conn.querypost('SELECT ?g WHERE { GRAPH ?g { ?b <http://example.org/q> "h" } }')
+        assert [row['g']['value'] for row in rows]==["http://example.org/c/h.nt"]
+
+    def test_gzip(self):
+        self.check(10, True)
+
+    def test_threads(self):
+        self.check(1, False, nthreads=3)
+
+    def test_retry(self):
+        self.server.fail(2)
+        loader=self.check(10, False, retries=2, backoff=0.01)
+        assert loader.nretries==2
+
+    def test_failures(self):
+        fname=os.path.join(self.dir, "failures")
+        self.server.fail(3)
+        loader=BatchLoader(self.conn, None, maxfiles=3, retries=1, backoff=0.01, nthreads=1, failurefile=fname)
+        for f in self.files:
+            loader.add(f)
+        loader.close()
+        # the first batch fails twice, the second once and then succeeds,
+        # as does the third
+        assert [files for (files, message) in loader.failures]==[self.files[:3]]
+        assert loader.nretries==2 and len(loader.timings)==2
+        assert [line.split('\t')[0] for line in open(fname)][1:]==self.files[:3]
+
+        # a rejected request is not retried
+        self.server.fail(1, 400)
+        loader=BatchLoader(self.conn, None, retries=3, backoff=0.01)
+        loader.add(self.files[0])
+        loader.close()
+        assert loader.nretries==0 and len(loader.failures)==1
+
+    def test_onsent(self):
+        sent=[]
+        self.server.fail(1, 400)
+        loader=BatchLoader(self.conn, None, maxfiles=2, nthreads=2, onsent=sent.extend)
+        for fname in self.files:
+            loader.add(fname)
+        loader.close()
+        # one of the batches is rejected
+        assert len(loader.failures)==1
+        assert len(sent)==len(self.files)-len(loader.failures[0][0])
+        assert sorted(sent+loader.failures[0][0])==sorted(self.files)
+
+    def test_timeout(self):
+        self.server.latency=0.5
+        loader=BatchLoader(self.conn, None, timeout=0.1, retries=1, backoff=0.01)
+        loader.add(self.files[0])
+        loader.close()
+        assert loader.nretries==1 and loader.failures[0][1].find('timed out')!=-1
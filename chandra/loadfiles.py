@@ -1,8 +1,10 @@
 #loadfiles
 __version__="0.1"
 from pysesame import connection
-from urllib import quote_plus, urlencode, quote
-import os.path, sys, os, glob
+from batchload import BatchLoader
+from loadmanifest import LoadManifest, manifestName, fileContext
+from urllib import quote_plus, unquote_plus, urlencode, quote
+import os.path, sys, os, glob, getopt
 import uuid
 
 #c=connection('http://localhost:8081/openrdf-sesame/')
@@ -10,21 +12,60 @@ import uuid
 #context=None
 testcodeuristart='<http://ads.harvard.edu/sem/context#'
 #DATA="../chandra-rdf"
-if len(sys.argv)==3:
+try:
+    opts, args = getopt.getopt(sys.argv[1:], "", ["batch", "threads=", "incremental", "resume"])
+except getopt.error, msg:
+    print msg
+    opts, args = [], []
+batch = False
+incremental = False
+resume = False
+threads = None
+for (opt, val) in opts:
+    if opt == "--batch":
+        batch = True
+    elif opt == "--threads":
+        threads = int(val)
+    elif opt == "--incremental":
+        incremental = True
+    elif opt == "--resume":
+        resume = True
+# --batch sends the files to Sesame in batches (see batchload.py) rather
+# than one request per file, and --threads N sends N batches at a time;
+# the other settings can be changed in the conf file. Batches that fail
+# after the retries are listed in BATCHFAILURES.
+# Each file is loaded into its own context, named after the file (see
+# loadmanifest.py). --incremental only sends the files that are new or
+# have changed since they were last loaded, using the manifest for the
+# context in MANIFESTDIR, and deletes the context of a changed file before
+# sending it again; --resume (which implies --incremental) continues an
+# interrupted load from the last file or batch that was sent. Set
+# LOADMANIFEST=True to always use the manifest. The manifest is not
+# checked against the store, so remove it if the store is cleared.
+BATCHFILES=500
+BATCHBYTES=8*1024*1024
+BATCHGZIP=False
+BATCHTHREADS=0
+BATCHRETRIES=3
+BATCHTIMEOUT=600
+BATCHFAILURES=None
+LOADMANIFEST=False
+MANIFESTDIR="."
+if len(args)==2:
     execfile("./default.conf")
     execfile("./chandra/default.conf")
-elif len(sys.argv)==4:
-    execfile(sys.argv[3])
+elif len(args)==3:
+    execfile(args[2])
 else:
-    print "Usage: python loadfiles.py assetsfile style [conffile]"
+    print "Usage: python loadfiles.py [--batch [--threads N]] [--incremental] [--resume] assetsfile style [conffile]"
     sys.exit(-1)
 #c.addnamespace('fb','http://rdf.freebase.com/ns/')
 #c.addnamespace('dc','http://purl.org/dc/elements/1.1/')
 c=connection(SESAME)
 c.use_repository(REPOSITORY)
 
-assetsfile=sys.argv[1]
-style=sys.argv[2]
+assetsfile=args[0]
+style=args[1]
 
 identifier=style+"-"+__file__+"-"+__version__
 
@@ -39,11 +80,46 @@ print "ASSETS", assets
 if not os.path.exists(DATA+'/'+style):
     print "Path not found"
     sys.exit(-1)
+if threads is not None:
+    BATCHTHREADS=threads
+if incremental or resume:
+    LOADMANIFEST=True
+manifest=None
+onsent=None
+if LOADMANIFEST:
+    manifest=LoadManifest(manifestName(MANIFESTDIR, REPOSITORY, context), resume)
+    onsent=manifest.record
+    print "MANIFEST:", manifest
+if batch:
+    if BATCHFAILURES is None:
+        BATCHFAILURES="../loadfiles-"+style+".failures"
+    loader=BatchLoader(c, context, BATCHFILES, BATCHBYTES, BATCHGZIP,
+                       BATCHTHREADS, BATCHRETRIES, BATCHTIMEOUT, BATCHFAILURES, onsent=onsent,
+                       filecontext=lambda filename: fileContext(context, filename))
 for ele in assets:
     filename=DATA+'/'+style+"/"+ele+".xml.rdf"
     print ele, filename
     if os.path.isfile(filename):
+        if manifest is not None and not manifest.changed(filename):
+            continue
         print filename
-        c.postfile(filename, context)
+        filecontext=fileContext(context, filename)
+        if manifest is not None and manifest.loaded(filename):
+            # remove the statements from the version loaded before
+            c.deletedata(unquote_plus(filecontext))
+        if batch:
+            loader.add(filename)
+        else:
+            c.postfile(filename, filecontext)
+            if manifest is not None:
+                manifest.record([filename])
     else:
         "FILE not found: ", filename
+if batch:
+    loader.close()
+    print "BATCHES:", loader.report()
+if manifest is not None:
+    manifest.close()
+    print "MANIFEST:", manifest.report()
+if batch and len(loader.failures) > 0:
+    sys.exit(1)
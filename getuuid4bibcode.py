@@ -1,8 +1,21 @@
 import gzip
 import sys
+import os, os.path
+import glob
+import heapq
+import fcntl
+import json
+import mmap
+import shutil
+import tempfile
 SORTEDYEARLIST='sortedyearlist.txt'
 DEFAULTPATH='../AstroExplorer/filebibs/'
 
+# The bibcode to uuid index built from DEFAULTPATH/*.gz, and the file
+# recording the size and modification time of the shards it was built
+# from (INDEXFILE+".json").
+INDEXFILE='bibcodes.idx'
+
 # as we are assuming python 2.6 we can use set() rather than Set()
 # from sets import Set
 
@@ -32,7 +45,222 @@ def openset(thefile, dbhash):
         bibcode,theuuid = line.strip().split()
         dbhash[bibcode]=theuuid
 
-def setsFromBibcodes(bibcodefile, yearhash):
+# The index is a header of HEADERLEN bytes, giving the widths of the
+# fields, followed by one line per bibcode, sorted by bibcode:
+#    bibcode (padded to keywidth) uuid (padded to valwidth) shard
+# where shard is the number of the .gz file it came from (the numbers
+# are listed in the .json file). As every line is the same length a
+# bibcode can be found with a binary search of the memory-mapped file.
+HEADERLEN=64
+SHARDWIDTH=5
+
+class BibcodeIndex:
+    """Look up the uuid of a bibcode in an index written by updateIndex."""
+
+    def __init__(self, indexfile):
+        self.fd=open(indexfile, 'rb')
+        header=self.fd.read(HEADERLEN).split()
+        if len(header)!=4 or header[0]!='bibcodeindex' or header[1]!='1':
+            raise ValueError("{0} is not a bibcode index".format(indexfile))
+        self.keywidth=int(header[2])
+        self.valwidth=int(header[3])
+        self.reclen=self.keywidth+self.valwidth+SHARDWIDTH+3
+        size=os.fstat(self.fd.fileno()).st_size
+        self.nrecords=(size-HEADERLEN) / self.reclen
+        if self.nrecords > 0:
+            self.map=mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map=None
+
+    def __len__(self):
+        return self.nrecords
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.fd.close()
+
+    def _key(self, i):
+        start=HEADERLEN+i*self.reclen
+        return self.map[start:start+self.keywidth]
+
+    def get(self, bibcode, default=None):
+        if isinstance(bibcode, unicode):
+            bibcode=bibcode.encode('utf-8')
+        if len(bibcode) > self.keywidth:
+            return default
+        key=bibcode.ljust(self.keywidth)
+        lo=0
+        hi=self.nrecords
+        while lo < hi:
+            mid=(lo+hi) / 2
+            if self._key(mid) < key:
+                lo=mid+1
+            else:
+                hi=mid
+        if lo==self.nrecords or self._key(lo)!=key:
+            return default
+        start=HEADERLEN+lo*self.reclen+self.keywidth+1
+        return self.map[start:start+self.valwidth].rstrip()
+
+    def __getitem__(self, bibcode):
+        theuuid=self.get(bibcode)
+        if theuuid is None:
+            raise KeyError(bibcode)
+        return theuuid
+
+    def records(self):
+        "Iterate through the (bibcode, uuid, shard) values in order."
+        for i in xrange(self.nrecords):
+            (bibcode, theuuid, shard)=self.map[HEADERLEN+i*self.reclen:HEADERLEN+(i+1)*self.reclen].split()
+            yield (bibcode, theuuid, int(shard))
+
+def _shardStats(defaultpath):
+    "The size and modification time of each .gz file, keyed by name."
+    stats={}
+    for fname in glob.glob(defaultpath+'*.gz'):
+        st=os.stat(fname)
+        stats[os.path.basename(fname)[:-3]]=[st.st_size, int(st.st_mtime)]
+    return stats
+
+def _record(bibcode, theuuid, shard, keywidth, valwidth):
+    "The index line for the entry, as (key, line)."
+    key=bibcode.ljust(keywidth)
+    return (key, "{0} {1} {2:0{3}d}\n".format(key, theuuid.ljust(valwidth), shard, SHARDWIDTH))
+
+def _readRun(fname, keywidth, valwidth):
+    for line in open(fname):
+        (bibcode, theuuid, shard)=line.split()
+        yield _record(bibcode, theuuid, int(shard), keywidth, valwidth)
+
+def _keptRecords(old, keep, keywidth, valwidth):
+    """The entries of the old index from the shards in keep; they are
+    copied as is unless the field widths have changed."""
+    same=(old.keywidth, old.valwidth)==(keywidth, valwidth)
+    for i in xrange(old.nrecords):
+        line=old.map[HEADERLEN+i*old.reclen:HEADERLEN+(i+1)*old.reclen]
+        if int(line[-SHARDWIDTH-1:-1]) not in keep:
+            continue
+        if same:
+            yield (line[:keywidth], line)
+        else:
+            (bibcode, theuuid, shard)=line.split()
+            yield _record(bibcode, theuuid, int(shard), keywidth, valwidth)
+
+def updateIndex(defaultpath=None, indexfile=None):
+    """Return the BibcodeIndex for the .gz files in defaultpath, building
+    it first if it does not exist. If it does, only the files that have
+    been added or changed (by size or modification time) since it was
+    last built are read; the entries from files that have been changed
+    or removed are dropped. The defaults are DEFAULTPATH and
+    defaultpath+INDEXFILE.
+
+    The check and rebuild are made holding a lock on indexfile+'.lock',
+    so that several scripts can be run at once.
+    """
+    if defaultpath is None:
+        defaultpath=DEFAULTPATH
+    if indexfile is None:
+        indexfile=defaultpath+INDEXFILE
+    lockfile=open(indexfile+'.lock', 'w')
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        return _updateIndex(defaultpath, indexfile)
+    finally:
+        lockfile.close()
+
+def _updateIndex(defaultpath, indexfile):
+    "updateIndex, once the lock is held."
+    stats=_shardStats(defaultpath)
+    old=None
+    shards={}
+    if os.path.exists(indexfile) and os.path.exists(indexfile+'.json'):
+        try:
+            old=BibcodeIndex(indexfile)
+            shards=json.load(open(indexfile+'.json'))
+        except ValueError:
+            old=None
+    keep=set()
+    changed=[]
+    numbers={}
+    for (name, stat) in stats.items():
+        if shards.has_key(name) and shards[name][:2]==stat:
+            keep.add(shards[name][2])
+            numbers[name]=shards[name][2]
+        else:
+            changed.append(name)
+    if old is not None and len(changed)==0 and len(keep)==len(shards):
+        return old
+
+    # each new or changed file is sorted into a run, and the runs are
+    # merged with the entries kept from the old index
+    if old is None:
+        keywidth=valwidth=0
+    else:
+        keywidth=old.keywidth
+        valwidth=old.valwidth
+    nextnumber=max([0]+[v[2]+1 for v in shards.values()])
+    tmpdir=tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(indexfile)))
+    try:
+        runfiles=[]
+        for name in sorted(changed):
+            numbers[name]=nextnumber
+            nextnumber+=1
+            entries=[]
+            for line in gzip.open(defaultpath+name+".gz"):
+                line=line.strip()
+                if line!='':
+                    bibcode,theuuid = line.split()
+                    entries.append((bibcode, theuuid))
+            entries.sort()
+            fname=os.path.join(tmpdir, name)
+            out=open(fname, 'w')
+            for (bibcode, theuuid) in entries:
+                keywidth=max(keywidth, len(bibcode))
+                valwidth=max(valwidth, len(theuuid))
+                out.write("{0} {1} {2}\n".format(bibcode, theuuid, numbers[name]))
+            out.close()
+            runfiles.append(fname)
+        runs=[_readRun(fname, keywidth, valwidth) for fname in runfiles]
+        if old is not None:
+            runs.append(_keptRecords(old, keep, keywidth, valwidth))
+
+        # the new files are written to tmpdir, which is in the same
+        # directory as the index, and then renamed; the names can not
+        # clash with the runs since glob skips names starting with '.'
+        fname=os.path.join(tmpdir, '.index')
+        out=open(fname, 'wb')
+        out.write("bibcodeindex 1 {0} {1}".format(keywidth, valwidth).ljust(HEADERLEN-1)+"\n")
+        out.writelines(line for (key, line) in heapq.merge(*runs))
+        out.close()
+        if old is not None:
+            old.close()
+        os.rename(fname, indexfile)
+        fname=os.path.join(tmpdir, '.index.json')
+        out=open(fname, 'w')
+        json.dump(dict([(name, stats[name]+[numbers[name]]) for name in stats.keys()]), out)
+        out.close()
+        os.rename(fname, indexfile+'.json')
+    finally:
+        shutil.rmtree(tmpdir)
+    return BibcodeIndex(indexfile)
+
+def setsFromBibcodes(bibcodefile, yearhash=None):
+    """Return the uuids of the bibcodes in bibcodefile, using the index
+    of DEFAULTPATH (which is updated first if necessary). The yearhash
+    argument is no longer needed and is ignored; setsFromYears gives
+    the old behaviour of reading the year files each time."""
+    index=updateIndex()
+    dbhash={}
+    try:
+        for line in open(bibcodefile):
+            bibcode = line.strip()
+            dbhash[bibcode]=index[bibcode]
+    finally:
+        index.close()
+    return dbhash
+
+def setsFromYears(bibcodefile, yearhash):
     #dh=setupAlts(DEFAULTPATH,'bmap.txt')
     dbhash={}
     bibcodehash={}
@@ -59,9 +287,65 @@ def setsFromBibcodes(bibcodefile, yearhash):
         #    dbhash[bcode]=bibcodehash[dh[bcode]]
     return dbhash
 
+class TestClass:
+    """Check the index against the year files (run with
+    nosetests getuuid4bibcode.py)."""
+
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()+'/'
+        self.write('bibs.2001', [('2001ApJ...561L.101W', 'u1'), ('2001A&A...100L...1T', 'u2')])
+        self.write('bibs.2002', [('2002AJ....100L...1K', 'u3')])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, pairs):
+        out=gzip.open(self.dir+name+'.gz', 'w')
+        for pair in pairs:
+            out.write("%s %s\n" % pair)
+        out.close()
+
+    def test_build_and_update(self):
+        index=updateIndex(self.dir)
+        assert len(index)==3
+        assert index['2001A&A...100L...1T']=='u2'
+        assert index.get(u'2002AJ....100L...1K')=='u3'
+        assert index.get('2001ApJ...561L.101') is None
+        assert index.get('2003ApJ...561L.101WXYZ') is None
+        index.close()
+
+        # a changed file replaces its old entries; the other is kept
+        self.write('bibs.2001', [('2001ApJ...561L.101W', 'u1-new-and-longer')])
+        os.utime(self.dir+'bibs.2001.gz', (0, 0))
+        self.write('bibs.2003', [('2003MNRAS.100L...1N', 'u4')])
+        index=updateIndex(self.dir)
+        assert [rec[:2] for rec in index.records()]==[('2001ApJ...561L.101W', 'u1-new-and-longer'),
+                                                      ('2002AJ....100L...1K', 'u3'),
+                                                      ('2003MNRAS.100L...1N', 'u4')]
+        index.close()
+
+        os.remove(self.dir+'bibs.2002.gz')
+        index=updateIndex(self.dir)
+        assert index.get('2002AJ....100L...1K') is None
+        assert index['2003MNRAS.100L...1N']=='u4'
+        index.close()
+
+    def test_concurrent(self):
+        import threading
+        results=[]
+        def update():
+            index=updateIndex(self.dir)
+            results.append([rec[:2] for rec in index.records()])
+            index.close()
+        threads=[threading.Thread(target=update) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results==[[('2001A&A...100L...1T', 'u2'), ('2001ApJ...561L.101W', 'u1'), ('2002AJ....100L...1K', 'u3')]]*4
+
 if __name__=='__main__':
     filename=sys.argv[1]	
-    yhash=storeYears(DEFAULTPATH+SORTEDYEARLIST)
-    dbhash=setsFromBibcodes(filename,  yhash)
+    dbhash=setsFromBibcodes(filename)
     for ele in dbhash.keys():
         print ele, dbhash[ele]
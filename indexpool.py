@@ -0,0 +1,103 @@
+"""
+Run an indexing function over a list of items (bibcodes or observation
+URIs) with a pool of worker processes. Each worker is set up by an
+initializer - so that it can create its own Sesame and Solr connections -
+and the items are handed out in chunks. Failures are recorded rather than
+stopping the run, and the per-worker throughput is collected so that
+it can be reported at the end, along with any values returned by the
+function.
+
+The function, initializer and items must be picklable, so use module-level
+functions.
+"""
+
+import multiprocessing
+import os, time
+
+def partition(items, chunksize):
+    """Split items into lists of at most chunksize elements."""
+    return [items[i:i+chunksize] for i in range(0, len(items), chunksize)]
+
+def _runChunk(args):
+    (func, chunk, after) = args
+    t0=time.time()
+    failures=[]
+    results=[]
+    for item in chunk:
+        try:
+            value=func(item)
+            if value is not None:
+                results.append((item, value))
+        except Exception, e:
+            failures.append((item, "{0}: {1}".format(e.__class__.__name__, e)))
+    aftervalue=None
+    if after is not None:
+        try:
+            aftervalue=after()
+        except Exception, e:
+            failures.append(("chunk of {0} starting {1}".format(len(chunk), chunk[0]),
+                             "{0}: {1}".format(e.__class__.__name__, e)))
+    return {'pid': os.getpid(), 'nitems': len(chunk), 'failures': failures,
+            'results': results, 'after': aftervalue, 'elapsed': time.time()-t0}
+
+def runPool(func, items, nworkers, initializer=None, initargs=(), chunksize=None, progress=None, after=None):
+    """Call func(item) for each item using nworkers processes, each of
+    which calls initializer(*initargs) when it starts. If given, after()
+    is called by the worker at the end of each chunk (e.g. to flush any
+    buffered output), and a failure in it is reported against the chunk;
+    its return value is passed back as the 'after' value of the chunk.
+
+    The items are sent out in chunks of chunksize; the default is small
+    enough that each worker gets several chunks, so that a slow chunk does
+    not hold up the end of the run. If given, progress(ndone, ntotal, res)
+    is called in this process as each chunk completes, where res is a
+    dictionary with the keys 'pid', 'nitems', 'failures', 'results',
+    'after' and 'elapsed' for that chunk.
+
+    The return value is (failures, workers, results), where failures is a
+    list of (item, message) pairs, workers is a dictionary, keyed by process
+    id, of dictionaries with the keys 'nitems', 'nchunks' and 'elapsed'
+    (the time spent by that worker processing its chunks), and results
+    is a dictionary of the values returned by func, keyed by item, for
+    those that did not return None.
+    """
+    if chunksize is None:
+        chunksize=max(1, min(50, len(items) / (nworkers * 4)))
+    chunks=partition(items, chunksize)
+    failures=[]
+    workers={}
+    results={}
+    ndone=0
+    pool=multiprocessing.Pool(nworkers, initializer, initargs)
+    try:
+        for res in pool.imap_unordered(_runChunk, [(func, chunk, after) for chunk in chunks]):
+            ndone+=res['nitems']
+            failures.extend(res['failures'])
+            results.update(res['results'])
+            stats=workers.setdefault(res['pid'], {'nitems': 0, 'nchunks': 0, 'elapsed': 0.0})
+            stats['nitems']+=res['nitems']
+            stats['nchunks']+=1
+            stats['elapsed']+=res['elapsed']
+            if progress is not None:
+                progress(ndone, len(items), res)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    pool.join()
+    return (failures, workers, results)
+
+def report(failures, workers, elapsed):
+    """Return a list of lines describing the results from runPool;
+    elapsed is the wall-clock time for the whole run."""
+    nitems=sum([stats['nitems'] for stats in workers.values()])
+    out=["{0} items in {1:.1f}s ({2:.2f}/s) with {3} workers, {4} failures".format(
+            nitems, elapsed, nitems / max(elapsed, 1e-6), len(workers), len(failures))]
+    for pid in sorted(workers.keys()):
+        stats=workers[pid]
+        out.append("  worker {0}: {1} items in {2} chunks, {3:.1f}s ({4:.2f}/s)".format(
+                pid, stats['nitems'], stats['nchunks'], stats['elapsed'],
+                stats['nitems'] / max(stats['elapsed'], 1e-6)))
+    for (item, msg) in failures:
+        out.append("  FAILED {0}: {1}".format(item, msg))
+    return out
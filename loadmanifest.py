@@ -0,0 +1,243 @@
+"""
+Keep track of the files that have been loaded into a Sesame context, so
+that a rerun of a load script only posts the files that are new or have
+changed since they were last loaded.
+
+A manifest is stored as a JSON file, one per repository/context, mapping
+each file name to the SHA1 hash of its contents, its size and the time
+it was loaded. While a load is running, each file (or batch of files)
+is appended to a journal next to the manifest as soon as Sesame has
+accepted it, and the journal is merged into the manifest when the load
+finishes. If the load is interrupted the journal is left behind, and
+the next run can continue from the last batch that was accepted
+(resume=True) or ignore it and compare against the manifest from the
+last complete run.
+
+Each file is loaded into its own context - the context of the load
+followed by /<file name>, see fileContext - so that when a file has
+changed the statements from the version that was loaded before can be
+removed, by deleting its context, before it is sent again.
+
+The manifest only describes what has been sent: if the store or the
+contexts are cleared, remove the manifest too so that everything is
+loaded again.
+"""
+
+import os, re, time, hashlib, threading
+from urllib import quote, quote_plus, unquote_plus
+import simplejson
+
+def fileHash(fname):
+    """Return the SHA1 hash of the contents of the file."""
+    h=hashlib.sha1()
+    fh=open(fname, 'rb')
+    try:
+        while True:
+            data=fh.read(1024*1024)
+            if data=='':
+                break
+            h.update(data)
+    finally:
+        fh.close()
+    return h.hexdigest()
+
+def manifestName(dirname, repository, context):
+    """The manifest for the context (quoted, as passed to postfile) of
+    the repository; the file is named after the part of the context URI
+    after the #."""
+    name=unquote_plus(context).strip('<>').split('#')[-1]
+    name=re.sub('[^A-Za-z0-9._-]', '_', name)
+    return os.path.join(dirname, "load-manifest-{0}-{1}.json".format(repository, name))
+
+def fileContext(context, filename):
+    """The context (quoted, as passed to postfile) that the file is
+    loaded into, for the context (also quoted) of the load."""
+    base=unquote_plus(context)[:-1]
+    return quote_plus(base+'/'+quote(os.path.basename(filename), '%:=')+'>')
+
+def _readJournal(fname):
+    """Return the entries in the journal as a dictionary; a line that
+    was only partly written when the load stopped is ignored."""
+    entries={}
+    for line in open(fname):
+        try:
+            (filename, filehash, size, loaded)=simplejson.loads(line)
+        except ValueError:
+            continue
+        entries[filename]=[filehash, size, loaded]
+    return entries
+
+class LoadManifest:
+    """The files loaded into one context, read from fname (the manifest
+    is empty if the file does not exist):
+
+        manifest=LoadManifest(fname)
+        for filename in files:
+            if manifest.changed(filename):
+                c.postfile(filename, context)
+                manifest.record([filename])
+        manifest.close()
+
+    If resume is True then the files in the journal of an interrupted
+    run are treated as loaded, otherwise the journal is discarded.
+    """
+
+    def __init__(self, fname, resume=False):
+        self.fname=fname
+        self.journalname=fname+".journal"
+        if os.path.exists(fname):
+            fh=open(fname)
+            try:
+                self.entries=simplejson.load(fh)
+            finally:
+                fh.close()
+        else:
+            self.entries={}
+        self.resumed=0
+        self.discarded=0
+        if os.path.exists(self.journalname):
+            journal=_readJournal(self.journalname)
+            if resume:
+                self.entries.update(journal)
+                self.resumed=len(journal)
+            else:
+                self.discarded=len(journal)
+                os.remove(self.journalname)
+        # the hash and size of the files that are to be loaded, from changed
+        self.pending={}
+        self.nskipped=0
+        self.nrecorded=0
+        self.journal=None
+        self.lock=threading.Lock()
+
+    def __str__(self):
+        return "<LoadManifest: {0} ({1} files, {2} resumed, {3} discarded)>".format(
+            self.fname, len(self.entries), self.resumed, self.discarded)
+
+    def loaded(self, filename):
+        """Has a version of the file been loaded, so that its context
+        needs to be cleared before it is loaded again?"""
+        return self.entries.has_key(filename)
+
+    def changed(self, filename):
+        """Is the file new, or has it changed since it was loaded? If
+        not, it is counted as skipped."""
+        size=os.path.getsize(filename)
+        filehash=fileHash(filename)
+        entry=self.entries.get(filename)
+        if entry is not None and entry[0]==filehash and entry[1]==size:
+            self.nskipped+=1
+            return False
+        self.lock.acquire()
+        try:
+            self.pending[filename]=(filehash, size)
+        finally:
+            self.lock.release()
+        return True
+
+    def record(self, filenames):
+        """Record that Sesame has accepted the files, which must have been
+        checked with changed. This can be called from several threads."""
+        loaded=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        self.lock.acquire()
+        try:
+            if self.journal is None:
+                self.journal=open(self.journalname, 'a')
+            for filename in filenames:
+                # a file listed twice is only recorded the first time
+                if not self.pending.has_key(filename):
+                    continue
+                (filehash, size)=self.pending.pop(filename)
+                self.entries[filename]=[filehash, size, loaded]
+                self.journal.write(simplejson.dumps([filename, filehash, size, loaded])+"\n")
+                self.nrecorded+=1
+            self.journal.flush()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Write out the manifest, replacing the file only once it has
+        been written, and remove the journal."""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal=None
+        tmpname=self.fname+".tmp"
+        fh=open(tmpname, "w")
+        try:
+            simplejson.dump(self.entries, fh, sort_keys=True, indent=0)
+        finally:
+            fh.close()
+        os.rename(tmpname, self.fname)
+        if os.path.exists(self.journalname):
+            os.remove(self.journalname)
+
+    def report(self):
+        """Return a string summarizing the files checked."""
+        return "{0} files loaded, {1} unchanged files skipped, {2} still to load, {3} resumed from an interrupted run, {4} discarded".format(
+            self.nrecorded, self.nskipped, len(self.pending), self.resumed, self.discarded)
+
+class TestClass:
+    """Run with nosetests loadmanifest.py."""
+
+    def setUp(self):
+        import tempfile
+        self.dir=tempfile.mkdtemp()
+        self.fname=os.path.join(self.dir, 'load-manifest.json')
+        self.files=[]
+        for i in range(3):
+            filename=os.path.join(self.dir, "f%d.rdf" % i)
+            self.write(filename, "file %d" % i)
+            self.files.append(filename)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def write(self, filename, data):
+        out=open(filename, 'w')
+        out.write(data)
+        out.close()
+
+    def test_name(self):
+        assert manifestName('logs', 'bench', '%3Chttp%3A%2F%2Fads.harvard.edu%2Fsem%2Fcontext%23pub-chandra%2Floadfiles.py-0.1%3E')== \
+            'logs/load-manifest-bench-pub-chandra_loadfiles.py-0.1.json'
+
+    def test_context(self):
+        assert unquote_plus(fileContext(quote_plus('<http://ads.harvard.edu/sem/context#obsv-loadfiles.py-0.1>'),
+                                        '/data/hut/obscore.hut.psv.hut000001=2004-12-28_21:19:00.rdf'))== \
+            '<http://ads.harvard.edu/sem/context#obsv-loadfiles.py-0.1/obscore.hut.psv.hut000001=2004-12-28_21:19:00.rdf>'
+        assert unquote_plus(fileContext(quote_plus('<http://ads.harvard.edu/sem/context#publications-loadfiles.py>'),
+                                        '../chandra-rdf/data/rdf/2009A%26A...100L...1G.xml'))== \
+            '<http://ads.harvard.edu/sem/context#publications-loadfiles.py/2009A%26A...100L...1G.xml>'
+
+    def test_changed(self):
+        manifest=LoadManifest(self.fname)
+        assert [f for f in self.files if manifest.changed(f)]==self.files
+        manifest.record(self.files[:2])
+        manifest.close()
+        assert not os.path.exists(self.fname+".journal")
+
+        self.write(self.files[0], "file 0 changed")
+        manifest=LoadManifest(self.fname)
+        assert [f for f in self.files if manifest.changed(f)]==[self.files[0], self.files[2]]
+        assert manifest.nskipped==1
+        assert manifest.loaded(self.files[0]) and not manifest.loaded(self.files[2])
+
+    def test_resume(self):
+        manifest=LoadManifest(self.fname)
+        for f in self.files:
+            manifest.changed(f)
+        manifest.record(self.files[:1])
+        manifest.record(self.files[1:2])
+        # interrupted, part way through writing the next line
+        manifest.journal.write('["' + self.files[2])
+        manifest.journal.close()
+        assert not os.path.exists(self.fname)
+
+        manifest=LoadManifest(self.fname, resume=True)
+        assert manifest.resumed==2
+        assert [f for f in self.files if manifest.changed(f)]==self.files[2:]
+
+        manifest=LoadManifest(self.fname)
+        assert manifest.discarded==2 and not os.path.exists(self.fname+".journal")
+        assert [f for f in self.files if manifest.changed(f)]==self.files
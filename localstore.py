@@ -0,0 +1,228 @@
+"""
+Read RDF files into memory and answer the ADSConnection queries used by
+the Solr indexers from them, so that an index can be built without
+loading the data into Sesame first.
+
+    c=LocalStore(glob.glob(DATA+"/data/rdf/*.xml"))
+    doc=rdf2solr5.getInfoForBibcode(c, None, bibcode, mission, project)
+
+The triples are indexed by subject and predicate, so the getDataBySP
+style calls are dictionary lookups; general SPARQL queries (makeQuery)
+are run by rdflib over the loaded graph. Named graphs (contexts) are
+not supported.
+"""
+
+import sys, os, threading
+
+from rdflib import ConjunctiveGraph, URIRef, BNode
+
+import namespaces
+import adsrdf
+from adsrdf import LRUCache, SPJSON
+
+# The RDF files that the load scripts post to Sesame, as glob patterns
+# relative to DATA: loadfiles.py, loadfiles-simbad.py, chandra/loadfiles.py
+# and, for the MAST missions, newmast/mast_obsvload.py, mast_pubload.py
+# and mast_propload.py.
+LOADEDFILES=["/data/rdf/*.xml", "/data/rdf/simbad.*.rdf", "/*/*.xml.rdf",
+             "/*/obscore.*.rdf", "/*/map.*.rdf", "/*/proposals.*.rdf"]
+
+def _guessFormat(fname):
+    "The rdflib parser to use for the file."
+    ext=os.path.splitext(fname)[1]
+    if ext=='.nt':
+        return 'nt'
+    elif ext in ['.n3', '.ttl']:
+        return 'n3'
+    return 'xml'
+
+def _binding(term):
+    "Convert a rdflib term into a SPARQL JSON binding."
+    if isinstance(term, URIRef):
+        return {'type': 'uri', 'value': unicode(term)}
+    elif isinstance(term, BNode):
+        return {'type': 'bnode', 'value': unicode(term)}
+    return {'type': 'literal', 'value': unicode(term)}
+
+class LocalTSC:
+    """Stands in for pysesame.connection, running SPARQL queries
+    against an in-memory rdflib graph."""
+
+    def __init__(self, graph):
+        self.graph=graph
+        self.pool=None
+        self.sparql_prefix="".join(['PREFIX %s:<%s>\n' % (k, v) for (k, v) in namespaces.namespace_dict.items()])
+
+    def querypost(self, q, atype=SPJSON):
+        if atype!=SPJSON:
+            raise ValueError("LocalTSC only supports SPARQL JSON results, not %s" % atype)
+        try:
+            res=self.graph.query(self.sparql_prefix+q)
+        except Exception, e:
+            return [{'error': "%s: %s" % (e.__class__.__name__, e)}]
+        names=[str(v) for v in res.vars]
+        rows=[]
+        for row in res:
+            rows.append(dict([(name, _binding(term)) for (name, term) in zip(names, row) if term is not None]))
+        return rows
+
+class LocalStore(adsrdf.ADSConnection):
+    """The read-only part of ADSConnection, answered from RDF files
+    rather than a Sesame repository."""
+
+    def __init__(self, filenames, cachesize=0, cachebytes=None, cachettl=None):
+        self.graph=ConjunctiveGraph()
+        for fname in filenames:
+            # as in Sesame, the literals keep their lexical form
+            adsrdf._parseExact(self.graph, _guessFormat(fname), source=fname)
+        self.tsc=LocalTSC(self.graph)
+        if cachesize > 0:
+            self.cache=LRUCache(cachesize, cachebytes, cachettl)
+        else:
+            self.cache=None
+        self.subjects=LRUCache(sys.maxint)
+        self.sources={}
+        self.sourceslock=threading.Lock()
+        self.fastdecode=True
+        self.nfiles=len(filenames)
+        self._index()
+
+    def __str__(self):
+        return "<LocalStore: %d files, %d triples, %d subjects>" % (self.nfiles, len(self.graph), len(self.subjects))
+
+    def _index(self):
+        """Store every subject in the prefetched-subjects structure used
+        by ADSConnection, keyed and encoded in the same way."""
+        index={}
+        seen=set()
+        for (s, p, o) in self.graph.triples((None, None, None)):
+            if isinstance(s, BNode):
+                n3s='_:'+str(s)
+            else:
+                n3s='<'+unicode(s).encode('utf-8')+'>'
+            p=str(p)
+            o=unicode(o).encode('utf-8')
+            if (n3s, p, o) in seen:
+                continue
+            seen.add((n3s, p, o))
+            index.setdefault(n3s, {}).setdefault(p, []).append(o)
+        for (n3s, preds) in index.items():
+            self.subjects.put((n3s, None), preds)
+
+    def _checkContext(self, n3context):
+        if n3context is not None:
+            raise ValueError("LocalStore does not support contexts")
+
+    def _getDataByN3(self, n3thingy, n3prop, n3context=None):
+        self._checkContext(n3context)
+        preds=self.subjects.get((n3thingy, None), {})
+        return list(preds.get(n3prop[1:-1], []))
+
+    def getDataBySPMany(self, thingies, propthingies, context=None, chunksize=50, usevalues=False):
+        if isinstance(propthingies, basestring):
+            propthingies=[propthingies]
+        if context:
+            self._checkContext(namespaces.n3encode(context))
+        result={}
+        for thingy in thingies:
+            n3thingy=self._n3subject(thingy)
+            result[thingy]=dict([(propthingy, self._getDataByN3(n3thingy, namespaces.n3encode(propthingy)))
+                                 for propthingy in propthingies])
+        return result
+
+    def getDataBySPPath(self, thingy, propthingies, context=None):
+        # every subject is held, so a node that is missing has no
+        # triples rather than needing a query
+        n3props=[namespaces.n3encode(p) for p in propthingies]
+        values=[self._n3subject(thingy)]
+        for (i, n3prop) in enumerate(n3props):
+            objects=[]
+            for n3value in values:
+                objects.extend(self._getDataByN3(n3value, n3prop))
+            if i==len(n3props)-1:
+                return objects
+            values=[]
+            for o in objects:
+                if ('_:'+o, None) in self.subjects:
+                    values.append('_:'+o)
+                else:
+                    values.append('<'+o+'>')
+        return values
+
+    def prefetchSubject(self, thingy, context=None, refresh=False):
+        pass
+
+    def prefetchQuery(self, query):
+        return 0
+
+    def getSourcesForBibcodes(self, bibcodes, chunksize=50):
+        n3p=dict([(p, namespaces.n3encode(p)) for p in ['adsbase:hasAstronomicalSource', 'adsbase:name', 'adsbase:objectType', 'adsobsv:ra', 'adsobsv:dec', 'adsbase:hasMetadataString']])
+        fields=[('name', 'adsbase:name'), ('otype', 'adsbase:objectType'), ('ra', 'adsobsv:ra'),
+                ('dec', 'adsobsv:dec'), ('meta', 'adsbase:hasMetadataString')]
+        self.sourceslock.acquire()
+        try:
+            todo=[bibcode for bibcode in bibcodes if not self.sources.has_key(bibcode)]
+        finally:
+            self.sourceslock.release()
+        found={}
+        for bibcode in todo:
+            sources=[]
+            for ouri in self._getDataByN3(namespaces.n3encode('uri_bib:'+bibcode), n3p['adsbase:hasAstronomicalSource']):
+                values={}
+                for (k, p) in fields:
+                    vals=self._getDataByN3('<'+ouri+'>', n3p[p])
+                    if len(vals) > 0:
+                        values[k]=vals[0].decode('utf-8')
+                sources.append(adsrdf._sourceFromValues(ouri.decode('utf-8'), values))
+            found[bibcode]=sources
+        self.sourceslock.acquire()
+        try:
+            self.sources.update(found)
+            return dict([(bibcode, self.sources[bibcode]) for bibcode in bibcodes])
+        finally:
+            self.sourceslock.release()
+
+    def _readonly(self, *args, **kw):
+        raise IOError("LocalStore is read only")
+
+    addFile=_readonly
+    deleteData=_readonly
+
+class TestClass:
+    """Check that the literals are read as Sesame - here the stand-in
+    server - stores them (run with nosetests localstore.py)."""
+
+    def setUp(self):
+        import tempfile, sesameserver
+        self.dir=tempfile.mkdtemp()
+        self.fname=os.path.join(self.dir, 'pos.rdf')
+        fd=open(self.fname, 'w')
+        fd.write('''<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:adsobsv="%s">
+  <rdf:Description rdf:about="%s">
+    <adsobsv:ra rdf:datatype="http://www.w3.org/2001/XMLSchema#double">1.50</adsobsv:ra>
+  </rdf:Description>
+</rdf:RDF>
+''' % (namespaces.namespace_dict['adsobsv'], namespaces.n3encode('uri_bib:pos')[1:-1]))
+        fd.close()
+        self.server=sesameserver.startServer()
+        self.server.store.load('test', open(self.fname).read(), 'xml', [None])
+
+    def tearDown(self):
+        import shutil
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def test_literals(self):
+        online=adsrdf.ADSConnection(self.server.baseurl, 'test')
+        offline=LocalStore([self.fname])
+        assert offline.getDataBySP('uri_bib:pos', 'adsobsv:ra')==online.getDataBySP('uri_bib:pos', 'adsobsv:ra')==['1.50']
+
+    def test_readonly(self):
+        offline=LocalStore([self.fname])
+        for call in [lambda: offline.deleteData(), lambda: offline.getDataBySP('uri_bib:pos', 'adsobsv:ra', 'uri_context:test')]:
+            try:
+                call()
+                assert False, "the call did not fail"
+            except (IOError, ValueError):
+                pass
@@ -1,12 +1,17 @@
 from urllib import quote_plus, urlencode, quote
 import urllib2, types
-from simplejson import loads
+import httplib, urlparse, socket, threading, re, time, zlib, errno
+from simplejson import loads, dumps
+from xml.sax.saxutils import escape, quoteattr
 
 SPJSON='application/sparql-results+json'
 SPXML='application/sparql-results+xml'
 SPCXML='application/rdf+xml'
 SPCN3='text/rdf+n3'
+SPCNT='text/plain'
 SPATXT='text/boolean'
+SPTRANS='application/x-rdftransaction'
+SPTRIG='application/x-trig'
 
 SPOC={
     's':'subj',
@@ -15,10 +20,498 @@ SPOC={
     'c':'context'
 }
 
+_ntescape=re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+_ntchars={'t':u'\t', 'n':u'\n', 'r':u'\r', '"':u'"', '\\':u'\\'}
+
+def _ntunescapematch(m):
+    esc=m.group(1)
+    if len(esc)==1:
+        return _ntchars.get(esc, esc)
+    #\U escapes need the unicode-escape codec on narrow builds
+    return ('\\'+esc).decode('unicode-escape')
+
+def _ntunescape(txt):
+    "Convert the N-Triples escapes in txt, returning a unicode string."
+    if '\\' not in txt:
+        return txt.decode('utf-8')
+    return _ntescape.sub(_ntunescapematch, txt.decode('utf-8'))
+
+def _ntterm(line, pos):
+    """Return (value, newpos) for the N-Triples term starting at line[pos].
+    URIs are returned without the angle brackets, blank nodes without
+    the leading _: and literals as their (unescaped) lexical form, with
+    any language tag or datatype dropped."""
+    while line[pos] in ' \t':
+        pos+=1
+    start=line[pos]
+    if start=='<':
+        end=line.index('>', pos)
+        return (_ntunescape(line[pos+1:end]), end+1)
+    if start=='_':
+        end=pos+2
+        while end < len(line) and line[end] not in ' \t.':
+            end+=1
+        return (line[pos+2:end].decode('utf-8'), end)
+    if start=='"':
+        end=pos+1
+        while True:
+            end=line.index('"', end)
+            #count the backslashes before the quote
+            nslash=0
+            while line[end-1-nslash]=='\\':
+                nslash+=1
+            if nslash % 2==0:
+                break
+            end+=1
+        value=_ntunescape(line[pos+1:end])
+        end+=1
+        if line[end:end+1]=='@':
+            while end < len(line) and line[end] not in ' \t':
+                end+=1
+        elif line[end:end+2]=='^^':
+            end=line.index('>', end)+1
+        return (value, end)
+    raise ValueError("Unable to parse N-Triples term at: "+line[pos:])
+
+def parse_ntriples(data):
+    """A minimal N-Triples reader: yields a (subject, predicate, object)
+    tuple of unicode strings for each statement in data, encoded as
+    described in _ntterm. No graph is built, so this is much cheaper
+    than parsing the RDF/XML form with rdflib when all that is wanted
+    is one column of the results."""
+    for line in data.splitlines():
+        line=line.strip()
+        if line=='' or line[0]=='#':
+            continue
+        (s, pos)=_ntterm(line, 0)
+        (p, pos)=_ntterm(line, pos)
+        (o, pos)=_ntterm(line, pos)
+        yield (s, p, o)
+
+def _transactionTerm(term):
+    """The element for a term - a dictionary as in the SPARQL JSON
+    results, e.g. {'type': 'uri', 'value': ...} - or None (any value,
+    when removing statements) in a transaction document."""
+    if term is None:
+        return '<null/>'
+    value=escape(term['value'])
+    if term['type']=='uri':
+        return '<uri>'+value+'</uri>'
+    elif term['type']=='bnode':
+        return '<bnode>'+value+'</bnode>'
+    attrs=''
+    if term.has_key('xml:lang'):
+        attrs+=' xml:lang='+quoteattr(term['xml:lang'])
+    if term.has_key('datatype'):
+        attrs+=' datatype='+quoteattr(term['datatype'])
+    return '<literal'+attrs+'>'+value+'</literal>'
+
+def transactionDocument(removed, added, contexts=None):
+    """Return the Sesame transaction document (SPTRANS, encoded as UTF-8)
+    that removes and then adds the statements in the lists removed and
+    added: (subject, predicate, object) tuples of terms as described in
+    _transactionTerm. The statements are removed from and added to the
+    contexts - a list of URIs - or, if there are none, removed from all
+    contexts and added to the default one."""
+    if contexts:
+        ctx='<contexts>'+''.join(['<uri>'+escape(c)+'</uri>' for c in contexts])+'</contexts>'
+    else:
+        ctx='<contexts/>'
+    out=[u'<?xml version="1.0" encoding="UTF-8"?>\n<transaction>\n']
+    for (tag, triples) in [('remove', removed), ('add', added)]:
+        for triple in triples:
+            out.append(u'<'+tag+'>'+''.join([_transactionTerm(t) for t in triple])+ctx+'</'+tag+'>\n')
+    out.append(u'</transaction>\n')
+    return u''.join(out).encode('utf-8')
+
+class _Response:
+    """The parts of a urllib2 response that connection uses, for a
+    response that has already been read in full."""
+
+    def __init__(self, url, status, reason, headers, body):
+        self.url=url
+        self.code=status
+        self.msg=reason
+        self.headers=headers
+        self.body=body
+
+    def read(self):
+        return self.body
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        pass
+
+def _bodyLength(data):
+    "The number of bytes in a request body (a string or list of strings)."
+    if isinstance(data, list):
+        return sum([len(chunk) for chunk in data])
+    return len(data or '')
+
+def _sendChunked(conn, method, path, chunks, headers):
+    "Make the request with the list of strings chunks as a chunked body."
+    conn.putrequest(method, path, skip_accept_encoding=True)
+    for (k, v) in headers.items():
+        conn.putheader(k, v)
+    conn.putheader('Transfer-Encoding', 'chunked')
+    conn.endheaders()
+    for chunk in chunks:
+        if len(chunk) > 0:
+            conn.send("%x\r\n" % len(chunk))
+            conn.send(chunk)
+            conn.send("\r\n")
+    conn.send("0\r\n\r\n")
+
+def _gzipChunks(chunks):
+    "gzip-compress the list of strings, returning a list of strings."
+    # the lowest level gets most of the gain for the very repetitive
+    # N-Triples for a fraction of the time
+    z=zlib.compressobj(1, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+    out=[z.compress(chunk) for chunk in chunks]
+    out.append(z.flush())
+    return [chunk for chunk in out if len(chunk) > 0]
+
+def _staleConnection(e):
+    """Is the error the one seen when the server has closed an idle
+    keep-alive connection before reading the request - no status line,
+    or the connection reset or closed while sending - rather than, say,
+    a timeout (after which the server may still act on the request)?"""
+    if isinstance(e, socket.timeout):
+        return False
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    return isinstance(e, socket.error) and e.errno in (errno.ECONNRESET, errno.EPIPE)
+
+class ConnectionPool:
+    """A pool of persistent (HTTP/1.1 keep-alive) connections.
+
+    Each request checks out an idle connection to the host (opening
+    a new one if there is none), reads the whole response and then
+    returns the connection to the pool, so a connection is only ever
+    used by one thread at a time and a pool can be shared by several
+    worker threads. At most maxsize connections are open per host;
+    further requests wait for one to be returned. Proxy settings
+    from the environment are not used.
+    """
+
+    def __init__(self, maxsize=4, timeout=None):
+        self.maxsize=maxsize
+        self.timeout=timeout
+        self.lock=threading.Condition()
+        self.idle={}
+        self.nopen={}
+
+    def _checkout(self, key):
+        self.lock.acquire()
+        try:
+            while True:
+                idle=self.idle.setdefault(key, [])
+                if len(idle) > 0:
+                    return (idle.pop(), True)
+                if self.nopen.get(key, 0) < self.maxsize:
+                    self.nopen[key]=self.nopen.get(key, 0)+1
+                    break
+                self.lock.wait()
+        finally:
+            self.lock.release()
+        (scheme, host, port)=key
+        if scheme=='https':
+            conn=httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn=httplib.HTTPConnection(host, port, timeout=self.timeout)
+        try:
+            conn.connect()
+            #small requests on a long-lived connection should not wait on Nagle
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except:
+            self._checkin(key, conn, False)
+            raise
+        return (conn, False)
+
+    def _checkin(self, key, conn, reuse):
+        self.lock.acquire()
+        try:
+            if reuse:
+                self.idle[key].append(conn)
+            else:
+                conn.close()
+                self.nopen[key]-=1
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def close(self, key=None):
+        "Close all the idle connections (or those to the host key)."
+        self.lock.acquire()
+        try:
+            for (k, idle) in self.idle.items():
+                if key is not None and k!=key:
+                    continue
+                for conn in idle:
+                    conn.close()
+                self.nopen[k]-=len(idle)
+                self.idle[k]=[]
+        finally:
+            self.lock.release()
+
+    def urlopen(self, req):
+        """Make the request described by the urllib2.Request req and
+        return the response, which has been read in full. As with
+        urllib2.urlopen, a HTTP error status raises urllib2.HTTPError and
+        a failure to connect raises urllib2.URLError. If the request
+        data is a list of strings then it is sent as a chunked body."""
+        url=req.get_full_url()
+        parts=urlparse.urlsplit(url)
+        if parts.port is None:
+            port={'https':443}.get(parts.scheme, 80)
+        else:
+            port=parts.port
+        key=(parts.scheme, parts.hostname, port)
+        path=parts.path or '/'
+        if parts.query:
+            path+='?'+parts.query
+        headers=dict(req.header_items())
+        body=req.get_data()
+        retried=False
+        while True:
+            try:
+                (conn, reused)=self._checkout(key)
+            except (httplib.HTTPException, socket.error), e:
+                raise urllib2.URLError(e)
+            res=None
+            try:
+                if isinstance(body, list):
+                    _sendChunked(conn, req.get_method(), path, body, headers)
+                else:
+                    conn.request(req.get_method(), path, body, headers)
+                res=conn.getresponse()
+                data=res.read()
+            except (httplib.HTTPException, socket.error), e:
+                self._checkin(key, conn, False)
+                #the server may have dropped an idle connection, in which case
+                #the others are likely to have gone too, so try again once on
+                #a new connection; anything else is left to the caller
+                if reused and not retried and res is None and _staleConnection(e):
+                    retried=True
+                    self.close(key)
+                    continue
+                raise urllib2.URLError(e)
+            except:
+                self._checkin(key, conn, False)
+                raise
+            self._checkin(key, conn, not res.will_close)
+            break
+        response=_Response(url, res.status, res.reason, res.msg, data)
+        if res.status >= 400:
+            raise urllib2.HTTPError(url, res.status, res.reason, res.msg, None)
+        return response
+
+_prefixdecl=re.compile(r'PREFIX\s+[\w-]*:\s*<[^<>]*>\s*', re.I)
+_iri=re.compile(r'<[^<>\s"{}|^`\\]*>')
+_literal=re.compile(r'"(?:[^"\\]|\\.)*"(?:@[\w-]+|\^\^\S+)?|\'(?:[^\'\\]|\\.)*\'(?:@[\w-]+|\^\^\S+)?')
+_number=re.compile(r'(?<![\w?$])[-+]?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b')
+_bnode=re.compile(r'_:\w+')
+_repeatedgroup=re.compile(r'(\{[^{}]*\})(?:\s*UNION\s*\1)+')
+
+def queryShape(query):
+    """Return the query with the PREFIX declarations removed, the URIs,
+    literals, numbers and blank nodes replaced by placeholders, repeated
+    UNION branches collapsed and the white space normalized, so that the
+    queries made from the same template have the same shape."""
+    shape=_prefixdecl.sub('', query)
+    shape=_literal.sub('""', shape)
+    shape=_iri.sub('<>', shape)
+    shape=_bnode.sub('_:b', shape)
+    shape=_number.sub('0', shape)
+    shape=' '.join(shape.split())
+    return _repeatedgroup.sub(r'\1 UNION ...', shape)
+
+class Metrics:
+    """Statistics on the requests made by one or more connections: for
+    each end point (e.g. 'sparql POST' or 'statements GET') the number of
+    requests and errors, the time taken - total and as a histogram - and
+    the bytes sent and received, and for each query shape (see queryShape)
+    the number of requests and time taken. A Metrics object can be shared
+    by several connections and threads.
+
+        m=Metrics()
+        c=connection(url, metrics=m)
+        ...
+        print m.report()
+        m.dump("metrics.json")
+
+    """
+
+    # upper limits of the histogram bins, in seconds; the last bin
+    # holds the slower requests
+    BINS=[0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10]
+
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.endpoints={}
+        self.shapes={}
+
+    def _newEndpoint(self):
+        return {'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                'sent': 0, 'received': 0, 'histogram': [0]*(len(self.BINS)+1)}
+
+    def record(self, endpoint, shape, seconds, nsent, nreceived, error=False):
+        i=0
+        while i < len(self.BINS) and seconds > self.BINS[i]:
+            i+=1
+        self.lock.acquire()
+        try:
+            stats=self.endpoints.get(endpoint)
+            if stats is None:
+                stats=self.endpoints[endpoint]=self._newEndpoint()
+            stats['count']+=1
+            stats['errors']+=int(error)
+            stats['seconds']+=seconds
+            stats['max_seconds']=max(stats['max_seconds'], seconds)
+            stats['sent']+=nsent
+            stats['received']+=nreceived
+            stats['histogram'][i]+=1
+            if shape is not None:
+                stats=self.shapes.get(shape)
+                if stats is None:
+                    stats=self.shapes[shape]={'endpoint': endpoint, 'count': 0, 'seconds': 0.0, 'received': 0}
+                stats['count']+=1
+                stats['seconds']+=seconds
+                stats['received']+=nreceived
+        finally:
+            self.lock.release()
+
+    def snapshot(self, reset=False):
+        """Return the statistics as a dictionary (that can be written
+        as JSON) with the keys 'bins', 'endpoints' and 'shapes'. If
+        reset is True then the statistics are cleared."""
+        self.lock.acquire()
+        try:
+            out={'bins': list(self.BINS),
+                 'endpoints': dict([(k, dict(v, histogram=list(v['histogram']))) for (k, v) in self.endpoints.items()]),
+                 'shapes': dict([(k, dict(v)) for (k, v) in self.shapes.items()])}
+            if reset:
+                self.endpoints={}
+                self.shapes={}
+            return out
+        finally:
+            self.lock.release()
+
+    def merge(self, snapshot):
+        """Add in the statistics from a snapshot (e.g. from another
+        process)."""
+        self.lock.acquire()
+        try:
+            for (endpoint, other) in snapshot['endpoints'].items():
+                stats=self.endpoints.get(endpoint)
+                if stats is None:
+                    stats=self.endpoints[endpoint]=self._newEndpoint()
+                for k in ['count', 'errors', 'seconds', 'sent', 'received']:
+                    stats[k]+=other[k]
+                stats['max_seconds']=max(stats['max_seconds'], other['max_seconds'])
+                stats['histogram']=[a+b for (a, b) in zip(stats['histogram'], other['histogram'])]
+            for (shape, other) in snapshot['shapes'].items():
+                stats=self.shapes.get(shape)
+                if stats is None:
+                    stats=self.shapes[shape]={'endpoint': other['endpoint'], 'count': 0, 'seconds': 0.0, 'received': 0}
+                for k in ['count', 'seconds', 'received']:
+                    stats[k]+=other[k]
+        finally:
+            self.lock.release()
+
+    def dump(self, fname):
+        "Write the statistics to fname as JSON."
+        fh=open(fname, 'w')
+        try:
+            fh.write(dumps(self.snapshot(), sort_keys=True, indent=1))
+        finally:
+            fh.close()
+
+    def report(self, nshapes=10, width=100):
+        """Return the statistics as a text table, including the nshapes
+        query shapes that took the most time (shortened to width
+        characters)."""
+        snap=self.snapshot()
+        labels=["<=%gs" % b for b in snap['bins']] + [">%gs" % snap['bins'][-1]]
+        out=["%-20s %8s %6s %10s %9s %9s %12s %12s" % ("end point", "requests", "errors", "total (s)",
+                                                       "mean (ms)", "max (ms)", "sent", "received")]
+        for (endpoint, stats) in sorted(snap['endpoints'].items()):
+            out.append("%-20s %8d %6d %10.3f %9.2f %9.2f %12d %12d" % (
+                endpoint, stats['count'], stats['errors'], stats['seconds'],
+                1000*stats['seconds']/max(stats['count'], 1), 1000*stats['max_seconds'],
+                stats['sent'], stats['received']))
+            out.append("    " + " ".join(["%s:%d" % (label, n) for (label, n) in zip(labels, stats['histogram']) if n > 0]))
+        shapes=sorted(snap['shapes'].items(), key=lambda kv: -kv[1]['seconds'])
+        if len(shapes) > 0:
+            out.append("%d query shapes, the %d slowest in total:" % (len(shapes), min(nshapes, len(shapes))))
+            out.append("%8s %10s %9s  %s" % ("requests", "total (s)", "mean (ms)", "shape"))
+            for (shape, stats) in shapes[:nshapes]:
+                if len(shape) > width:
+                    shape=shape[:width-3]+"..."
+                out.append("%8d %10.3f %9.2f  %s" % (stats['count'], stats['seconds'],
+                                                       1000*stats['seconds']/max(stats['count'], 1), shape))
+        return "\n".join(out)
+
+def _requestShape(req):
+    """Return the end point and shape of the request, as used by Metrics."""
+    parts=urlparse.urlsplit(req.get_full_url())
+    method=req.get_method()
+    if parts.path.endswith('/statements'):
+        params=urlparse.parse_qs(parts.query, keep_blank_values=True)
+        return ('statements '+method, 'statements '+method+' '+','.join(sorted(params.keys())))
+    if method=='POST':
+        params=urlparse.parse_qs(req.get_data() or '')
+    else:
+        params=urlparse.parse_qs(parts.query)
+    if params.has_key('query'):
+        return ('sparql '+method, queryShape(params['query'][0]))
+    return ('other '+method, None)
+
 class connection:
-    def __init__(self,url):
+    def __init__(self,url, poolsize=4, timeout=None, metrics=None):
+        """Connect to the Sesame server at url. Requests are made over
+        at most poolsize persistent connections (see ConnectionPool);
+        set poolsize to 0 to open a new connection for each request
+        with urllib2 instead. timeout is the socket timeout in seconds
+        for the pooled connections (None means no timeout). If metrics
+        is a Metrics object then each request is recorded in it."""
         self.baseurl=url
         self.sparql_prefix=""
+        self.metrics=metrics
+        if poolsize > 0:
+            self.pool=ConnectionPool(poolsize, timeout)
+        else:
+            self.pool=None
+
+    def _urlopen(self, req):
+        if self.metrics is not None:
+            return self._measuredUrlopen(req)
+        if self.pool is None:
+            return urllib2.urlopen(req)
+        return self.pool.urlopen(req)
+
+    def _measuredUrlopen(self, req):
+        (endpoint, shape)=_requestShape(req)
+        nsent=len(req.get_full_url())+_bodyLength(req.get_data())
+        t0=time.time()
+        try:
+            if self.pool is None:
+                res=urllib2.urlopen(req)
+                data=res.read()
+                res.close()
+                res=_Response(res.geturl(), res.code, res.msg, res.info(), data)
+            else:
+                res=self.pool.urlopen(req)
+        except:
+            self.metrics.record(endpoint, shape, time.time()-t0, nsent, 0, True)
+            raise
+        self.metrics.record(endpoint, shape, time.time()-t0, nsent, len(res.body))
+        return res
     
     def addnamespace(self,id,ns):
         self.sparql_prefix+='PREFIX %s:<%s>\n' % (id,ns) 
@@ -43,7 +536,7 @@ class connection:
             req.add_header('Content-Type','application/x-www-form-urlencoded')
             #print "INPUTDATA", req.get_data()
         try:
-            sock=urllib2.urlopen(req)
+            sock=self._urlopen(req)
             #print "INFO", sock.info()
             data=sock.read()
             #print "DATA", data
@@ -91,7 +584,7 @@ class connection:
         
     def construct_query(self,q):
         q='repositories/'+self.repository+'?query='+quote_plus(self.sparql_prefix+q)
-        res=urllib2.urlopen(self.baseurl+q)
+        res=self._urlopen(urllib2.Request(self.baseurl+q))
         data=res.read()
         res.close()
         return data
@@ -113,7 +606,7 @@ class connection:
         req=urllib2.Request(endpoint)
         #accepting rdf/xml not ntriples
         req.add_header('Accept', atype)
-        res=urllib2.urlopen(req)
+        res=self._urlopen(req)
         #print "INFO", res.info()
         readstuff=res.read()
         res.close()
@@ -129,7 +622,7 @@ class connection:
         req=urllib2.Request(endpoint)
         #accepting rdf/xml not ntriples
         req.add_header('Accept', atype)
-        res=urllib2.urlopen(req)
+        res=self._urlopen(req)
         #print "INFO", res.info()
         readstuff=res.read()
         res.close()
@@ -146,7 +639,7 @@ class connection:
         req=urllib2.Request(endpoint)
         req.get_method = lambda: 'DELETE'
         try:
-            res=urllib2.urlopen(req)
+            res=self._urlopen(req)
         except urllib2.HTTPError, e:
             print 'Code: ', e.code
             res=None
@@ -159,18 +652,20 @@ class connection:
         res.close()
         return 0
            
-    def postdata(self,data, context=None, method='POST'):
-        "POST/PUT a bunch of RDF statements into the repository"
-        #PUT replaces, rather than adds, either for whole rep, or for context
-        #/openrdf-sesame/repositories/mem-rdf/statements
+    def _statementsEndpoint(self, context):
         host=self.baseurl+'repositories/'+self.repository+'/statements'
         if context==None:
-            endpoint=host
+            return host
         elif type(context)==types.ListType:
             qlist=["context="+ele for ele in context]
-            endpoint=host+"?"+'&'.join(qlist)
-        else:
-            endpoint=host+"?"+'context='+context
+            return host+"?"+'&'.join(qlist)
+        return host+"?"+'context='+context
+
+    def postdata(self,data, context=None, method='POST'):
+        "POST/PUT a bunch of RDF statements into the repository"
+        #PUT replaces, rather than adds, either for whole rep, or for context
+        #/openrdf-sesame/repositories/mem-rdf/statements
+        endpoint=self._statementsEndpoint(context)
         #print 'ENDPOINT', endpoint 
         req=urllib2.Request(endpoint)
         if method=='PUT':#otherwise assume POST
@@ -178,7 +673,7 @@ class connection:
         req.add_header('Content-Type', SPCXML)
         req.add_data(data)
         try:
-            res=urllib2.urlopen(req)
+            res=self._urlopen(req)
             print res.info()
         except urllib2.HTTPError, e:
             print 'Code: ', e.code
@@ -192,7 +687,47 @@ class connection:
         #readstuff=res.read()
         res.close()
         return 0
+
+    def poststream(self, chunks, context=None, atype=SPCNT, compress=False):
+        """POST the RDF statements in chunks - a list of strings that
+        together make up one document of type atype - into the repository.
+        With a connection pool they are sent as a chunked request, so the
+        strings are never joined. If compress is True the body is sent
+        gzip-compressed (Content-Encoding: gzip), which the server (or a
+        proxy in front of it) must support. A HTTP error raises ValueError
+        with the status code, as with postdata."""
+        req=urllib2.Request(self._statementsEndpoint(context))
+        req.add_header('Content-Type', atype)
+        if compress:
+            chunks=_gzipChunks(chunks)
+            req.add_header('Content-Encoding', 'gzip')
+        if self.pool is None:
+            req.add_data(''.join(chunks))
+        else:
+            req.add_data(chunks)
+        try:
+            res=self._urlopen(req)
+        except urllib2.HTTPError, e:
+            print 'Error code: ', e.code
+            raise ValueError(e.code)
+        res.close()
+        return 0
        
+    def transaction(self, removed, added, contexts=None):
+        """Remove and add statements in one request, which Sesame applies
+        as a single transaction; the arguments are as for
+        transactionDocument. A HTTP error raises ValueError with the
+        status code, as with postdata."""
+        req=urllib2.Request(self._statementsEndpoint(None))
+        req.add_header('Content-Type', SPTRANS)
+        req.add_data(transactionDocument(removed, added, contexts))
+        try:
+            res=self._urlopen(req)
+        except urllib2.HTTPError, e:
+            print 'Error code: ', e.code
+            raise ValueError(e.code)
+        res.close()
+
     def postfile(self, thefile, context=None, method='POST'):
         #print "FILE", thefile
         fd=open(thefile)
@@ -14,6 +14,12 @@ from namespaces import n3encode
 import time
 import logging
 import re
+import getopt
+import indexpool
+import localstore
+import glob
+from rollup import Rollup
+from solrbatch import SolrBatchWriter
 logger = None
 
 DAPROPSBIB=['id','bibcode','title', 'author', 'author_s','keywords','keywords_s', 'pubyear_i', 'objectnames', 'objectnames_s', 'objecttypes', 'objecttypes_s']
@@ -70,6 +76,61 @@ def info(lbl, msg):
 #are twofold (a) Ordering (b) stuff added later. Currently we punt on (b)
 #by assuming everything is just added at one time. ie we redo all SOLR.
 
+# The observation, proposal and paper sub-documents created during
+# a run, so that each is only created once however many documents
+# include it. Set up by initialize_memo; when None nothing is stored.
+memo = None
+
+def initialize_memo():
+    """Start a new (empty) store of sub-documents."""
+    global memo
+    memo = {'docs': {}, 'active': set(), 'hits': 0, 'misses': 0, 'cycles': 0}
+
+def memoReport():
+    if memo is None:
+        return "off"
+    return "{0} sub-documents, {1} hits, {2} misses, {3} cycles".format(
+        len(memo['docs']), memo['hits'], memo['misses'], memo['cycles'])
+
+def copyDoc(doc):
+    """Copy the document so that the lists in it are not shared."""
+    return dict([(k, list(v) if isinstance(v, list) else v) for (k, v) in doc.items()])
+
+def memoize(kind):
+    """Decorator for the getInfoFor... routines so that the sub-documents
+    they create (i.e. when entrybool is False) are stored in memo. The
+    key includes the othersbool settings since these change what is
+    included. A request for a document that is still being created - e.g.
+    paper to observation to paper - returns an empty document rather than
+    recursing."""
+    def wrap(func):
+        def getInfo(c, solr, uri, mission, project, othersbool=None, entrybool=False):
+            if memo is None or entrybool:
+                return func(c, solr, uri, mission, project, othersbool, entrybool)
+            flags=()
+            if othersbool:
+                flags=tuple(sorted([k for (k, v) in othersbool.items() if v]))
+            key=(kind, uri, mission, project, flags)
+            if memo['docs'].has_key(key):
+                memo['hits']+=1
+                return copyDoc(memo['docs'][key])
+            if key in memo['active']:
+                memo['cycles']+=1
+                debug("CYCLE", key)
+                return {}
+            memo['misses']+=1
+            memo['active'].add(key)
+            try:
+                doc=func(c, solr, uri, mission, project, othersbool, entrybool)
+            finally:
+                memo['active'].discard(key)
+            memo['docs'][key]=doc
+            return copyDoc(doc)
+        getInfo.__name__=func.__name__
+        getInfo.__doc__=func.__doc__
+        return getInfo
+    return wrap
+
 def splitns(theuri, splitter='/', atposition=-2):
     splittuple=theuri.split(splitter)[atposition-1:]
     return splittuple
@@ -123,6 +184,7 @@ def getTailFromSplit(mission, project, theuri, thetype='OBSV'):
         
     return themission, theproject, theobsid, thedataid, uritail
 
+@memoize('obsv')
 def getInfoForObsuri(c, solr, theuri, mission, project, othersbool=None, entrybool=False):
     daprops=[]
     thedict={}
@@ -137,18 +199,13 @@ def getInfoForObsuri(c, solr, theuri, mission, project, othersbool=None, entrybo
  
     
     debug("URITAIL", uritail)
+    # most of the information below comes from the observation URI
+    c.prefetchSubject('uri_obs:'+uritail)
     if is_mast:
-        pquery0="""
-        SELECT ?tname WHERE {
-        %s adsbase:target ?tnode.
-        ?tnode adsbase:name ?tname.            
-        }
-        """ % (n3encode('uri_obs:'+uritail))
-        #Sprint pquery0
-        res1=c.makeQuery(pquery0)
+        res1=c.getDataBySPPath('uri_obs:'+uritail, ['adsbase:target', 'adsbase:name'])
         debug("RES1", res1)
         if len(res1) > 0:
-            target=res1[0]['tname']['value']
+            target=res1[0].decode("utf-8")
         else:
             target='Unspecified'
         #target=res1[0]['tname']['value']
@@ -170,9 +227,9 @@ def getInfoForObsuri(c, solr, theuri, mission, project, othersbool=None, entrybo
     #thedict['obsids_s']=rinitem(theobsid)
     thedict['obsids_s']=theproject+"/"+theobsid
     if theproject==themission:
-            thedict['obsv_mission_s']=theproject
-        else:
-            thedict['obsv_mission_s']=themission+"/"+theproject
+        thedict['obsv_mission_s']=theproject
+    else:
+        thedict['obsv_mission_s']=themission+"/"+theproject
     #print theobsid, c.getDataBySP('uri_obs:'+uritail, 'adsobsv:observationType')
     obstypes=c.getDataBySP('uri_obs:'+uritail, 'adsobsv:observationType')
     if len(obstypes)>0:
@@ -246,11 +303,11 @@ def getInfoForObsuri(c, solr, theuri, mission, project, othersbool=None, entrybo
     res=c.makeQuery(pquery)
     dtypes=set()
     duriset=set()
-    for ele in res:
-        thedatauri=ele['daturi']['value']
-        #print "THEDATAURI", thedatauri
-        datauritail=getTailFromSplit(mission, project, thedatauri,'DATA')[-1]
-        dtype=c.getDataBySP('uri_dat:'+datauritail, 'adsbase:dataType')[0]
+    datauritails=[getTailFromSplit(mission, project, ele['daturi']['value'],'DATA')[-1] for ele in res]
+    dtypedata=c.getDataBySPMany(['uri_dat:'+datauritail for datauritail in datauritails], 'adsbase:dataType')
+    for datauritail in datauritails:
+        #print "THEDATAURI", datauritail
+        dtype=dtypedata['uri_dat:'+datauritail]['adsbase:dataType'][0]
         dtypes.add(dtype)
         duriset.add(datauritail)
     #BUG: Still assume one istrument. This will change, point is how? There will be both
@@ -300,23 +357,15 @@ def getInfoForObsuri(c, solr, theuri, mission, project, othersbool=None, entrybo
     thepointings=c.getDataBySP('uri_obs:'+uritail, 'adsobsv:associatedPosition')
     
     if len(thepointings) > 0:
-        pquery="""
-        SELECT ?ra ?dec WHERE {
-        %s adsobsv:associatedPosition ?position.
-        ?position adsobsv:ra ?ra.
-        ?position adsobsv:dec ?dec.
-            
-        }
-        """ % (n3encode('uri_obs:'+uritail))
-    
-        #print pquery
-        res=c.makeQuery(pquery)
-        #print "POINTING", res
+        # the position is a blank node
+        ras=c.getDataBySPPath('uri_obs:'+uritail, ['adsobsv:associatedPosition', 'adsobsv:ra'])
+        decs=c.getDataBySPPath('uri_obs:'+uritail, ['adsobsv:associatedPosition', 'adsobsv:dec'])
+        #print "POINTING", ras, decs
         ra=None
         dec=None
-        if len(res)!=0:
-            ra=res[0]['ra']['value']
-            dec=res[0]['dec']['value']
+        if len(ras)!=0 and len(decs)!=0:
+            ra=ras[0]
+            dec=decs[0]
             #print "RADEC", ra, dec
         if ra!='None' and dec!='None':
             thedict['ra_f']=float(ra)
@@ -408,6 +457,7 @@ def getInfoForObsuri(c, solr, theuri, mission, project, othersbool=None, entrybo
     #though paper proposals will be assoced with papers, not here, so this should be obsvprop
     #only
     #what happens when like in 2002ApJ...573..157N, this shows up for multiple missions
+@memoize('prop')
 def getInfoForPropuri(c, solr, propuri, mission, project, othersbool=None, entrybool=False):
     daprops=[]   
     thedict={}
@@ -423,6 +473,7 @@ def getInfoForPropuri(c, solr, propuri, mission, project, othersbool=None, entry
     #themission, thevariable, thepropid=splitns(propuri)
     #proptail=themission+"/"+thevariable+"/"+thepropid
     thedict['propids_s']=theproject+"/"+thepropid
+    c.prefetchSubject('uri_prop:'+proptail)
     #print proptail, n3encode('uri_prop:'+proptail), c.getDataBySP('uri_prop:'+proptail, 'adsbase:title')
     proposaltitles=c.getDataBySP('uri_prop:'+proptail, 'adsbase:title')
     if len(proposaltitles)>0:
@@ -499,6 +550,7 @@ def biburiForId(idee, c):
     return biburi
 #THE REVERSE IS NOT UNIQUE. WE NEED SOME WAY OF IDENTIFYING THE LATEST
 
+@memoize('bib')
 def getInfoForBibcode(c, solr, bibcode, mission, project, othersbool=None, entrybool=False):
     daprops=[]
     result={}
@@ -512,6 +564,8 @@ def getInfoForBibcode(c, solr, bibcode, mission, project, othersbool=None, entry
     theid=result['id']
     iduri='uri_bib:'+result['id']
     debug("IDURI", "{0} {1}".format(iduri, result['id']))
+    # the work is queried for the keywords, title, abstract and citations
+    c.prefetchSubject(iduri)
         
     result['bibcode']=bibcode
 
@@ -524,16 +578,8 @@ def getInfoForBibcode(c, solr, bibcode, mission, project, othersbool=None, entry
     result['keywords_s']=result['keywords']
     result['title']=c.getDataBySP(iduri, 'adsbase:title')[0].decode("utf-8") # DJB added decode statement as I think we want to send across a unicode string
     if entrybool==True:
-        pquery0="""
-            SELECT ?atext WHERE {
-                uri_bib:%s adsbib:hasAbstract [ adsbib:abstractText ?atext ] .            
-            }
-        """ % (result['id'])
-
-        #print pquery0
-        res1=c.makeQuery(pquery0)
-        #print res1[0]
-        result['abstract']=res1[0]['atext']['value']
+        # the abstract is stored in a blank node
+        result['abstract']=c.getDataBySPPath(iduri, ['adsbib:hasAbstract', 'adsbib:abstractText'])[0].decode("utf-8")
 
     debug("TITLE", result['title'].encode("ascii", "replace")) ## can contain UTF-8
     
@@ -621,24 +667,18 @@ def getInfoForBibcode(c, solr, bibcode, mission, project, othersbool=None, entry
     result['author']=result['author_s']
     #get the publication uri
     result['pubyear_i']=int(c.getDataBySP(bibcodeuri, 'adsbib:pubDate')[0].split()[1])
-    theobjects=c.getDataBySP(bibcodeuri, 'adsbase:hasAstronomicalSource')
-    debug("THEOBJECTS", "{0} {1}".format(bibcode, len(theobjects)))
+    sources=c.getSourcesForBibcodes([bibcode])[bibcode]
+    debug("THEOBJECTS", "{0} {1}".format(bibcode, len(sources)))
     objectlist=[]
-    for theobj in theobjects:
-        #print "theobj", theobj
-        odata=c.getDataBySP('uri_source:'+theobj.split('/')[-1], 'adsbase:hasMetadataString')
-        #print "theobj", theobj, odata
-        if len(odata)>0:
-            odict=eval(odata[0]) # why does this need to be an eval? aha, because we are storing a Python dictionary in the string!
-            oid=odict['id']
+    for source in sources:
+        if source['otype'] is not None:
+            oid=source['oid']
             # Strip out the leading 'NAME ' from object identifiers
             if oid.startswith("NAME "):
                 oid = oid[5:]
-            otype=odict['otype']
-            ouri=theobj
-            objectlist.append({'oid':oid, 'otype':otype, 'ouri':ouri})
+            objectlist.append({'oid':oid, 'otype':source['otype'], 'ouri':source['ouri']})
         else:
-            print "PROBLEM", bibcode, theobj, odata
+            print "PROBLEM", bibcode, source['ouri'], source
     result['objectnames']=[e['oid'] for e in objectlist]
     result['objecttypes']=[e['otype'] for e in objectlist]
     result['objectnames_s']=result['objectnames']
@@ -707,18 +747,9 @@ def getInfoForBibcode(c, solr, bibcode, mission, project, othersbool=None, entry
 def doAugment(keylist, incdict, dictray):
     print "KEYLIST", keylist
     #print dictray
-    if len(dictray)>0:
-        for tkey in keylist:
-            #print "tkey is ", tkey
-            temptkey=[e[tkey] for e in dictray if e.has_key(tkey)]
-            #print "temptkey", temptkey
-            temp2=[item if hasattr(item,'__iter__') else [item] for item in temptkey]
-            #print "temp2", temp2
-            if len(temp2) >0:
-                incdict[tkey]=reduce(lambda x,y: x+y, temp2)
-            else:
-		if not incdict.has_key(tkey):
-                    incdict[tkey]=[]
+    rollup=Rollup(keylist)
+    rollup.addAll(dictray)
+    rollup.emit(incdict, overwrite=False)
 
 import pprint
 class TestClass:
@@ -763,6 +794,46 @@ def putIntoSolr(sesame, solrinstance, bibcode, mission, project, othersbool):
 
     solrinstance.add([bibdir], commit=False)
     
+# The connections and settings used by each process when run with
+# --workers; set up by initWorker.
+worker = None
+
+def initWorker(sesameurl, repository, solrurl, cacheargs, batchargs, mission, project, othersbool, offlinefiles=None):
+    """Create the Sesame and Solr connections for a worker process;
+    cacheargs are the cachesize, cachebytes and cachettl arguments of
+    adsrdf.ADSConnection and batchargs the maxdocs, maxbytes, commitwithin
+    and nthreads arguments of SolrBatchWriter. If offlinefiles is not None
+    then these RDF files are read into a localstore.LocalStore which is
+    used instead of Sesame."""
+    global worker
+    initialize_memo()
+    if offlinefiles is None:
+        sesame = adsrdf.ADSConnection(sesameurl, repository, *cacheargs)
+    else:
+        sesame = localstore.LocalStore(offlinefiles, *cacheargs)
+    worker = {'sesame': sesame,
+              'solr': SolrBatchWriter(pysolr.Solr(solrurl), *batchargs),
+              'mission': mission, 'project': project, 'othersbool': othersbool}
+
+def flushWorker():
+    """Send any documents the worker has buffered to Solr."""
+    worker['solr'].flush()
+    debug("Solr batches:", worker['solr'].report())
+    debug("Sub-documents:", memoReport())
+
+def indexBibcode(bibcode):
+    """Add the document for bibcode to Solr (without a commit)."""
+    putIntoSolr(worker['sesame'], worker['solr'], bibcode,
+                worker['mission'], worker['project'], worker['othersbool'])
+
+def indexObsuri(obsuri):
+    """Add the document for the observation to Solr (without a commit)."""
+    obsvdir=getInfoForObsuri(worker['sesame'], worker['solr'], obsuri,
+                             worker['mission'], worker['project'], worker['othersbool'], True)
+    worker['solr'].add([obsvdir], commit=False)
+
+def showProgress(ndone, ntotal, res):
+    info("Indexed:", "{0}/{1} (worker {2}, {3} failures in chunk)".format(ndone, ntotal, res['pid'], len(res['failures'])))
     
 # Issue with loading into sh obsids.sh and all wont we duplicate them
 # if we do stuff separately for overlaps and stuff. Should we do it
@@ -775,42 +846,81 @@ if __name__=="__main__":
     initialize_logging("rdf2solarfuncs")
     debug("Starting:", time.asctime())
     
-    if len(sys.argv)==5:
+    usage = "Usage: python rdf2solarfuncs.py [--workers N] [--offline] MISSION(CAPS) project(small) type typefile [conffile]"
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["workers=", "offline"])
+    except getopt.error, msg:
+        print msg
+        print usage
+        sys.exit(-1)
+
+    # --workers splits the list between N processes, each with its
+    # own connections
+    # --offline reads the RDF files given by OFFLINEFILES rather than
+    # querying Sesame.
+    nworkers = 0
+    offline = False
+    for (opt, val) in opts:
+        if opt == "--workers":
+            nworkers = int(val)
+        elif opt == "--offline":
+            offline = True
+
+    if len(args)==4:
         confname = "./default.conf"
-    elif len(sys.argv)==6:
-        confname = sys.argv[5]
+    elif len(args)==5:
+        confname = args[4]
     else:
-        print "Usage: python rdf2solarfuncs.py MISSION(CAPS) project(small) type typefile [conffile]"
+        print usage
         sys.exit(-1)
 
+    # Settings for the query cache used by the Sesame connection;
+    # these can be overridden in the configuration file.
+    CACHESIZE=20000
+    CACHEBYTES=256*1024*1024
+    CACHETTL=None
+
+    # Documents are sent to Solr in batches of SOLRBATCHDOCS documents
+    # (or SOLRBATCHBYTES bytes, if set) by SOLRTHREADS background
+    # threads (0 means send from the main thread).
+    SOLRBATCHDOCS=100
+    SOLRBATCHBYTES=None
+    SOLRCOMMITWITHIN=None
+    SOLRTHREADS=0
+
+    # The RDF files read by --offline, as glob patterns (the files are
+    # the ones loaded into Sesame by the load scripts).
+    OFFLINEFILES=None
+
     debug("Execing:", confname)
     execfile(confname)
 
-    dafile=sys.argv[4]
-    datype=sys.argv[3]
-    mission=sys.argv[1]
-    project=sys.argv[2]
+    if OFFLINEFILES is None:
+        OFFLINEFILES=[DATA+pattern for pattern in localstore.LOADEDFILES]
+    if offline:
+        offlinefiles=[]
+        for pattern in OFFLINEFILES:
+            offlinefiles.extend(sorted(glob.glob(pattern)))
+        info("Reading:", "{0} RDF files".format(len(offlinefiles)))
+    else:
+        offlinefiles=None
+
+    dafile=args[3]
+    datype=args[2]
+    mission=args[0]
+    project=args[1]
 
     info("Mission:", mission)
     info("Project:", project)
-    sesame = adsrdf.ADSConnection(SESAME, REPOSITORY)
-    info("Sesame connection:", sesame)
 
-    solr=pysolr.Solr(SOLR)
-    info("Solr connection:", solr)
-    
     if datype=='bib':
         othersbool={
             'obsv':True,
             'prop':True
         }
-        researchpapers=[ele.strip() for ele in open(dafile).readlines()]
-        debug("Research papers:", researchpapers)
-        for ele in researchpapers:
-            info("Indexing:", ele)
-            bibdir=getInfoForBibcode(sesame, solr, ele, mission, project, othersbool, True)
-            solrinstance.add([bibdir], commit=False)
-            logger.info("-------------")
+        items=[ele.strip() for ele in open(dafile).readlines()]
+        debug("Research papers:", items)
+        indexfunc=indexBibcode
     elif datype=='obsv':
         othersbool={
             'prop':True,
@@ -818,15 +928,38 @@ if __name__=="__main__":
         }
         #obsuris=[ele.strip() for ele in open(dafile).readlines()]
         obsmap=eval(open(dafile).read())
-        obsuris=[str(e) for e in obsmal.keys()]
-        debug("Observations:", obsuris)
-        for ele in obsuris:
+        items=[str(e) for e in obsmap.keys()]
+        debug("Observations:", items)
+        indexfunc=indexObsuri
+    else:
+        print "Unknown type:", datype
+        print usage
+        sys.exit(-1)
+
+    initargs=(SESAME, REPOSITORY, SOLR, (CACHESIZE, CACHEBYTES, CACHETTL),
+              (SOLRBATCHDOCS, SOLRBATCHBYTES, SOLRCOMMITWITHIN, SOLRTHREADS),
+              mission, project, othersbool, offlinefiles)
+    if nworkers > 0:
+        t0 = time.time()
+        (failures, workers, results) = indexpool.runPool(indexfunc, items, nworkers, initWorker, initargs,
+                                                progress=showProgress, after=flushWorker)
+        for line in indexpool.report(failures, workers, time.time()-t0):
+            info("Workers:", line)
+    else:
+        initWorker(*initargs)
+        info("Sesame connection:", worker['sesame'])
+        if datype=='bib':
+            worker['sesame'].getSourcesForBibcodes(items)
+        info("Solr connection:", worker['solr'])
+        for ele in items:
             info("Indexing:", ele)
-            obsvdir=getInfoForObsuri(sesame, solr, ele, mission, project, othersbool,True)
-            solrinstance.add([obsvdir], commit=False)
+            indexfunc(ele)
             logger.info("-------------")
-            
-        
+        worker['solr'].close()
+        info("Query cache:", worker['sesame'].cacheReport())
+        info("Sub-documents:", memoReport())
+        info("Solr batches:", worker['solr'].report())
 
+    solr=pysolr.Solr(SOLR)
     solr.commit()
     debug("Finished:", time.asctime())
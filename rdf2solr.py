@@ -1,6 +1,7 @@
 #rdf2solr: this is only for the bib stuff...not the connected observation and proposal stuff
 import adsrdf
 import pysolr
+from solrbatch import SolrBatchWriter
 from urllib import unquote, quote_plus
 import uuid, sys
 import HTMLParser
@@ -56,9 +57,10 @@ if __name__=="__main__":
     researchpapers=[ele.strip() for ele in open(sys.argv[1]).readlines()]
     print researchpapers
     #researchpapers=['2002ApJ...564..683M']
-    solr=pysolr.Solr(SOLR)
+    solr=SolrBatchWriter(pysolr.Solr(SOLR))
     for ele in researchpapers:
         print "Indexing: ",ele
         putIntoSolr(solr, ele)
         print "-------------"
     solr.commit()
+    solr.close()
@@ -2,6 +2,7 @@
 #rdf2solr
 import adsrdf
 import pysolr
+from solrbatch import SolrBatchWriter
 from urllib import unquote, quote_plus
 import uuid, sys
 import HTMLParser, datetime, calendar
@@ -303,7 +304,7 @@ if __name__=="__main__":
     researchpapers=[ele.strip() for ele in open(sys.argv[1]).readlines()]
     print researchpapers
     #researchpapers=['2000A&A...359..489C', '2000ApJ...534L..47G', '2000ApJ...536L..27W', '2000ApJ...540L..69S', '2000ApJ...541...49H']
-    solr=pysolr.Solr(SOLR)
+    solr=SolrBatchWriter(pysolr.Solr(SOLR))
     #solr=None
     #researchpapers=['2000ApJ...534L..47G', '2009ApJ...692.1143K']
     for ele in researchpapers:
@@ -311,3 +312,4 @@ if __name__=="__main__":
         putIntoSolr(solr, ele)
         print "-------------"
     solr.commit()
+    solr.close()
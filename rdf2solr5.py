@@ -1,6 +1,7 @@
 #v2: This contains the connected stuff
 #rdf2solr
 import adsrdf
+import pysesame
 import pysolr
 from urllib import unquote, quote_plus
 import uuid, sys
@@ -12,6 +13,14 @@ from namespaces import n3encode
 
 import time
 import logging
+import getopt
+import simplejson
+import indexpool
+from rollup import Rollup
+import solrmanifest
+import localstore
+import glob
+from solrbatch import SolrBatchWriter
 
 logger = None
 
@@ -55,6 +64,8 @@ def info(lbl, msg):
 #The critical problem when we have multiple results from different surveys
 #are twofold (a) Ordering (b) stuff added later. Currently we punt on (b)
 #by assuming everything is just added at one time. ie we redo all SOLR.
+#With --incremental the documents are compared against the manifest from
+#the last run (see solrmanifest.py) and only the changed ones are sent.
 
 def splitns(theuri, splitter='/', atposition=-2):
     splittuple=theuri.split(splitter)[atposition-1:]
@@ -80,13 +91,12 @@ def getInfoForBibcode(c, solr, bibcode, mission, project):
     debug("returned", "{0} {1}".format(iduri, bibcodeuri))
     iduri=iduri[0]
 
-    # we use the original URI when accessing the author names
-    idurifull = iduri
-    
     result['id']=iduri.split('#')[1]
     theid=result['id']
     iduri='uri_bib:'+result['id']
     debug("IDURI", "{0} {1}".format(iduri, result['id']))
+    # the work is queried for the keywords, title, abstract and citations
+    c.prefetchSubject(iduri)
         
     result['bibcode']=bibcode
 
@@ -95,19 +105,14 @@ def getInfoForBibcode(c, solr, bibcode, mission, project):
     # store. Note that we unquote the fragment to ensure %3B and
     # other keywords are displayed sensibly.
     # 
-    result['keywords']=[unquote(e.split('#')[1]).replace('_',' ') for e in c.getDataBySP(iduri, 'adsbib:keywordConcept')]
+    # The multi-valued fields are sorted, since the order the store
+    # returns values in depends on how they were queried (e.g. with
+    # getInfoForBibcodeComposed), and the document should not.
+    result['keywords']=sorted([unquote(e.split('#')[1]).replace('_',' ') for e in c.getDataBySP(iduri, 'adsbib:keywordConcept')])
     
     result['title']=c.getDataBySP(iduri, 'adsbase:title')[0].decode("utf-8") # DJB added decode statement as I think we want to send across a unicode string
-    pquery0="""
-        SELECT ?atext WHERE {
-            uri_bib:%s adsbib:hasAbstract [ adsbib:abstractText ?atext ] .            
-        }
-     """ % (result['id'])
-
-    #print pquery0
-    res1=c.makeQuery(pquery0)
-    #print res1[0]
-    result['abstract']=res1[0]['atext']['value']
+    # the abstract is stored in a blank node
+    result['abstract']=c.getDataBySPPath(iduri, ['adsbib:hasAbstract', 'adsbib:abstractText'])[0].decode("utf-8")
 
     debug("TITLE", result['title'].encode("ascii", "replace")) ## can contain UTF-8
     citationcount=len(c.getDataBySP(iduri, 'cito:cites'))
@@ -180,37 +185,31 @@ def getInfoForBibcode(c, solr, bibcode, mission, project):
     result['author']=[unquote(e.split('/')[-2]).replace('_',' ') for e in authoren]
     """
 
-    aqstr = "SELECT ?name {{ <{0}> <http://swan.mindinformatics.org/ontologies/1.2/pav/authoredBy> [ <http://swan.mindinformatics.org/ontologies/1.2/agents/normName> ?name ].}}".format(idurifull)
-    authoren = c.makeQuery(aqstr)
+    authoren = c.getDataBySPPath(iduri, ['pav:authoredBy', 'agent:normName'])
     authorlist = set()
     for au in authoren:
-        authorlist.add(au["name"]["value"])
+        authorlist.add(au.decode("utf-8"))
         
-    result['author'] = list(authorlist)
+    result['author'] = sorted(authorlist)
     
     #print result['author']
     result['keywords_s']=result['keywords']
     result['author_s']=result['author']
     #get the publication uri
     result['pubyear_i']=int(c.getDataBySP(bibcodeuri, 'adsbib:pubDate')[0].split()[1])
-    theobjects=c.getDataBySP(bibcodeuri, 'adsbase:hasAstronomicalSource')
-    debug("THEOBJECTS", "{0} {1}".format(bibcode, len(theobjects)))
+    sources=c.getSourcesForBibcodes([bibcode])[bibcode]
+    debug("THEOBJECTS", "{0} {1}".format(bibcode, len(sources)))
     objectlist=[]
-    for theobj in theobjects:
-        #print "theobj", theobj
-        odata=c.getDataBySP('uri_source:'+theobj.split('/')[-1], 'adsbase:hasMetadataString')
-        #print "theobj", theobj, odata
-        if len(odata)>0:
-            odict=eval(odata[0]) # why does this need to be an eval? aha, because we are storing a Python dictionary in the string!
-            oid=odict['id']
+    for source in sources:
+        if source['otype'] is not None:
+            oid=source['oid']
             # Strip out the leading 'NAME ' from object identifiers
             if oid.startswith("NAME "):
                 oid = oid[5:]
-            otype=odict['otype']
-            ouri=theobj
-            objectlist.append({'oid':oid, 'otype':otype, 'ouri':ouri})
+            objectlist.append({'oid':oid, 'otype':source['otype'], 'ouri':source['ouri']})
         else:
-            print "PROBLEM", bibcode, theobj, odata
+            print "PROBLEM", bibcode, source['ouri'], source
+    objectlist.sort(key=lambda e: (e['oid'], e['otype'], e['ouri']))
     result['objectnames']=[e['oid'] for e in objectlist]
     result['objecttypes']=[e['otype'] for e in objectlist]
     result['objectnames_s']=result['objectnames']
@@ -222,7 +221,8 @@ def getInfoForBibcode(c, solr, bibcode, mission, project):
     #    result['missions_s']=mission+"/"+project
     #print result['objectnames']
     #theobsids=[rinitem(splitns(e)) for e in c.getDataBySP(bibcodeuri, 'adsbase:aboutScienceProduct')]
-    theobsiduris=c.getDataBySP(bibcodeuri, 'adsbase:aboutScienceProcess')
+    # the observation fields are rolled up in the order of the observations
+    theobsiduris=sorted(c.getDataBySP(bibcodeuri, 'adsbase:aboutScienceProcess'))
     #print "OBSIDS", bibcodeuri, theobsiduris
     obsray=[]
     #TESTnotice by this we dont uniq telescopes or data types...what does this mean for the numbers, if anything?
@@ -278,18 +278,13 @@ def getInfoForBibcode(c, solr, bibcode, mission, project):
             raise ValueError("Unable to decode URI for mission: " + theuri)
         
         debug("URITAIL", uritail)
+        # most of the information below comes from the observation URI
+        c.prefetchSubject('uri_obs:'+uritail)
         if is_mast:
-            pquery0="""
-            SELECT ?tname WHERE {
-            %s adsbase:target ?tnode.
-            ?tnode adsbase:name ?tname.            
-            }
-            """ % (n3encode('uri_obs:'+uritail))
-            #Sprint pquery0
-            res1=c.makeQuery(pquery0)
+            res1=c.getDataBySPPath('uri_obs:'+uritail, ['adsbase:target', 'adsbase:name'])
             debug("RES1", res1)
             if len(res1) > 0:
-                target=res1[0]['tname']['value']
+                target=res1[0].decode("utf-8")
             else:
                 target='Unspecified'
             #target=res1[0]['tname']['value']
@@ -355,23 +350,21 @@ def getInfoForBibcode(c, solr, bibcode, mission, project):
         
         #hasDatum is a subset of hasDataProduct. How do we get sparql to fo up inhertitance hierarchy
         #Currently we have no way of knowing as the owl file hasnt been loaded in
-        pquery="""
-            SELECT ?dtype WHERE {
-            {%s adsobsv:hasDataProduct ?daturi.} UNION {%s adsobsv:hasDatum ?daturi.}
-            ?daturi adsbase:dataType ?dtype.
-            }
-        """ % (n3encode('uri_obs:'+uritail),n3encode('uri_obs:'+uritail) )
-        res=c.makeQuery(pquery)
-        #print "RES", res, pquery
+        daturis=['<'+e+'>' for e in c.getDataBySP('uri_obs:'+uritail, 'adsobsv:hasDataProduct')+c.getDataBySP('uri_obs:'+uritail, 'adsobsv:hasDatum')]
+        datdata=c.getDataBySPMany(daturis, 'adsbase:dataType')
+        res=[]
+        for daturi in daturis:
+            res.extend(datdata[daturi]['adsbase:dataType'])
+        #print "RES", res
         tempdt={}
         if len(res)>0:
             for ele in res:
-                tkey=ele['dtype']['value']
+                tkey=ele.decode("utf-8")
                 if tempdt.has_key('tkey'):
                     tempdt[tkey]+=1
                 else:
                     tempdt[tkey]=1
-            thedict['datatypes_s']=tempdt.keys()
+            thedict['datatypes_s']=sorted(tempdt.keys())
         else:
             thedict['datatypes_s']=[]
 
@@ -403,29 +396,21 @@ def getInfoForBibcode(c, solr, bibcode, mission, project):
         #BUG:Note that by doing this emdomains is optional...Not sure we want that
         if len(theemdomains) > 0:
             thedict['emdomains_s']=[]
-            for domain in theemdomains:
+            for domain in sorted(theemdomains):
                 thedict['emdomains_s'].append(domain.split('_')[-1])
             
         thepointings=c.getDataBySP('uri_obs:'+uritail, 'adsobsv:associatedPosition')
         
         if len(thepointings) > 0:
-            pquery="""
-            SELECT ?ra ?dec WHERE {
-            %s adsobsv:associatedPosition ?position.
-            ?position adsobsv:ra ?ra.
-            ?position adsobsv:dec ?dec.
-                
-            }
-            """ % (n3encode('uri_obs:'+uritail))
-        
-            #print pquery
-            res=c.makeQuery(pquery)
-            #print "POINTING", res
+            # the position is a blank node
+            ras=c.getDataBySPPath('uri_obs:'+uritail, ['adsobsv:associatedPosition', 'adsobsv:ra'])
+            decs=c.getDataBySPPath('uri_obs:'+uritail, ['adsobsv:associatedPosition', 'adsobsv:dec'])
+            #print "POINTING", ras, decs
             ra=None
             dec=None
-            if len(res)!=0:
-                ra=res[0]['ra']['value']
-                dec=res[0]['dec']['value']
+            if len(ras)!=0 and len(decs)!=0:
+                ra=ras[0]
+                dec=decs[0]
                 #print "RADEC", ra, dec
             if ra!='None' and dec!='None':
                 thedict['ra_f']=float(ra)
@@ -455,6 +440,7 @@ def getInfoForBibcode(c, solr, bibcode, mission, project):
             #themission, thevariable, thepropid=splitns(propuri)
             #proptail=themission+"/"+thevariable+"/"+thepropid
             thedict['propids_s']=theproject+"/"+thepropid
+            c.prefetchSubject('uri_prop:'+proptail)
             #print proptail, n3encode('uri_prop:'+proptail), c.getDataBySP('uri_prop:'+proptail, 'adsbase:title')
             proposaltitles=c.getDataBySP('uri_prop:'+proptail, 'adsbase:title')
             if len(proposaltitles)>0:
@@ -483,15 +469,14 @@ def getInfoForBibcode(c, solr, bibcode, mission, project):
                 else:
                     raise ValueError("Unexpected mission '{0}' for {1}".format(mission, propuri))
 
-            qstr = "SELECT ?name WHERE { <" + propuri + "> adsbase:principalInvestigator [ agent:fullName ?name ] . }"
-            pinameres = c.makeQuery(qstr)
+            pinameres = c.getDataBySPPath('<'+propuri+'>', ['adsbase:principalInvestigator', 'agent:fullName'])
             nres = len(pinameres)
             if nres == 0:
                 piname = 'No Info'
             else:
                 if nres != 1:
                     print("DBG: found {0} proposal pis for {1}, using first from {2}".format(nres, propuri, pinameres))
-                piname = pinameres[0]["name"]["value"]
+                piname = pinameres[0].decode("utf-8")
                 # the following should not occur but just in case
                 if piname.strip() == "":
                     logger.debug("PINAME: found ' ' so converting to 'No Info'; should not happen")
@@ -507,7 +492,7 @@ def getInfoForBibcode(c, solr, bibcode, mission, project):
             #print thedict
         obsray.append(thedict)
         
-    result['missions_s']=list(missions)
+    result['missions_s']=sorted(missions)
 
     """ paper types are currently removed
 
@@ -519,29 +504,295 @@ def getInfoForBibcode(c, solr, bibcode, mission, project):
     """
 
     #print "OBSRAY", obsray
-    if len(obsray)>0:
-        for tkey in daprops:
-            #print "tkey is ", tkey
-            temptkey=[e[tkey] for e in obsray if e.has_key(tkey)]
-            #print "temptkey", temptkey
-            temp2=[item if hasattr(item,'__iter__') else [item] for item in temptkey]
-            #print "temp2", temp2
-            if len(temp2) >0:
-                result[tkey]=reduce(lambda x,y: x+y, temp2)
-            else:
-                result[tkey]=[]
+    rollup=Rollup(daprops)
+    rollup.addAll(obsray)
+    rollup.emit(result)
     return result
 
 
-def putIntoSolr(sesame, solrinstance, bibcode, mission, project):
-    bibdir=getInfoForBibcode(sesame, solrinstance, bibcode, mission, project)
+# The nodes whose triples are needed by getInfoForBibcode, given as
+# patterns that bind ?s, where %(bib)s is the bibcode (expression) URI.
+# The first set is for
+# the paper itself and the second for the observations and proposals
+# it is linked to.
+#
+PAPERNODES=[
+    "%(bib)s fabio:isRealizationOf ?w . ?s fabio:isRealizationOf ?w . FILTER(sameTerm(?s, %(bib)s))",
+    "%(bib)s fabio:isRealizationOf ?s .",
+    "%(bib)s fabio:isRealizationOf ?w . ?w adsbib:hasAbstract ?s .",
+    "%(bib)s fabio:isRealizationOf ?w . ?w pav:authoredBy ?s .",
+    "%(bib)s adsbase:aboutScienceProcess ?s .",
+]
+
+OBSVNODES=[
+    "%(bib)s adsbase:aboutScienceProcess ?x . ?x adsobsv:associatedPosition ?s .",
+    "%(bib)s adsbase:aboutScienceProcess ?x . ?x adsbase:target ?s .",
+    "%(bib)s adsbase:aboutScienceProcess ?x . ?x adsobsv:hasDataProduct ?s .",
+    "%(bib)s adsbase:aboutScienceProcess ?x . ?x adsobsv:hasDatum ?s .",
+    "%(bib)s adsbase:aboutScienceProcess ?x . ?x adsbase:asAResultOfProposal ?s .",
+    "%(bib)s adsbase:aboutScienceProcess ?x . ?x adsbase:asAResultOfProposal ?y . ?y adsbase:principalInvestigator ?s .",
+]
+
+def composeNodeQuery(nodes, bib):
+    """Return a SPARQL query for all the triples of the nodes matched
+    by the patterns in nodes (PAPERNODES or OBSVNODES), for the
+    given (n3-encoded) bibcode URI, or list of URIs."""
+    if isinstance(bib, basestring):
+        bib=[bib]
+    branches=" UNION ".join(["{ "+(node % {'bib':b})+" }" for b in bib for node in nodes])
+    return "SELECT ?s ?p ?o WHERE { "+branches+" ?s ?p ?o . }"
+
+def prefetchBibcode(c, bibcode):
+    """Load everything that getInfoForBibcode needs for bibcode into
+    the connection's prefetched subjects, using two queries (one for
+    the paper and one for its observations and proposals)."""
+    bib=n3encode('uri_bib:'+bibcode)
+    nsubj=c.prefetchQuery(composeNodeQuery(PAPERNODES, bib))
+    nsubj+=c.prefetchQuery(composeNodeQuery(OBSVNODES, bib))
+    debug("PREFETCHED", "{0} {1} subjects".format(bibcode, nsubj))
+
+def prefetchBibcodes(c, bibcodes, chunksize=50):
+    """Load everything that getInfoForBibcode needs for all the papers
+    in bibcodes into the connection's prefetched subjects, so the
+    connection should have been created with prefetchsize=None. As
+    with prefetchBibcode there are two queries, but each is for
+    chunksize papers at a time, with the bibcodes written into the
+    patterns. The results go straight to the prefetched subjects
+    rather than the query cache.
+    """
+    for i in range(0, len(bibcodes), chunksize):
+        bibs=[n3encode('uri_bib:'+bibcode) for bibcode in bibcodes[i:i+chunksize]]
+        nsubj=c.prefetchQuery(composeNodeQuery(PAPERNODES, bibs))
+        nsubj+=c.prefetchQuery(composeNodeQuery(OBSVNODES, bibs))
+        debug("BULK", "{0} subjects for {1} papers".format(nsubj, len(bibs)))
+
+def startPrefetchBibcode(ac, bibcode):
+    """Start fetching the data needed by getInfoForBibcode for bibcode
+    using the AsyncADSConnection ac; the paper and observation queries
+    (see prefetchBibcode) and the sources are requested at the same
+    time. Returns the list of Futures for the requests."""
+    bib=n3encode('uri_bib:'+bibcode)
+    return [ac.prefetchQuery(composeNodeQuery(PAPERNODES, bib)),
+            ac.prefetchQuery(composeNodeQuery(OBSVNODES, bib)),
+            ac.getSourcesForBibcodes([bibcode])]
+
+def indexConcurrently(ac, solr, bibcodes, mission, project, lookahead=8, manifest={}):
+    """Add the documents for bibcodes to Solr, fetching the data for the
+    next lookahead papers while the current one is being created. The
+    documents are created from ac.conn, whose prefetchsize should be
+    large enough to hold lookahead+1 papers. The manifest is as for
+    putIntoSolr, and the entries for the unchanged papers are returned."""
+    pending={}
+    newmanifest={}
+    for (i, bibcode) in enumerate(bibcodes):
+        for ahead in bibcodes[i:i+lookahead+1]:
+            if not pending.has_key(ahead):
+                pending[ahead]=startPrefetchBibcode(ac, ahead)
+        for future in pending.pop(bibcode):
+            future.result()
+        info("Indexing:", bibcode)
+        entry=putIntoSolr(ac.conn, solr, bibcode, mission, project, False, manifest.get(bibcode))
+        if entry is not None:
+            newmanifest[bibcode]=entry
+    return newmanifest
+
+def getInfoForBibcodeComposed(c, solr, bibcode, mission, project):
+    """As getInfoForBibcode but the data is fetched up front with
+    prefetchBibcode, and the document is then assembled from memory.
+
+    The connection should be created with a prefetchsize large enough
+    to hold all the nodes of a paper, otherwise the ones that have been
+    dropped are queried individually.
+    """
+    prefetchBibcode(c, bibcode)
+    return getInfoForBibcode(c, solr, bibcode, mission, project)
+
+def putIntoSolr(sesame, solrinstance, bibcode, mission, project, composed=False, oldentry=None):
+    """Create the document for bibcode and add it to Solr, unless
+    oldentry - the manifest entry from the last run - shows that it
+    has not changed, in which case the entry is returned. The entry
+    for a document that is added is only known to be sent once Solr
+    has accepted the batch holding it, so None is returned and it is
+    recorded by the onsent function of the SolrBatchWriter (see
+    acceptedEntries)."""
+    if composed:
+        bibdir=getInfoForBibcodeComposed(sesame, solrinstance, bibcode, mission, project)
+    else:
+        bibdir=getInfoForBibcode(sesame, solrinstance, bibcode, mission, project)
     #print '===================================='
     #print bibdir
     #print '===================================='
 
-    solrinstance.add([bibdir], commit=False)
+    dochash=solrmanifest.documentHash(bibdir)
+    if oldentry is None or oldentry[1]!=dochash:
+        solrinstance.add([bibdir], commit=False)
+        return None
+    debug("Unchanged:", bibcode)
+    return [bibdir['id'], dochash]
+
+def acceptedEntries(manifest):
+    """Return a function, to use as the onsent argument of SolrBatchWriter,
+    that adds the manifest entries of the documents Solr accepts to
+    manifest."""
+    def record(docs):
+        for doc in docs:
+            manifest[doc['bibcode']]=[doc['id'], solrmanifest.documentHash(doc)]
+    return record
     
+# The connections and settings used by each process when run with
+# --workers; set up by initWorker.
+worker = None
+
+# The pysesame.Metrics for the run when --metrics is given; with
+# --workers the statistics from each worker are added in by showProgress.
+runmetrics = None
+
+# The manifest entries for the documents the workers have sent to Solr,
+# added in by showProgress.
+acceptedmanifest = {}
+
+def openStore(sesameurl, repository, cacheargs, offlinefiles=None, metrics=None):
+    """Return the connection to Sesame or, if offlinefiles is not None,
+    a localstore.LocalStore containing those files; cacheargs are the
+    cachesize, cachebytes, cachettl and prefetchsize arguments of
+    adsrdf.ADSConnection. The requests to Sesame are recorded in
+    metrics, if given."""
+    if offlinefiles is None:
+        return adsrdf.ADSConnection(sesameurl, repository, *cacheargs, metrics=metrics)
+    info("Reading:", "{0} RDF files".format(len(offlinefiles)))
+    return localstore.LocalStore(offlinefiles, *cacheargs[:3])
+
+def initWorker(sesameurl, repository, solrurl, cacheargs, batchargs, mission, project, composed, manifest, offlinefiles=None, usemetrics=False):
+    """Create the Sesame and Solr connections for a worker process;
+    cacheargs and offlinefiles are as for openStore and batchargs the
+    maxdocs, maxbytes, commitwithin and nthreads arguments of
+    SolrBatchWriter. The manifest is from the last run (empty if all
+    documents are to be sent). If usemetrics is True then the requests
+    to Sesame are recorded."""
+    global worker
+    metrics = None
+    if usemetrics:
+        metrics = pysesame.Metrics()
+    accepted = {}
+    worker = {'sesame': openStore(sesameurl, repository, cacheargs, offlinefiles, metrics),
+              'solr': SolrBatchWriter(pysolr.Solr(solrurl), *batchargs, onsent=acceptedEntries(accepted)),
+              'mission': mission, 'project': project, 'composed': composed,
+              'manifest': manifest, 'metrics': metrics, 'accepted': accepted}
+
+def flushWorker():
+    """Send any documents the worker has buffered to Solr, returning
+    the manifest entries for the documents Solr has accepted and the
+    request statistics (None if they are not being recorded) since the
+    last call."""
+    worker['solr'].flush()
+    debug("Solr batches:", worker['solr'].report())
+    accepted = dict(worker['accepted'])
+    worker['accepted'].clear()
+    metrics = None
+    if worker['metrics'] is not None:
+        metrics = worker['metrics'].snapshot(reset=True)
+    return {'accepted': accepted, 'metrics': metrics}
+
+def indexBibcode(bibcode):
+    """Add the document for bibcode to Solr (without a commit) using the
+    worker's connections, returning its manifest entry if it has not
+    changed."""
+    return putIntoSolr(worker['sesame'], worker['solr'], bibcode,
+                       worker['mission'], worker['project'], worker['composed'],
+                       worker['manifest'].get(bibcode))
+
+def showProgress(ndone, ntotal, res):
+    if res['after'] is not None:
+        acceptedmanifest.update(res['after']['accepted'])
+        if runmetrics is not None:
+            runmetrics.merge(res['after']['metrics'])
+    info("Indexed:", "{0}/{1} (worker {2}, {3} failures in chunk)".format(ndone, ntotal, res['pid'], len(res['failures'])))
     
+class TestClass:
+    """Check that the composed and separate documents are the same for
+    the papers in tests/composed - RDF from the synthetic corpus (see
+    scripts/gencorpus.py) as written by the Chandra pipeline - loaded
+    into the stand-in Sesame server (run with nosetests rdf2solr5.py)."""
+
+    def setUp(self):
+        import os.path, sesameserver
+        from rdflib import URIRef
+        initialize_logging("rdf2solr5-test")
+        testdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "composed")
+        self.server = sesameserver.startServer()
+        context = URIRef("http://ads.harvard.edu/sem/context#test")
+        for fname in glob.glob(testdir+"/data/rdf/*.xml")+glob.glob(testdir+"/*/*.xml.rdf"):
+            self.server.store.load('test', open(fname).read(), 'xml', [context])
+        self.separate = adsrdf.ADSConnection(self.server.baseurl, 'test')
+        self.composed = adsrdf.ADSConnection(self.server.baseurl, 'test', prefetchsize=None)
+        self.bibcodes = [ele.strip() for ele in open(testdir+"/composed.txt").readlines()]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_composed_matches_separate(self):
+        nauthors = []
+        for bibcode in self.bibcodes:
+            expected = getInfoForBibcode(self.separate, None, bibcode, 'CHANDRA', 'chandra')
+            got = getInfoForBibcodeComposed(self.composed, None, bibcode, 'CHANDRA', 'chandra')
+            assert simplejson.dumps(got, sort_keys=True) == simplejson.dumps(expected, sort_keys=True), bibcode
+            assert len(expected['obsids_s']) == 3, bibcode
+            nauthors.append(len(expected['author']))
+        # the order of the values only matters if there are several
+        assert max(nauthors) > 1
+
+    def test_bulk_matches_separate(self):
+        prefetchBibcodes(self.composed, self.bibcodes[1:], chunksize=2)
+        # only the requested papers are fetched
+        assert self.composed.subjects.get((n3encode('uri_bib:'+self.bibcodes[0]), None)) is None
+        for bibcode in self.bibcodes[1:]:
+            assert self.composed.subjects.get((n3encode('uri_bib:'+bibcode), None)) is not None, bibcode
+            expected = getInfoForBibcode(self.separate, None, bibcode, 'CHANDRA', 'chandra')
+            got = getInfoForBibcode(self.composed, None, bibcode, 'CHANDRA', 'chandra')
+            assert simplejson.dumps(got, sort_keys=True) == simplejson.dumps(expected, sort_keys=True), bibcode
+
+class TestOfflineClass:
+    """Check that --offline creates the same documents as a run against
+    Sesame for the HUT papers in tests/mast - RDF from the synthetic
+    corpus as written by the newmast scripts - where Sesame holds every
+    file under the directory (run with nosetests rdf2solr5.py)."""
+
+    def setUp(self):
+        import os.path, sesameserver
+        from rdflib import URIRef
+        initialize_logging("rdf2solr5-test")
+        self.testdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "mast")
+        self.server = sesameserver.startServer()
+        context = URIRef("http://ads.harvard.edu/sem/context#test")
+        self.loaded = glob.glob(self.testdir+"/data/rdf/*.xml")+glob.glob(self.testdir+"/hut/*.rdf")
+        for fname in self.loaded:
+            self.server.store.load('test', open(fname).read(), 'xml', [context])
+        self.online = adsrdf.ADSConnection(self.server.baseurl, 'test')
+        offlinefiles = []
+        for pattern in localstore.LOADEDFILES:
+            offlinefiles.extend(sorted(glob.glob(self.testdir+pattern)))
+        self.offlinefiles = offlinefiles
+        self.offline = localstore.LocalStore(offlinefiles)
+        self.bibcodes = [ele.strip() for ele in open(self.testdir+"/mast.txt").readlines()]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_files(self):
+        assert sorted(self.offlinefiles) == sorted(self.loaded)
+
+    def test_offline_matches_online(self):
+        for bibcode in self.bibcodes:
+            expected = getInfoForBibcode(self.online, None, bibcode, 'MAST', 'hut')
+            got = getInfoForBibcode(self.offline, None, bibcode, 'MAST', 'hut')
+            assert simplejson.dumps(got, sort_keys=True) == simplejson.dumps(expected, sort_keys=True), bibcode
+            # the observations come from map.hut.rdf
+            assert len(expected['obsids_s']) > 0, bibcode
+        proposal = 'uri_prop:MAST/hut/propid/P00001'
+        assert self.offline.getDataBySP(proposal, 'adsbase:title') == self.online.getDataBySP(proposal, 'adsbase:title') != []
+
 # Issue with loading into sh obsids.sh and all wont we duplicate them
 # if we do stuff separately for overlaps and stuff. Should we do it
 # just once or check whats been loaded to protect against this BUG
@@ -553,36 +804,211 @@ if __name__=="__main__":
     initialize_logging("rdf2solr5")
     debug("Starting:", time.asctime())
     
-    if len(sys.argv)==4:
+    usage = "Usage: python rdf2solr5.py [--composed|--bulk|--concurrent N|--offline] [--workers N] [--incremental] [--metrics FILE] MISSION(CAPS) project(small) biblistfile [conffile]"
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["composed", "bulk", "workers=", "incremental", "concurrent=", "offline", "metrics="])
+    except getopt.error, msg:
+        print msg
+        print usage
+        sys.exit(-1)
+
+    # --bulk fetches the data for the whole list before creating any
+    # documents, so needs enough memory to hold it
+    # --workers splits the list between N processes, each with its
+    # own connections; it can not be combined with --bulk.
+    # --incremental only sends the documents that differ from the last
+    # run and deletes those that are no longer present.
+    # --concurrent makes up to N queries at once from a single process,
+    # fetching the data for the next LOOKAHEAD papers while the current
+    # one is being created.
+    # --offline reads the RDF files given by OFFLINEFILES rather than
+    # querying Sesame.
+    # --metrics records the time and size of each request to Sesame,
+    # by end point and query shape, and writes them to FILE as JSON
+    # (and to the log as a table) at the end of the run.
+    composed = False
+    bulk = False
+    nworkers = 0
+    incremental = False
+    nconcurrent = 0
+    offline = False
+    metricsfile = None
+    for (opt, val) in opts:
+        if opt == "--composed":
+            composed = True
+        elif opt == "--bulk":
+            bulk = True
+        elif opt == "--workers":
+            nworkers = int(val)
+        elif opt == "--incremental":
+            incremental = True
+        elif opt == "--concurrent":
+            nconcurrent = int(val)
+        elif opt == "--offline":
+            offline = True
+        elif opt == "--metrics":
+            metricsfile = val
+
+    if bulk and nworkers > 0:
+        print "--bulk and --workers can not be used together"
+        print usage
+        sys.exit(-1)
+
+    if nconcurrent > 0 and (bulk or composed or nworkers > 0):
+        print "--concurrent can not be used with --bulk, --composed or --workers"
+        print usage
+        sys.exit(-1)
+
+    if offline and (bulk or composed or nconcurrent > 0):
+        print "--offline can not be used with --bulk, --composed or --concurrent"
+        print usage
+        sys.exit(-1)
+
+    if len(args)==3:
         confname = "./default.conf"
-    elif len(sys.argv)==5:
-        confname = sys.argv[4]
+    elif len(args)==4:
+        confname = args[3]
     else:
-        print "Usage: python rdf2solr4.py MISSION(CAPS) project(small) biblistfile [conffile]"
+        print usage
         sys.exit(-1)
 
+    # Settings for the query cache used by the Sesame connection;
+    # these can be overridden in the configuration file.
+    CACHESIZE=20000
+    CACHEBYTES=256*1024*1024
+    CACHETTL=None
+    PREFETCHSIZE=4096
+    LOOKAHEAD=8
+
+    # Documents are sent to Solr in batches of SOLRBATCHDOCS documents
+    # (or SOLRBATCHBYTES bytes, if set) by SOLRTHREADS background
+    # threads (0 means send from the main thread).
+    SOLRBATCHDOCS=100
+    SOLRBATCHBYTES=None
+    SOLRCOMMITWITHIN=None
+    SOLRTHREADS=0
+
+    # The directory containing the manifests of what has been sent
+    # to Solr.
+    MANIFESTDIR="."
+
+    # The RDF files read by --offline, as glob patterns (the files are
+    # the ones loaded into Sesame by the load scripts).
+    OFFLINEFILES=None
+
     debug("Execing:", confname)
     execfile(confname)
 
-    biblist=sys.argv[3]
-    mission=sys.argv[1]
-    project=sys.argv[2]
+    if OFFLINEFILES is None:
+        OFFLINEFILES=[DATA+pattern for pattern in localstore.LOADEDFILES]
+    if offline:
+        offlinefiles=[]
+        for pattern in OFFLINEFILES:
+            offlinefiles.extend(sorted(glob.glob(pattern)))
+    else:
+        offlinefiles=None
+
+    if metricsfile is not None:
+        runmetrics = pysesame.Metrics()
+
+    biblist=args[2]
+    mission=args[0]
+    project=args[1]
 
     info("Mission:", mission)
     
-    sesame = adsrdf.ADSConnection(SESAME, REPOSITORY)
-    info("Sesame connection:", sesame)
-
     researchpapers=[ele.strip() for ele in open(biblist).readlines()]
     debug("Research papers:", researchpapers)
-    
-    solr=pysolr.Solr(SOLR)
-    info("Solr connection:", solr)
 
-    for ele in researchpapers:
-        info("Indexing:", ele)
-        putIntoSolr(sesame, solr, ele, mission, project)
-        #logger.info("-------------")
+    # The manifest is always written out, so that a full run can be
+    # followed by incremental ones.
+    manifestname=solrmanifest.manifestName(MANIFESTDIR, mission, project)
+    oldmanifest=solrmanifest.loadManifest(manifestname)
+    if incremental:
+        info("Manifest:", "{0} ({1} papers)".format(manifestname, len(oldmanifest)))
+        sentmanifest=oldmanifest
+    else:
+        sentmanifest={}
+
+    if nworkers > 0:
+        t0 = time.time()
+        (failures, workers, newmanifest) = indexpool.runPool(indexBibcode, researchpapers, nworkers,
+                                                initWorker, (SESAME, REPOSITORY, SOLR,
+                                                             (CACHESIZE, CACHEBYTES, CACHETTL, PREFETCHSIZE),
+                                                             (SOLRBATCHDOCS, SOLRBATCHBYTES, SOLRCOMMITWITHIN, SOLRTHREADS),
+                                                             mission, project, composed, sentmanifest, offlinefiles,
+                                                             runmetrics is not None),
+                                                progress=showProgress, after=flushWorker)
+        for line in indexpool.report(failures, workers, time.time()-t0):
+            info("Workers:", line)
+        solr=SolrBatchWriter(pysolr.Solr(SOLR))
+        newmanifest.update(acceptedmanifest)
+        # keep the old entries for the papers that failed, so that they
+        # are neither deleted nor treated as up to date
+        failed=[item for (item, msg) in failures]
+        for bibcode in failed:
+            if oldmanifest.has_key(bibcode):
+                newmanifest[bibcode]=oldmanifest[bibcode]
+        if len(set(failed) - set(researchpapers)) > 0:
+            info("Manifest:", "not updated since documents may not have been sent to Solr")
+            newmanifest=None
+    else:
+        if bulk:
+            PREFETCHSIZE=None
+        sesame = openStore(SESAME, REPOSITORY, (CACHESIZE, CACHEBYTES, CACHETTL, PREFETCHSIZE), offlinefiles, runmetrics)
+        info("Sesame connection:", sesame)
+
+        if bulk:
+            info("Bulk prefetch:", "{0} papers".format(len(researchpapers)))
+            prefetchBibcodes(sesame, researchpapers)
+            sesame.getSourcesForBibcodes(researchpapers, None)
+            info("Bulk prefetch done:", time.asctime())
+        else:
+            sesame.getSourcesForBibcodes(researchpapers)
+    
+        accepted={}
+        solr=SolrBatchWriter(pysolr.Solr(SOLR), SOLRBATCHDOCS, SOLRBATCHBYTES, SOLRCOMMITWITHIN, SOLRTHREADS,
+                             onsent=acceptedEntries(accepted))
+        info("Solr connection:", solr)
+
+        if nconcurrent > 0:
+            asesame = adsrdf.AsyncADSConnection(sesame, nconcurrent)
+            info("Sesame connection:", asesame)
+            newmanifest=indexConcurrently(asesame, solr, researchpapers, mission, project,
+                                          LOOKAHEAD, sentmanifest)
+            asesame.close()
+        else:
+            newmanifest={}
+            for ele in researchpapers:
+                info("Indexing:", ele)
+                entry=putIntoSolr(sesame, solr, ele, mission, project, composed, sentmanifest.get(ele))
+                if entry is not None:
+                    newmanifest[ele]=entry
+                #logger.info("-------------")
+        info("Query cache:", sesame.cacheReport())
+        # the entries for the documents that were sent are only added once
+        # Solr has accepted them; if a batch can not be sent the error is
+        # raised here and the manifest is left as it was
+        solr.flush()
+        newmanifest.update(accepted)
+
+    if newmanifest is not None:
+        nsent=len([bibcode for bibcode in newmanifest.keys()
+                   if not sentmanifest.has_key(bibcode) or sentmanifest[bibcode][1]!=newmanifest[bibcode][1]])
+        info("Documents sent:", "{0} of {1}".format(nsent, len(newmanifest)))
+        if incremental:
+            for theid in solrmanifest.removedIds(oldmanifest, newmanifest, manifestname):
+                info("Deleting:", theid)
+                solr.delete(id=theid)
 
     solr.commit()
+    solr.close()
+    info("Solr batches:", solr.report())
+    if newmanifest is not None:
+        solrmanifest.saveManifest(manifestname, newmanifest)
+    if runmetrics is not None:
+        for line in runmetrics.report().split("\n"):
+            info("Sesame requests:", line)
+        runmetrics.dump(metricsfile)
+        info("Sesame requests:", "written to {0}".format(metricsfile))
     info("Finished:", time.asctime())
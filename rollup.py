@@ -0,0 +1,88 @@
+"""
+Denormalize child records - e.g. the observations or proposals of a
+paper - into fields of the parent Solr document.
+
+Each field is collected into a column as the records are added; the
+floating-point fields are held in array('d') columns and the rest in
+lists. This is linear in the number of values, unlike repeatedly
+concatenating the per-record lists, which matters for papers with
+hundreds of observations.
+
+    rollup=Rollup(['obsids_s', 'exptime_f'])
+    rollup.addAll(obsray)
+    rollup.emit(result)
+
+"""
+
+from array import array
+
+# The fields whose values are always floats.
+FLOATFIELDS=['exptime_f', 'ra_f', 'dec_f']
+
+class Rollup:
+    """Collect the values of the given fields from a set of records.
+
+    A value that is iterable (e.g. a list, but not a string) adds each
+    of its elements to the column, otherwise the value itself is added.
+    If a value which is not a float is added to one of the floatfields
+    then that column is changed to a list.
+    """
+
+    def __init__(self, keys, floatfields=FLOATFIELDS):
+        self.keys=[]
+        self.columns={}
+        for key in keys:
+            if self.columns.has_key(key):
+                continue
+            self.keys.append(key)
+            if key in floatfields:
+                self.columns[key]=array('d')
+            else:
+                self.columns[key]=[]
+        self.seen=set()
+        self.nrecords=0
+
+    def _append(self, key, value):
+        column=self.columns[key]
+        try:
+            column.append(value)
+        except TypeError:
+            column=column.tolist()
+            column.append(value)
+            self.columns[key]=column
+
+    def add(self, record):
+        """Add the fields of the record (a dictionary)."""
+        self.nrecords+=1
+        for key in self.keys:
+            if not record.has_key(key):
+                continue
+            self.seen.add(key)
+            value=record[key]
+            if hasattr(value, '__iter__'):
+                for item in value:
+                    self._append(key, item)
+            else:
+                self._append(key, value)
+
+    def addAll(self, records):
+        for record in records:
+            self.add(record)
+
+    def emit(self, doc, overwrite=True):
+        """Set the fields of doc to the collected values (as lists) and
+        return doc. Fields that did not appear in any record are set to
+        an empty list, unless overwrite is False and doc already contains
+        the field. Nothing is changed if no records were added."""
+        if self.nrecords==0:
+            return doc
+        for key in self.keys:
+            if key in self.seen:
+                column=self.columns[key]
+                if isinstance(column, array):
+                    doc[key]=column.tolist()
+                else:
+                    doc[key]=list(column)
+            elif overwrite or not doc.has_key(key):
+                doc[key]=[]
+        return doc
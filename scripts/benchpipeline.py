@@ -0,0 +1,245 @@
+"""
+Time the stages of scripts/doitchandra.sh or scripts/doithut.sh - RDF
+generation, loading into the store and Solr indexing - on a corpus
+created by scripts/gencorpus.py, using sesameserver.py as the store and a
+stand-in Solr that accepts (and counts) the updates.
+
+Usage: python scripts/benchpipeline.py [--pipeline chandra|hut] [--latency SECONDS] [--index-args "ARGS"] [--load-args "ARGS"] [--label LABEL] [--results FILE] corpusdir
+
+Each stage is run as a separate process, with the same script and
+arguments as in the doit script, from corpusdir/semflow - a directory of
+links to this checkout - so that the relative paths used by the scripts
+find the corpus. The RDF written by the scripts goes to corpusdir/chandra-rdf
+or corpusdir/mast-rdf, which is removed at the start of the run, and
+the output of each stage is written to corpusdir/logs/<stage>.log.
+
+For each stage the wall-clock time, throughput (items per second, where
+the items are papers, observations or proposals depending on the stage),
+peak RSS, CPU time, the number of requests made to the store (by type) and
+the number of documents sent to Solr are recorded. The run is appended
+to the results file (default bench-results.json), which holds a JSON list
+of runs, so that the numbers can be compared over time. The --index-args
+option is used to pass options such as --bulk to rdf2solr5.py, and
+--load-args to pass options such as --batch to the load scripts that
+post a file at a time.
+"""
+
+import sys, os, glob, time, getopt, shutil, subprocess, threading, datetime, logging
+import BaseHTTPServer, SocketServer
+
+import simplejson
+
+SEMFLOW=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, SEMFLOW)
+from sesameserver import startServer
+
+CHANDRA='../AstroExplorer/Missions/Chandra/chandra'
+MAST='../AstroExplorer/Missions/MAST/{0}'
+
+def chandraStages():
+    """The stages of doitchandra.sh, as (label, script and arguments, item count)."""
+    return ('../chandra-rdf', [
+        ("adsrdf",     ["adsclassic2rdf.py", "../chandra-rdf", CHANDRA+"/synthetic.biblist.txt"], 'chandra_papers'),
+        ("simbadrdf",  ["simbad2rdf.py", CHANDRA+"/synthetic.simbad.dict", "../chandra-rdf"], 'chandra_papers'),
+        ("pubrdf",     ["chandra/genrdf.py", "pub", CHANDRA+"/synthetic.linkedpubs.txt", "../chandra-rdf/"], 'chandra_papers'),
+        ("obsvrdf",    ["chandra/genrdf.py", "obsv", CHANDRA+"/global.obsids.txt", "../chandra-rdf/"], 'chandra_obs'),
+        ("proprdf",    ["chandra/genrdf.py", "prop", CHANDRA+"/global.proposals.txt", "../chandra-rdf/"], 'chandra_props'),
+        ("adsload",    ["loadfiles.py", "LOADARGS", CHANDRA+"/synthetic.biblist.txt", "bench.conf"], 'chandra_papers'),
+        ("simbadload", ["loadfiles-simbad.py", "LOADARGS", CHANDRA+"/synthetic.biblist.txt", "bench.conf"], 'chandra_papers'),
+        ("pubload",    ["chandra/loadfiles.py", "LOADARGS", CHANDRA+"/synthetic.linkedpubs.txt", "pub", "bench.conf"], 'chandra_papers'),
+        ("obsvload",   ["chandra/loadfiles.py", "LOADARGS", CHANDRA+"/global.obsids.txt", "obsv", "bench.conf"], 'chandra_obs'),
+        ("propload",   ["chandra/loadfiles.py", "LOADARGS", CHANDRA+"/global.proposals.txt", "prop", "bench.conf"], 'chandra_props'),
+        ("pubsolr",    ["rdf2solr5.py", "INDEXARGS", "CHANDRA", "chandra", CHANDRA+"/synthetic.biblist.txt", "bench.conf"], 'chandra_papers'),
+        ])
+
+def mastStages(mission):
+    """The stages of doithut.sh (for the given MAST mission)."""
+    mdir=MAST.format(mission)
+    biblist="{0}/{1}.biblist.txt".format(mdir, mission)
+    return ('../mast-rdf', [
+        ("adsrdf",     ["adsclassic2rdf.py", "../mast-rdf", biblist], 'mast_papers'),
+        ("simbadrdf",  ["simbad2rdf.py", "{0}/{1}.simbad.dict".format(mdir, mission), "../mast-rdf"], 'mast_papers'),
+        ("obsvrdf",    ["newmast/mast_obsvrdf.py", mission, "{0}/obscore.{1}.psv".format(mdir, mission), "bench.conf"], 'mast_obs'),
+        ("pubrdf",     ["newmast/mast_pubrdf.py", mission, "{0}/map.{1}.txt".format(mdir, mission), "bench.conf"], 'mast_papers'),
+        ("adsload",    ["loadfiles.py", "LOADARGS", biblist, "bench.conf"], 'mast_papers'),
+        ("simbadload", ["loadfiles-simbad.py", "LOADARGS", biblist, "bench.conf"], 'mast_papers'),
+        ("obsvload",   ["newmast/mast_obsvload.py", "LOADARGS", mission, "bench.conf"], 'mast_obs'),
+        ("pubload",    ["newmast/mast_pubload.py", mission, "bench.conf"], 'mast_papers'),
+        ("pubsolr",    ["rdf2solr5.py", "INDEXARGS", "MAST", mission, biblist, "bench.conf"], 'mast_papers'),
+        ])
+
+class SolrHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Accept any request, counting the documents in update requests."""
+    protocol_version='HTTP/1.1'
+    wbufsize=-1
+    RESPONSE='<?xml version="1.0" encoding="UTF-8"?>\n<response><lst name="responseHeader"><int name="status">0</int><int name="QTime">0</int></lst></response>\n'
+
+    def _reply(self):
+        body=self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+        self.server.count(body.count('<doc>'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(self.RESPONSE)))
+        self.end_headers()
+        self.wfile.write(self.RESPONSE)
+
+    do_GET=_reply
+    do_POST=_reply
+
+    def log_message(self, format, *args):
+        pass
+
+class SolrServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads=True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), SolrHandler)
+        self.lock=threading.Lock()
+        self.requests=0
+        self.docs=0
+        self.url='http://127.0.0.1:%d/solr' % self.server_address[1]
+
+    def count(self, ndocs):
+        self.lock.acquire()
+        self.requests+=1
+        self.docs+=ndocs
+        self.lock.release()
+
+    def handle_error(self, request, client_address):
+        pass
+
+def makeWorkdir(corpusdir):
+    """Create corpusdir/semflow, linking to the contents of this checkout."""
+    workdir=os.path.join(corpusdir, 'semflow')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    for name in os.listdir(SEMFLOW):
+        link=os.path.join(workdir, name)
+        if not os.path.lexists(link):
+            os.symlink(os.path.abspath(os.path.join(SEMFLOW, name)), link)
+    return workdir
+
+def diffCounts(before, after):
+    return dict([(k, after[k]-before.get(k, 0)) for k in after.keys() if after[k]!=before.get(k, 0)])
+
+def runStage(label, argv, workdir, logdir, sesame, solr):
+    """Run the stage, returning a dictionary of the measurements."""
+    env=dict(os.environ)
+    env['PYTHONPATH']=os.path.abspath(SEMFLOW) + os.pathsep + env.get('PYTHONPATH', '')
+    log=open(os.path.join(logdir, label+".log"), 'w')
+    counts=sesame.requestCounts()
+    (solrrequests, solrdocs)=(solr.requests, solr.docs)
+    t0=time.time()
+    proc=subprocess.Popen([sys.executable]+argv, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    (pid, status, usage)=os.wait4(proc.pid, 0)
+    dt=time.time()-t0
+    proc.returncode=status
+    log.close()
+    return {'stage': label, 'command': argv, 'status': os.WEXITSTATUS(status), 'seconds': dt,
+            'peak_rss_kb': usage.ru_maxrss, 'user_seconds': usage.ru_utime, 'system_seconds': usage.ru_stime,
+            'sesame_requests': diffCounts(counts, sesame.requestCounts()),
+            'solr_requests': solr.requests-solrrequests, 'solr_docs': solr.docs-solrdocs}
+
+def run(corpusdir, pipeline='chandra', latency=0.0, indexargs=[], label=None, loadargs=[]):
+    # rdflib warns about literals it cannot convert when the store parses them
+    logging.getLogger('rdflib').addHandler(logging.NullHandler())
+    corpus=simplejson.load(open(os.path.join(corpusdir, 'corpus.json')))
+    if pipeline=='chandra':
+        (rdfdir, stages)=chandraStages()
+    else:
+        (rdfdir, stages)=mastStages(corpus['mast_mission'])
+    workdir=makeWorkdir(corpusdir)
+    logdir=os.path.join(corpusdir, 'logs')
+    if not os.path.isdir(logdir):
+        os.makedirs(logdir)
+    # the store starts empty, so what an earlier run loaded (as recorded
+    # by the load scripts) no longer applies
+    for fname in glob.glob(os.path.join(logdir, 'load-manifest-*')):
+        os.remove(fname)
+    if os.path.isdir(os.path.join(workdir, rdfdir)):
+        shutil.rmtree(os.path.join(workdir, rdfdir))
+
+    sesame=startServer(latency=latency)
+    solr=SolrServer()
+    t=threading.Thread(target=solr.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    fh=open(os.path.join(workdir, 'bench.conf'), 'w')
+    fh.write("SESAME={0!r}\nREPOSITORY='bench'\nSOLR={1!r}\nDATA={2!r}\nMANIFESTDIR='../logs'\n".format(
+        sesame.baseurl, solr.url, rdfdir))
+    fh.close()
+
+    results=[]
+    t0=time.time()
+    try:
+        for (stage, argv, itemkey) in stages:
+            for (placeholder, extra) in [("INDEXARGS", indexargs), ("LOADARGS", loadargs)]:
+                if placeholder in argv:
+                    i=argv.index(placeholder)
+                    argv=argv[:i]+extra+argv[i+1:]
+            print "{0:12s}".format(stage),
+            sys.stdout.flush()
+            res=runStage(stage, argv, workdir, logdir, sesame, solr)
+            res['items']=corpus['counts'][itemkey]
+            if res['seconds'] > 0:
+                res['items_per_second']=res['items']/res['seconds']
+            results.append(res)
+            print "{0:8.2f}s {1:10.1f}/s {2:8d} KB {3:7d} store requests {4:6d} solr docs{5}".format(
+                res['seconds'], res.get('items_per_second', 0), res['peak_rss_kb'],
+                sum(res['sesame_requests'].values()), res['solr_docs'],
+                res['status'] and " FAILED (status {0})".format(res['status']) or "")
+    finally:
+        sesame.shutdown()
+        solr.shutdown()
+    return {'label': label, 'started': datetime.datetime.now().isoformat(), 'pipeline': pipeline,
+            'latency': latency, 'index_args': indexargs, 'load_args': loadargs, 'python': sys.version.split()[0],
+            'corpus': corpus, 'stages': results, 'total_seconds': time.time()-t0,
+            'failed': [res['stage'] for res in results if res['status']!=0]}
+
+if __name__=="__main__":
+    usage='Usage: python scripts/benchpipeline.py [--pipeline chandra|hut] [--latency SECONDS] [--index-args "ARGS"] [--load-args "ARGS"] [--label LABEL] [--results FILE] corpusdir'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["pipeline=", "latency=", "index-args=", "load-args=", "label=", "results="])
+    except getopt.error, msg:
+        print msg
+        print usage
+        sys.exit(-1)
+    if len(args)!=1:
+        print usage
+        sys.exit(-1)
+
+    pipeline='chandra'
+    latency=0.0
+    indexargs=[]
+    loadargs=[]
+    label=None
+    resultsfile='bench-results.json'
+    for (opt, val) in opts:
+        if opt=="--pipeline":
+            pipeline=val
+        elif opt=="--latency":
+            latency=float(val)
+        elif opt=="--index-args":
+            indexargs=val.split()
+        elif opt=="--load-args":
+            loadargs=val.split()
+        elif opt=="--label":
+            label=val
+        elif opt=="--results":
+            resultsfile=val
+    if pipeline not in ['chandra', 'hut']:
+        print usage
+        sys.exit(-1)
+
+    res=run(args[0], pipeline, latency, indexargs, label, loadargs)
+    runs=[]
+    if os.path.exists(resultsfile):
+        runs=simplejson.load(open(resultsfile))
+    runs.append(res)
+    fh=open(resultsfile, 'w')
+    simplejson.dump(runs, fh, indent=1)
+    fh.close()
+    print "Total {0:.2f}s; results appended to {1}".format(res['total_seconds'], resultsfile)
+    if len(res['failed']) > 0:
+        print "Failed stages:", " ".join(res['failed'])
+        sys.exit(1)
@@ -0,0 +1,84 @@
+"""
+Compare the request rate of pysesame.connection with and without the
+keep-alive connection pool, using a local stand-in for the Sesame
+/statements end point (so no Sesame installation is needed).
+
+Usage: python scripts/benchpool.py [nrequests] [nthreads]
+
+Run from the top-level semflow directory.
+"""
+
+import sys, os, time, threading
+import BaseHTTPServer, SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pysesame import connection
+
+RESPONSE="""<?xml version="1.0" encoding="UTF-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+<rdf:Description rdf:about="http://ads.harvard.edu/sem/obsv/observation/CHANDRA/obsid/1">
+  <tExptime xmlns="https://github.com/rahuldave/ontoads/raw/master/owl/ADS-obsv.owl#">1000.0</tExptime>
+</rdf:Description>
+</rdf:RDF>
+"""
+
+class StatementsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version='HTTP/1.1'
+    #send the headers and body as one packet, as a servlet container would
+    wbufsize=-1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rdf+xml')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads=True
+
+def run(baseurl, poolsize, nrequests, nthreads):
+    c=connection(baseurl, poolsize=poolsize)
+    c.use_repository('bench')
+    qdict={'s':'<http://ads.harvard.edu/sem/obsv/observation/CHANDRA/obsid/1>'}
+    def worker(n):
+        for i in range(n):
+            c.query_statements(qdict)
+    threads=[threading.Thread(target=worker, args=(nrequests/nthreads,)) for i in range(nthreads)]
+    t0=time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    dt=time.time()-t0
+    if c.pool is not None:
+        c.pool.close()
+    return (nrequests/nthreads)*nthreads/dt
+
+if __name__=="__main__":
+    if len(sys.argv) > 3:
+        print "Usage: python scripts/benchpool.py [nrequests] [nthreads]"
+        sys.exit(-1)
+    nrequests=2000
+    nthreads=1
+    if len(sys.argv) > 1:
+        nrequests=int(sys.argv[1])
+    if len(sys.argv) > 2:
+        nthreads=int(sys.argv[2])
+
+    server=Server(('127.0.0.1', 0), StatementsHandler)
+    thread=threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    baseurl='http://127.0.0.1:%d/openrdf-sesame/' % server.server_address[1]
+
+    before=run(baseurl, 0, nrequests, nthreads)
+    after=run(baseurl, max(nthreads, 1), nrequests, nthreads)
+    print "requests=%d threads=%d" % (nrequests, nthreads)
+    print "urllib2 (new connection per request): %8.1f requests/sec" % before
+    print "keep-alive pool:                      %8.1f requests/sec" % after
+    print "speedup: %.2f" % (after/before)
+    server.shutdown()
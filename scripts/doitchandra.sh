@@ -7,6 +7,15 @@ RDFSTORE=../chandra-rdf
 MISSIONSTORE=../AstroExplorer/Missions/${PARENT}/${MISSION}
 BIBLISTA=${MISSIONSTORE}/sherry.p.a.biblist.txt
 BIBLISTB=${MISSIONSTORE}/hutoverlap.biblist.txt
+# number of processes used to convert the ADS records (the adsrdf stage)
+JOBS=${JOBS:-1}
+# options for the load stages that post a file at a time, such as
+# LOADARGS="--batch --threads 4" (add --incremental to only send the
+# changed files, or --resume to continue an interrupted load), and
+# PARALLELLOAD=1 to run the load stages at the same time (they
+# write to different contexts)
+LOADARGS=${LOADARGS:-}
+PARALLELLOAD=${PARALLELLOAD:-0}
 
 # run the stage, logging start and end time, as well as
 # the status, to $LOGFILE
@@ -30,27 +39,51 @@ runStage() {
     fi
 }
 
+# run a load stage - runStage and its arguments, or a function that
+# runs several stages - in the background if PARALLELLOAD is 1; call
+# wait before using the loaded data
+#
+runLoad() {
+    if [ "$PARALLELLOAD" = "1" ]; then
+	"$@" &
+    else
+	"$@"
+    fi
+}
+
 echo "# Logging to $LOGFILE"
 touch $LOGFILE
 echo "######################################" >> $LOGFILE
 echo "# Starting script: `date`" >> $LOGFILE
 
-runStage "adsrdf a"     adsclassic2rdf.py $RDFSTORE ${BIBLISTA}
-runStage "adsrdf b"     adsclassic2rdf.py $RDFSTORE ${BIBLISTB}
+runStage "adsrdf a"     adsclassic2rdf.py --jobs $JOBS $RDFSTORE ${BIBLISTA}
+runStage "adsrdf b"     adsclassic2rdf.py --jobs $JOBS $RDFSTORE ${BIBLISTB}
 runStage "simbadrdf a"  simbad2rdf.py ${MISSIONSTORE}/sherry.p.a.simbad.dict $RDFSTORE
 runstage "simbadrdf b"  simbad2rdf.py ${MISSIONSTORE}/hutoverlap.simbad.dict $RDFSTORE
 runStage "pubrdf a"     chandra/genrdf.py pub ${MISSIONSTORE}/sherry.p.a.linkedpubs.txt $RDFSTORE/
 runStage "pubrdf b"     chandra/genrdf.py pub ${MISSIONSTORE}/hutoverlap.linkedpubs.txt $RDFSTORE/
 runStage "obsvrdf"      chandra/genrdf.py obsv ${MISSIONSTORE}/global.obsids.txt $RDFSTORE/
 runStage "proprdf"      chandra/genrdf.py prop ${MISSIONSTORE}/global.proposals.txt $RDFSTORE/
-runStage "adsload a"    loadfiles.py ${BIBLISTA}
-runStage "adsload b"    loadfiles.py ${BIBLISTB}
-runStage "simbadload a" loadfiles-simbad.py ${BIBLISTA}
-runStage "simbadload b" loadfiles-simbad.py ${BIBLISTB}
-runStage "pubload a"    chandra/loadfiles.py ${MISSIONSTORE}/sherry.p.a.linkedpubs.txt pub
-runStage "pubload b"    chandra/loadfiles.py ${MISSIONSTORE}/hutoverlap.linkedpubs.txt pub
-runStage "obsvload"     chandra/loadfiles.py ${MISSIONSTORE}/global.obsids.txt obsv
-runStage "propload"     chandra/loadfiles.py ${MISSIONSTORE}/global.proposals.txt prop
+
+# the a and b lists go into the same context, so are loaded in turn
+adsLoad() {
+    runStage "adsload a"    loadfiles.py $LOADARGS ${BIBLISTA}
+    runStage "adsload b"    loadfiles.py $LOADARGS ${BIBLISTB}
+}
+simbadLoad() {
+    runStage "simbadload a" loadfiles-simbad.py $LOADARGS ${BIBLISTA}
+    runStage "simbadload b" loadfiles-simbad.py $LOADARGS ${BIBLISTB}
+}
+pubLoad() {
+    runStage "pubload a"    chandra/loadfiles.py $LOADARGS ${MISSIONSTORE}/sherry.p.a.linkedpubs.txt pub
+    runStage "pubload b"    chandra/loadfiles.py $LOADARGS ${MISSIONSTORE}/hutoverlap.linkedpubs.txt pub
+}
+runLoad adsLoad
+runLoad simbadLoad
+runLoad pubLoad
+runLoad runStage "obsvload"     chandra/loadfiles.py $LOADARGS ${MISSIONSTORE}/global.obsids.txt obsv
+runLoad runStage "propload"     chandra/loadfiles.py $LOADARGS ${MISSIONSTORE}/global.proposals.txt prop
+wait
 
 #We had to produce a cut file below due to some linkage probs in Chandra
 runStage "pubsolr a"    rdf2solr5.py CHANDRA chandra ${BIBLISTA}.cut 
@@ -7,6 +7,15 @@ RDFSTORE=../mast-rdf
 MISSIONSTORE=../AstroExplorer/Missions/${PARENT}/${MISSION}
 BIBLIST=${MISSIONSTORE}/${MISSION}.biblist.txt
 CONF=default2.conf
+# number of processes used to convert the ADS records (the adsrdf stage)
+JOBS=${JOBS:-1}
+# options for the load stages that post a file at a time, such as
+# LOADARGS="--batch --threads 4" (add --incremental to only send the
+# changed files, or --resume to continue an interrupted load), and
+# PARALLELLOAD=1 to run the load stages at the same time (they
+# write to different contexts)
+LOADARGS=${LOADARGS:-}
+PARALLELLOAD=${PARALLELLOAD:-0}
 
 # run the stage, logging start and end time, as well as
 # the status, to $LOGFILE
@@ -30,21 +39,34 @@ runStage() {
     fi
 }
 
+# run a load stage - runStage and its arguments, or a function that
+# runs several stages - in the background if PARALLELLOAD is 1; call
+# wait before using the loaded data
+#
+runLoad() {
+    if [ "$PARALLELLOAD" = "1" ]; then
+	"$@" &
+    else
+	"$@"
+    fi
+}
+
 echo "# Logging to $LOGFILE"
 touch $LOGFILE
 echo "######################################" >> $LOGFILE
 echo "# Starting script: `date`" >> $LOGFILE
 
-runStage "adsrdf"     adsclassic2rdf.py $RDFSTORE $BIBLIST
+runStage "adsrdf"     adsclassic2rdf.py --jobs $JOBS $RDFSTORE $BIBLIST
 runStage "simbadrdf"  simbad2rdf.py ${MISSIONSTORE}/${MISSION}.simbad.dict $RDFSTORE
 runStage "obsvrdf"    newmast/mast_obsvrdf.py $MISSION ${MISSIONSTORE}/obscore.${MISSION}.psv 	
 runStage "pubrdf"     newmast/mast_pubrdf.py $MISSION ${MISSIONSTORE}/map.${MISSION}.txt
 # runStage "proprdf"   
-runStage "adsload"    loadfiles.py $BIBLIST $CONF
-runStage "simbadload" loadfiles-simbad.py $BIBLIST $CONF
-runStage "obsvload"   newmast/mast_obsvload.py $MISSION
-runStage "pubload"    newmast/mast_pubload.py $MISSION
+runLoad runStage "adsload"    loadfiles.py $LOADARGS $BIBLIST $CONF
+runLoad runStage "simbadload" loadfiles-simbad.py $LOADARGS $BIBLIST $CONF
+runLoad runStage "obsvload"   newmast/mast_obsvload.py $LOADARGS $MISSION
+runLoad runStage "pubload"    newmast/mast_pubload.py $MISSION
 # runStage "propload"
+wait
 runStage "pubsolr"    rdf2solr5.py $PARENT $MISSION $BIBLIST
 
 echo "# Ending script: `date`" >> $LOGFILE
@@ -0,0 +1,380 @@
+"""
+Create a synthetic set of pipeline inputs, for benchmarking the
+scripts/doit*.sh stages at a chosen scale (e.g. 1000 to 1000000 papers)
+without access to the real ADS, SIMBAD, Chandra or MAST data.
+
+Usage: python scripts/gencorpus.py [--papers N] [--seed S] [--mast-fraction F] [--mast-mission M] outdir
+
+The files are written into outdir using the layout expected by the
+pipeline scripts when they are run from outdir/semflow (see
+scripts/benchpipeline.py), so that the relative paths used by the
+scripts - e.g. ../AstroExplorer and ../chandradata - resolve:
+
+  AstroExplorer/filebibs/sortedyearlist.txt, bibs.<year>.gz
+      the bibcode to UUID maps read by getuuid4bibcode
+  AstroExplorer/Missions/Chandra/chandra/
+      synthetic.biblist.txt, synthetic.bibcodes.xml (ADS records),
+      synthetic.simbad.dict, synthetic.linkedpubs.txt,
+      global.obsids.txt, global.proposals.txt
+  chandradata/Publications, Datum, Proposal
+      one XML file per paper, observation and proposal
+  AstroExplorer/Missions/MAST/<mission>/
+      <mission>.biblist.txt, <mission>.bibcodes.xml,
+      <mission>.simbad.dict, obscore.<mission>.psv (no header),
+      map.<mission>.txt (bibcode obsid [propid]) and
+      <mission>_proposal.txt (in the IUE proposal-list layout)
+  corpus.json
+      the parameters and the number of items of each type
+
+The output depends only on the arguments, so runs with the same
+seed can be compared.
+"""
+
+import sys, os, gzip, getopt, random, uuid
+from urllib import quote_plus
+from xml.sax.saxutils import escape, quoteattr
+
+import simplejson
+
+JOURNALS=['ApJ', 'A&A', 'MNRAS', 'AJ', 'ApJS', 'PASP']
+YEARS=range(1999, 2013)
+KEYWORDS=['x rays: galaxies', 'galaxies: active', 'stars: pulsars', 'ism: supernova remnants',
+          'galaxies: clusters: general', 'x rays: binaries', 'accretion', 'cosmology: observations',
+          'stars: coronae', 'black hole physics', 'ultraviolet: stars', 'techniques: spectroscopic']
+WORDS=['x-ray', 'emission', 'cluster', 'galaxy', 'observations', 'spectrum', 'source', 'chandra',
+       'temperature', 'gas', 'we', 'the', 'of', 'and', 'in', 'a', 'is', 'with', 'from', 'model',
+       'data', 'luminosity', 'nucleus', 'halo', 'jet', 'shock', 'abundance', 'survey', 'ray']
+SURNAMES=['Smith', 'Jones', 'Wang', 'Garcia', 'Muller', 'Rossi', 'Tanaka', 'Kim', 'Caraveo',
+          'Mignani', 'Fabbiano', 'Murray', 'Forman', 'Jones', 'Kraft', 'Evans', 'Burke', 'Dave']
+OTYPES=['G ~', 'X ~', 'SNR ~', 'Red ~', 'QSO ~', 'Psr ~', '* ~', 'ClG ~']
+CATEGORIES=['NORMAL GALAXIES', 'ACTIVE GALAXIES AND QUASARS', 'CLUSTERS OF GALAXIES',
+            'STARS AND WD', 'SN, SNR AND ISOLATED NS', 'BH AND NS BINARIES']
+INSTRUMENTS=['ACIS-S', 'ACIS-I', 'HRC-S', 'HRC-I']
+MONTHS=['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+def bibcode(i):
+    """The i'th bibcode; every i gives a different, valid-looking, bibcode."""
+    year=YEARS[i % len(YEARS)]
+    journal=JOURNALS[(i // len(YEARS)) % len(JOURNALS)]
+    k=i // (len(YEARS)*len(JOURNALS))
+    volume=100 + k // 9000
+    page=1 + k % 9000
+    qualifier='.L'[k % 7==0]
+    return "{0}{1}{2}{3}{4}{5}".format(year, journal.ljust(5, '.'), str(volume).rjust(4, '.'),
+                                       qualifier, str(page).rjust(4, '.'), "ABCDEFGHJKLMNPRSTW"[i % 18])
+
+def words(rng, n):
+    return " ".join([rng.choice(WORDS) for i in range(n)])
+
+def author(rng):
+    last=rng.choice(SURNAMES)
+    first=rng.choice("ABCDEFGHJKLMNPRSTW")
+    return ("{0}, {1}. {2}.".format(last, first, rng.choice("ABCDEFGH")), "{0}, {1}".format(last, first))
+
+def sexagesimal(rng):
+    return (rng.uniform(0, 360), rng.uniform(-90, 90))
+
+class Corpus:
+    """Write out the files for npapers papers."""
+
+    def __init__(self, outdir, npapers, seed=1, mastfraction=0.2, mastmission='hut'):
+        self.outdir=outdir
+        self.npapers=npapers
+        self.rng=random.Random(seed)
+        self.mastfraction=mastfraction
+        self.mastmission=mastmission
+        # the Chandra observations and proposals the papers can link to
+        self.nobs=max(1, int(0.6*npapers))
+        self.nprops=max(1, self.nobs // 4)
+        self.nmastobs=max(1, int(0.6*npapers*mastfraction))
+        self.nmastprops=max(1, self.nmastobs // 4)
+        self.counts={'papers': 0, 'chandra_papers': 0, 'mast_papers': 0, 'references': 0, 'authors': 0,
+                     'sources': 0, 'chandra_links': 0, 'mast_links': 0, 'chandra_obs': self.nobs,
+                     'chandra_props': self.nprops, 'mast_obs': self.nmastobs, 'mast_props': self.nmastprops}
+
+    def path(self, *parts):
+        fname=os.path.join(self.outdir, *parts)
+        dirname=os.path.dirname(fname)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        return fname
+
+    def missionDir(self, parent, mission):
+        return os.path.join('AstroExplorer', 'Missions', parent, mission)
+
+    def writeRecord(self, fh, i, bib):
+        rng=self.rng
+        refereed=int(rng.random() < 0.85)
+        year=bib[:4]
+        volume=bib[9:13].strip('.')
+        page=bib[14:18].strip('.')
+        journal=JOURNALS[(i // len(YEARS)) % len(JOURNALS)]
+        out=['  <record refereed="{0}" type="article">'.format(refereed),
+             '    <bibcode>{0}</bibcode>'.format(escape(bib)),
+             '    <keywords type="Normalized">']
+        for kw in rng.sample(KEYWORDS, rng.randint(1, 5)):
+            out.append('      <keyword channel="">{0}</keyword>'.format(escape(kw)))
+        out.append('    </keywords>')
+        if not refereed:
+            out.append('    <keywords type="arXiv">\n      <keyword channel="astro-ph">astro-ph</keyword>\n    </keywords>')
+        out.append('    <title>{0}</title>'.format(escape(words(rng, rng.randint(5, 15)).capitalize())))
+        for n in range(rng.randint(1, 8)):
+            (western, normalized)=author(rng)
+            self.counts['authors']+=1
+            out.extend(['    <author nr="{0}">'.format(n+1), '      <name>',
+                        '        <western>{0}</western>'.format(escape(western)),
+                        '        <normalized>{0}</normalized>'.format(escape(normalized)),
+                        '      </name>'])
+            if rng.random() < 0.5:
+                out.append('      <affiliations>\n        <affiliation>{0} Institute, {1}</affiliation>\n      </affiliations>'.format(
+                    rng.choice(SURNAMES), rng.choice(['USA', 'Italy', 'Japan', 'UK', 'Germany'])))
+            if rng.random() < 0.2:
+                out.append('      <emails>\n        <email>{0}@example.org</email>\n      </emails>'.format(normalized.split(',')[0].lower()))
+            out.append('    </author>')
+        out.extend(['    <journal>{0}, v.{1}, p.{2} ({3})</journal>'.format(escape(journal), volume, page, year),
+                    '    <volume>{0}</volume>'.format(volume),
+                    '    <pubdate>{0} {1}</pubdate>'.format(rng.choice(MONTHS), year),
+                    '    <page>{0}</page>'.format(page)])
+        if rng.random() < 0.7:
+            out.append('    <lastpage>{0}</lastpage>'.format(int(page)+rng.randint(1, 20)))
+        if rng.random() < 0.5:
+            out.append('    <DOI>10.1086/{0}</DOI>'.format(i))
+        out.append('    <abstract lang="en">{0}.</abstract>'.format(escape(words(rng, rng.randint(50, 250)).capitalize())))
+        if not refereed or rng.random() < 0.4:
+            out.append('    <preprintid ecode="{0}astro.ph..{1:04d}X">astro-ph/{2:02d}{1:04d}</preprintid>'.format(
+                year, i % 10000, int(year) % 100))
+        # references go to papers earlier in the corpus, or outside it
+        for n in range(rng.randint(0, 40)):
+            self.counts['references']+=1
+            if i > 0 and rng.random() < 0.5:
+                ref=bibcode(rng.randint(0, i-1))
+            else:
+                ref=bibcode(self.npapers + rng.randint(0, 10*self.npapers))
+            score=rng.random() < 0.05 and 5 or 1
+            out.append('    <reference score="{0}" bibcode={1}>{2} et al., {3}</reference>'.format(
+                score, quoteattr(ref), escape(rng.choice(SURNAMES)), ref[:4]))
+        out.append('  </record>\n')
+        fh.write("\n".join(out))
+
+    def writeSources(self, fh, bib):
+        rng=self.rng
+        sources=[]
+        for n in range(rng.choice([0, 0, 1, 1, 2, 3, 5])):
+            name="NGC {0:5d}".format(rng.randint(1, 7840))
+            (ra, dec)=sexagesimal(rng)
+            otype=rng.choice(OTYPES)
+            ra="{0:09.5f}".format(ra)
+            dec="{0:+09.5f}".format(dec)
+            sources.append({'id': name, 'ra': ra, 'dec': dec, 'otype': otype, 'mtype': '~,~,~',
+                            'refcode': bib, '_raw': "|".join([name, ra, dec, otype, '~,~,~', '~,~,~'])})
+        self.counts['sources']+=len(sources)
+        if len(sources) > 0:
+            fh.write("{0!r}: {1!r},\n".format(bib, sources))
+
+    def writeChandraPaper(self, bib, linked):
+        rng=self.rng
+        obsids=sorted(set([rng.randint(1, self.nobs) for n in range(rng.choice([0, 1, 1, 2, 3]))]))
+        self.counts['chandra_links']+=len(obsids)
+        out=['<paper>', '    <bibcode>{0}</bibcode>'.format(escape(bib.replace('&', '%26'))),
+             '    <classified_by>CDA</classified_by>',
+             '    <paper_type>{0}</paper_type>'.format(rng.choice(['science', 'science', 'theory'])),
+             '    <flags>', '        <data_use>{0}</data_use>'.format(rng.choice(['direct', 'indirect'])), '    </flags>']
+        if len(obsids) > 0:
+            out.append('    <data>')
+            out.extend(['        <obsid>{0}</obsid>'.format(obsid) for obsid in obsids])
+            out.append('    </data>')
+        out.append('</paper>\n')
+        fh=open(self.path('chandradata', 'Publications', quote_plus(bib+".xml")), 'w')
+        fh.write("\n".join(out))
+        fh.close()
+        linked.write(bib+"\n")
+
+    def writeChandraObservations(self):
+        rng=self.rng
+        lst=open(self.path(self.missionDir('Chandra', 'chandra'), 'global.obsids.txt'), 'w')
+        for obsid in range(1, self.nobs+1):
+            (ra, dec)=sexagesimal(rng)
+            year=rng.choice(YEARS)
+            start="{0} {1:2d} {2} {3:2d}:{4:02d}PM".format(rng.choice(MONTHS), rng.randint(1, 28), year,
+                                                          rng.randint(1, 11), rng.randint(0, 59))
+            public="{0} {1:2d} {2} 12:00PM".format(rng.choice(MONTHS), rng.randint(1, 28), year+1)
+            fh=open(self.path('chandradata', 'Datum', "{0}.xml".format(obsid)), 'w')
+            fh.write("\n".join([
+                '<observation obsid="{0}" name={1}>'.format(obsid, quoteattr("NGC {0}".format(rng.randint(1, 7840)))),
+                '    <observed_time units="ksec">{0:.2f}</observed_time>'.format(rng.uniform(1, 150)),
+                '    <type>{0}</type>'.format(rng.choice(['GO', 'GO', 'GTO', 'CAL', 'DDT'])),
+                '    <start_date>{0}</start_date>'.format(start),
+                '    <public_avail>{0}</public_avail>'.format(public),
+                '    <instrument name="{0}" />'.format(rng.choice(INSTRUMENTS)),
+                '    <proposal id="{0}" />'.format(1 + (obsid-1) % self.nprops),
+                '    <ra>{0:.8f}</ra>'.format(ra),
+                '    <dec>{0:.8f}</dec>'.format(dec),
+                '</observation>\n']))
+            fh.close()
+            lst.write("{0}\n".format(obsid))
+        lst.close()
+
+    def writeChandraProposals(self):
+        rng=self.rng
+        lst=open(self.path(self.missionDir('Chandra', 'chandra'), 'global.proposals.txt'), 'w')
+        for propid in range(1, self.nprops+1):
+            (western, normalized)=author(rng)
+            (last, first)=western.split(', ')
+            fh=open(self.path('chandradata', 'Proposal', "{0}.xml".format(propid)), 'w')
+            fh.write("\n".join([
+                '<proposal id="{0}" name="{1:08d}">'.format(propid, 1600000+propid),
+                '    <title>{0}</title>'.format(escape(words(rng, rng.randint(4, 12)).upper())),
+                '    <category>{0}</category>'.format(escape(rng.choice(CATEGORIES))),
+                '    <abstract>{0}</abstract>'.format(escape(words(rng, rng.randint(50, 150)))),
+                '    <pi first={0} last={1} />'.format(quoteattr(first), quoteattr(last)),
+                '</proposal>\n']))
+            fh.close()
+            lst.write("{0}\n".format(propid))
+        lst.close()
+
+    def mastObsid(self, n):
+        return "{0}{1:06d}".format(self.mastmission, n)
+
+    def writeMastObservations(self):
+        rng=self.rng
+        m=self.mastmission
+        fh=open(self.path(self.missionDir('MAST', m), 'obscore.{0}.psv'.format(m)), 'w')
+        for n in range(1, self.nmastobs+1):
+            obsid=self.mastObsid(n)
+            (ra, dec)=sexagesimal(rng)
+            year=rng.choice(YEARS)
+            date="{0}-{1:02d}-{2:02d} {3:02d}:{4:02d}:{5:02d}".format(year, rng.randint(1, 12), rng.randint(1, 28),
+                                                                      rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59))
+            vals={'s_ra': "{0:.5f}".format(ra), 's_dec': "{0:.5f}".format(dec),
+                  'target_name': "NGC {0}".format(rng.randint(1, 7840)),
+                  'title': words(rng, 6), 'obs_creator_name': m.upper(), 'obs_collection': m.upper(),
+                  'obs_publisher_did': "ivo://mast.stsci/{0}/{1}".format(m, obsid), 'obs_id': obsid,
+                  'creation_date': date, 'instrument': m.upper(), 'date_obs': date,
+                  't_exptime': "{0:.1f}".format(rng.uniform(100, 5000)), 'telescope_name': m.upper(),
+                  'em_min': "{0:.3e}".format(rng.uniform(8.2e-8, 1.0e-7)), 'em_max': "{0:.3e}".format(rng.uniform(1.5e-7, 1.8e-7)),
+                  'access_format': 'application/fits',
+                  'access_url': "http://archive.stsci.edu/pub/{0}/{1}/{1}_ph_sum.fits".format(m, obsid),
+                  's_resolution': "{0:.2f}".format(rng.uniform(1, 10)), 't_resolution': "{0:.1f}".format(rng.uniform(1, 100)),
+                  's_region': "CIRCLE ICRS {0:.5f} {1:.5f} 0.00278".format(ra, dec), 'calib_level': '2',
+                  'dataproduct_type': rng.choice(['Spectrum.Flux', 'Image']), 's_fov': "{0:.5f}".format(rng.uniform(0.001, 0.01))}
+            fh.write("|".join([vals.get(col, '') for col in OBSCORECOLUMNS]) + "\n")
+        fh.close()
+
+        fh=open(self.path(self.missionDir('MAST', m), '{0}_proposal.txt'.format(m)), 'w')
+        for n in range(1, self.nmastprops+1):
+            (western, normalized)=author(rng)
+            (last, first)=western.split(', ')
+            fh.write("|".join(["P{0:05d}".format(n), words(rng, 6), first, last, 'STScI', words(rng, 40), 'N']) + "\n")
+        fh.close()
+
+    def writeMastPaper(self, bib, mapfh):
+        rng=self.rng
+        obsids=sorted(set([rng.randint(1, self.nmastobs) for n in range(rng.choice([1, 1, 2, 3]))]))
+        self.counts['mast_links']+=len(obsids)
+        for n in obsids:
+            mapfh.write("{0}\t{1}\tP{2:05d}\n".format(bib, self.mastObsid(n), 1 + (n-1) % self.nmastprops))
+
+    def write(self):
+        rng=self.rng
+        m=self.mastmission
+        cdir=self.missionDir('Chandra', 'chandra')
+        mdir=self.missionDir('MAST', m)
+        outputs={}
+        for (key, dirname, prefix) in [('chandra', cdir, 'synthetic'), ('mast', mdir, m)]:
+            outputs[key]={'biblist': open(self.path(dirname, prefix+'.biblist.txt'), 'w'),
+                          'xml': open(self.path(dirname, prefix+'.bibcodes.xml'), 'w'),
+                          'simbad': open(self.path(dirname, prefix+'.simbad.dict'), 'w')}
+            outputs[key]['xml'].write('<records>\n')
+            outputs[key]['simbad'].write('{\n')
+        linked=open(self.path(cdir, 'synthetic.linkedpubs.txt'), 'w')
+        mapfh=open(self.path(mdir, 'map.{0}.txt'.format(m)), 'w')
+        uuids={}
+        for i in range(self.npapers):
+            bib=bibcode(i)
+            uuids.setdefault(bib[:4], []).append((bib, uuid.UUID(int=rng.getrandbits(128), version=4)))
+            if rng.random() < self.mastfraction:
+                key='mast'
+                self.writeMastPaper(bib, mapfh)
+            else:
+                key='chandra'
+                self.writeChandraPaper(bib, linked)
+            self.counts[key+'_papers']+=1
+            self.counts['papers']+=1
+            out=outputs[key]
+            out['biblist'].write(bib+"\n")
+            self.writeRecord(out['xml'], i, bib)
+            self.writeSources(out['simbad'], bib)
+        for out in outputs.values():
+            out['xml'].write('</records>\n')
+            out['simbad'].write('}\n')
+            for fh in out.values():
+                fh.close()
+        linked.close()
+        mapfh.close()
+
+        fh=open(self.path('AstroExplorer', 'filebibs', 'sortedyearlist.txt'), 'w')
+        for year in sorted(uuids.keys()):
+            fh.write("{0} bibs.{0}\n".format(year))
+            gz=gzip.open(self.path('AstroExplorer', 'filebibs', 'bibs.{0}.gz'.format(year)), 'w')
+            for (bib, theuuid) in uuids[year]:
+                gz.write("{0} {1}\n".format(bib, theuuid))
+            gz.close()
+        fh.close()
+        del uuids
+
+        self.writeChandraObservations()
+        self.writeChandraProposals()
+        self.writeMastObservations()
+        return self.counts
+
+# The obscore columns, in the order used by newmast/psv.py
+OBSCORECOLUMNS=[
+    "s_ra", "s_dec", "datalen", "radecsys", "equinox", "timesys", "specsys", "vover", "vodate",
+    "target_name", "ra_targ", "dec_targ", "title", "obs_creator_name", "obs_collection",
+    "obs_publisher_did", "obs_id", "creation_date", "version", "instrument", "dssource",
+    "em_domain", "der_snr", "spec_val", "spec_bw", "spec_fil", "em_res_power", "date_obs",
+    "t_exptime", "t_min", "t_max", "aperture", "telescope_name", "tmid", "fluxavg", "fluxmax2",
+    "em_min", "em_max", "min_flux", "max_flux", "min_error", "max_error", "access_format",
+    "access_url", "representative", "preview", "project", "spectralaxisname", "fluxaxisname",
+    "spectralsi", "fluxsi", "spectralunit", "fluxunit", "fluxucd", "fluxcal", "coord_obs",
+    "coord_targ", "s_ra_min", "s_ra_max", "s_dec_min", "s_dec_max", "s_resolution",
+    "t_resolution", "s_region", "o_fluxucd", "calib_level", "dataproduct_type", "t_span",
+    "s_fov", "filesize", "access_estsize",
+]
+
+if __name__=="__main__":
+    usage="Usage: python scripts/gencorpus.py [--papers N] [--seed S] [--mast-fraction F] [--mast-mission M] outdir"
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["papers=", "seed=", "mast-fraction=", "mast-mission="])
+    except getopt.error, msg:
+        print msg
+        print usage
+        sys.exit(-1)
+    if len(args)!=1:
+        print usage
+        sys.exit(-1)
+
+    npapers=1000
+    seed=1
+    mastfraction=0.2
+    mastmission='hut'
+    for (opt, val) in opts:
+        if opt=="--papers":
+            npapers=int(val)
+        elif opt=="--seed":
+            seed=int(val)
+        elif opt=="--mast-fraction":
+            mastfraction=float(val)
+        elif opt=="--mast-mission":
+            mastmission=val
+
+    outdir=args[0]
+    corpus=Corpus(outdir, npapers, seed, mastfraction, mastmission)
+    counts=corpus.write()
+    fh=open(os.path.join(outdir, 'corpus.json'), 'w')
+    simplejson.dump({'papers': npapers, 'seed': seed, 'mast_fraction': mastfraction,
+                     'mast_mission': mastmission, 'counts': counts}, fh, sort_keys=True, indent=1)
+    fh.close()
+    print "Wrote", outdir
+    for k in sorted(counts.keys()):
+        print "  {0:16s} {1}".format(k, counts[k])
@@ -0,0 +1,549 @@
+"""
+A small stand-in for the openrdf-sesame HTTP server, implementing the
+parts of the Sesame 2 protocol used by pysesame, so that the load scripts
+and indexers can be run - e.g. for benchmarks and regression tests -
+without a Java servlet container:
+
+  repositories/<r>               GET or POST a SPARQL query (query=...);
+                                 SELECT/ASK results are returned as SPARQL
+                                 JSON (or XML), CONSTRUCT/DESCRIBE as RDF/XML
+  repositories/<r>/statements    GET, POST, PUT and DELETE statements, with
+                                 the subj, pred, obj and context parameters
+                                 (N-Triples encoded; context=null means
+                                 the default graph); a POST can also be a
+                                 transaction (application/x-rdftransaction)
+
+Statements can be sent and returned as RDF/XML (application/rdf+xml) or
+N-Triples (text/plain), and also sent as TriG (application/x-trig), where
+the contexts are named in the document; request bodies may be chunked and
+gzipped. Each repository is an in-memory rdflib
+ConjunctiveGraph, created when first used. Each request can be delayed
+by latency seconds to mimic a remote store.
+
+Usage: python sesameserver.py [--port N] [--latency SECONDS] [--repository NAME] [rdffile ...]
+
+which serves http://localhost:N/openrdf-sesame/ (the default port is 8081)
+with the files loaded into the repository NAME (default testads8). In a
+test, use startServer, which runs the server in a background thread:
+
+    server=startServer(latency=0.01)
+    c=connection(server.baseurl)
+    ...
+    server.shutdown()
+
+"""
+
+import sys, time, threading, getopt, urlparse, cgi, re, zlib
+from urllib import quote_plus
+import BaseHTTPServer, SocketServer
+from xml.etree import cElementTree as ElementTree
+import simplejson
+
+import rdflib
+from rdflib import ConjunctiveGraph, Graph, URIRef, BNode, Literal
+from rdflib.util import from_n3
+
+SPJSON='application/sparql-results+json'
+SPXML='application/sparql-results+xml'
+SPCXML='application/rdf+xml'
+SPCNT='text/plain'
+SPTRANS='application/x-rdftransaction'
+SPTRIG='application/x-trig'
+
+XMLLANG='{http://www.w3.org/XML/1998/namespace}lang'
+
+def _parseTerm(value):
+    "Convert a N-Triples encoded subj, pred, obj or context value."
+    if value=='null':
+        return None
+    if value.startswith('_:'):
+        return BNode(value[2:])
+    return from_n3(value.decode('utf-8'))
+
+def _binding(term):
+    "Convert a rdflib term into a SPARQL JSON binding."
+    if isinstance(term, URIRef):
+        return {'type': 'uri', 'value': unicode(term)}
+    elif isinstance(term, BNode):
+        return {'type': 'bnode', 'value': unicode(term)}
+    out={'type': 'literal', 'value': unicode(term)}
+    if term.language:
+        out['xml:lang']=term.language
+    elif term.datatype:
+        out['datatype']=unicode(term.datatype)
+    return out
+
+def _transactionTerm(elem):
+    "Convert a value in a transaction document (None for <null/>)."
+    text=elem.text or u''
+    if elem.tag=='uri':
+        return URIRef(text)
+    elif elem.tag=='bnode':
+        return BNode(text)
+    elif elem.tag=='literal':
+        datatype=elem.get('datatype')
+        if datatype is not None:
+            datatype=URIRef(datatype)
+        return Literal(text, lang=elem.get(XMLLANG), datatype=datatype, normalize=False)
+    elif elem.tag=='null':
+        return None
+    raise ValueError("Unknown value in transaction: %s" % elem.tag)
+
+def _readTransaction(data):
+    """Return the operations in the transaction document as a list of
+    (operation, s, p, o, contexts), where operation is add, remove or
+    clear (with s, p and o None), so that the document can be checked
+    before any of it is applied."""
+    ops=[]
+    for op in ElementTree.fromstring(data):
+        if op.tag not in ['add', 'remove', 'clear']:
+            raise ValueError("Unsupported transaction operation: %s" % op.tag)
+        terms=[]
+        contexts=[]
+        for child in op:
+            if child.tag=='contexts':
+                contexts=[_transactionTerm(c) for c in child]
+            else:
+                terms.append(_transactionTerm(child))
+        if op.tag=='clear':
+            terms=[None, None, None]
+        if len(terms)!=3:
+            raise ValueError("Expected a subject, predicate and object in %s" % op.tag)
+        ops.append((op.tag, terms[0], terms[1], terms[2], contexts))
+    return ops
+
+_GROUP=re.compile(r'\{([^{}]*)\}')
+_SAMETERM=re.compile(r'FILTER\s*\(\s*sameTerm\s*\(\s*\?(\w+)\s*,\s*(<[^<>\s]*>)\s*\)\s*\)', re.I)
+
+def _bindSameTerm(query):
+    """Replace each variable that a FILTER(sameTerm(?v, <uri>)) in a
+    group (without nested groups) fixes by the URI, and BIND the URI
+    to the variable, as Sesame's SameTermFilterOptimizer does; rdflib
+    would otherwise match the whole store and then filter."""
+    def rewrite(m):
+        group=m.group(1)
+        terms=_SAMETERM.findall(group)
+        if len(terms)==0:
+            return m.group(0)
+        group=_SAMETERM.sub('', group)
+        for (var, uri) in terms:
+            group=re.sub(r'\?%s\b' % var, uri, group)
+        return '{' + group + ' ' + ' '.join(['BIND(%s AS ?%s)' % (uri, var) for (var, uri) in terms]) + ' }'
+    return _GROUP.sub(rewrite, query)
+
+class Store:
+    """The repositories, each a ConjunctiveGraph, with a lock since rdflib
+    graphs are not safe to use from several threads."""
+
+    def __init__(self):
+        self.repositories={}
+        self.lock=threading.RLock()
+
+    def graph(self, name):
+        self.lock.acquire()
+        try:
+            if not self.repositories.has_key(name):
+                self.repositories[name]=ConjunctiveGraph()
+            return self.repositories[name]
+        finally:
+            self.lock.release()
+
+    def load(self, name, data, fmt, contexts):
+        """Add the serialized RDF to each of the contexts (None means
+        the default graph), or for TriG with no contexts to the ones it
+        names. As with Sesame, literals keep their lexical form (rdflib
+        would normalize "1.50"^^xsd:double to "1.5")."""
+        g=self.graph(name)
+        normalize=rdflib.NORMALIZE_LITERALS
+        rdflib.NORMALIZE_LITERALS=False
+        try:
+            if fmt=='trig' and len(contexts)==0:
+                g.parse(data=data, format=fmt)
+                return
+            for context in contexts:
+                if context is None:
+                    target=g.default_context
+                else:
+                    target=g.get_context(context)
+                target.parse(data=data, format=fmt)
+        finally:
+            rdflib.NORMALIZE_LITERALS=normalize
+
+    def add(self, name, s, p, o, contexts):
+        g=self.graph(name)
+        if len(contexts)==0:
+            contexts=[None]
+        for context in contexts:
+            if context is None:
+                target=g.default_context
+            else:
+                target=g.get_context(context)
+            target.add((s, p, o))
+
+    def match(self, name, s, p, o, contexts):
+        """Return the matching (s, p, o) triples; contexts is a list of
+        contexts to search, or empty for all of them."""
+        g=self.graph(name)
+        if len(contexts)==0:
+            return list(g.triples((s, p, o)))
+        out=[]
+        for context in contexts:
+            if context is None:
+                target=g.default_context
+            else:
+                target=g.get_context(context)
+            out.extend(target.triples((s, p, o)))
+        return out
+
+    def remove(self, name, s, p, o, contexts):
+        g=self.graph(name)
+        if len(contexts)==0:
+            g.remove((s, p, o))
+            return
+        for context in contexts:
+            if context is None:
+                target=g.default_context
+            else:
+                target=g.get_context(context)
+            target.remove((s, p, o))
+
+class SesameHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version='HTTP/1.1'
+    wbufsize=-1
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _reply(self, code, body='', ctype='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        "Read the request body, which may be chunked and/or gzipped."
+        if (self.headers.getheader('Transfer-Encoding') or '').lower()=='chunked':
+            parts=[]
+            while True:
+                n=int(self.rfile.readline().split(';')[0].strip(), 16)
+                if n==0:
+                    while self.rfile.readline().strip()!='':
+                        pass
+                    break
+                parts.append(self.rfile.read(n))
+                self.rfile.readline()
+            data=''.join(parts)
+        else:
+            data=self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+        if (self.headers.getheader('Content-Encoding') or '').lower()=='gzip':
+            data=zlib.decompress(data, 16+zlib.MAX_WBITS)
+        return data
+
+    def _route(self):
+        """Return (repository, isstatements, params) for the request,
+        or None if the path is not recognized."""
+        url=urlparse.urlparse(self.path)
+        parts=[part for part in url.path.split('/') if part!='']
+        if 'repositories' not in parts:
+            return None
+        i=parts.index('repositories')
+        rest=parts[i+1:]
+        if len(rest)==1:
+            return (rest[0], False, cgi.parse_qs(url.query, keep_blank_values=True))
+        elif len(rest)==2 and rest[1]=='statements':
+            return (rest[0], True, cgi.parse_qs(url.query, keep_blank_values=True))
+        return None
+
+    def _handle(self, method):
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        route=self._route()
+        if route is None:
+            self._body()
+            self._reply(404, "Unknown resource: %s" % self.path)
+            return
+        (repository, isstatements, params)=route
+        self.server.count(method, isstatements)
+        status=self.server.failure()
+        if status is not None:
+            self._body()
+            self._reply(status, "Failing as requested")
+            return
+        store=self.server.store
+        store.lock.acquire()
+        try:
+            try:
+                if isstatements:
+                    self._statements(method, store, repository, params)
+                else:
+                    self._query(method, store, repository, params)
+            except Exception, e:
+                self._reply(400, "%s: %s" % (e.__class__.__name__, e))
+        finally:
+            store.lock.release()
+
+    def _query(self, method, store, repository, params):
+        if method=='POST':
+            params=cgi.parse_qs(self._body(), keep_blank_values=True)
+        elif method!='GET':
+            self._reply(405, "Method not allowed")
+            return
+        if not params.has_key('query'):
+            self._reply(400, "Missing query parameter")
+            return
+        res=store.graph(repository).query(_bindSameTerm(params['query'][0].decode('utf-8')))
+        accept=self.headers.getheader('Accept') or SPJSON
+        if res.type in ['CONSTRUCT', 'DESCRIBE']:
+            self._reply(200, res.graph.serialize(format='xml'), SPCXML)
+        elif res.type=='ASK':
+            self._reply(200, simplejson.dumps({'head': {}, 'boolean': bool(res.askAnswer)}), SPJSON)
+        elif accept.find(SPXML)!=-1:
+            self._reply(200, res.serialize(format='xml'), SPXML)
+        else:
+            names=[str(v) for v in res.vars]
+            bindings=[]
+            for row in res:
+                bindings.append(dict([(name, _binding(term)) for (name, term) in zip(names, row) if term is not None]))
+            self._reply(200, simplejson.dumps({'head': {'vars': names}, 'results': {'bindings': bindings}}), SPJSON)
+
+    def _statements(self, method, store, repository, params):
+        contexts=[_parseTerm(c) for c in params.get('context', [])]
+        if method in ['POST', 'PUT']:
+            ctype=(self.headers.getheader('Content-Type') or SPCXML).split(';')[0].strip()
+            if method=='POST' and ctype==SPTRANS:
+                for (op, s, p, o, opcontexts) in _readTransaction(self._body()):
+                    if op=='add':
+                        store.add(repository, s, p, o, opcontexts)
+                    else:
+                        store.remove(repository, s, p, o, opcontexts)
+                self._reply(204)
+                return
+            if ctype==SPCNT:
+                fmt='nt'
+            elif ctype==SPCXML:
+                fmt='xml'
+            elif ctype==SPTRIG:
+                fmt='trig'
+            else:
+                self._body()
+                self._reply(415, "Unsupported content type: %s" % ctype)
+                return
+            data=self._body()
+            if method=='PUT':
+                store.remove(repository, None, None, None, contexts)
+            if len(contexts)==0 and fmt!='trig':
+                contexts=[None]
+            store.load(repository, data, fmt, contexts)
+            self._reply(204)
+            return
+        (s, p, o)=[params.has_key(k) and _parseTerm(params[k][0]) or None for k in ['subj', 'pred', 'obj']]
+        if method=='DELETE':
+            store.remove(repository, s, p, o, contexts)
+            self._reply(204)
+        elif method=='GET':
+            out=Graph()
+            for triple in store.match(repository, s, p, o, contexts):
+                out.add(triple)
+            accept=self.headers.getheader('Accept') or SPCXML
+            if accept.find(SPCNT)!=-1:
+                self._reply(200, out.serialize(format='nt'), SPCNT)
+            else:
+                self._reply(200, out.serialize(format='xml'), SPCXML)
+        else:
+            self._reply(405, "Method not allowed")
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+class SesameServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads=True
+    allow_reuse_address=True
+
+    def __init__(self, address, latency=0.0, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, SesameHandler)
+        self.store=Store()
+        self.latency=latency
+        self.verbose=verbose
+        self.counts={}
+        self.countlock=threading.Lock()
+        self.nfail=0
+        self.failstatus=503
+        self.baseurl='http://%s:%d/openrdf-sesame/' % (self.server_address[0], self.server_address[1])
+
+    def count(self, method, isstatements):
+        key=method+(isstatements and " statements" or " query")
+        self.countlock.acquire()
+        try:
+            self.counts[key]=self.counts.get(key, 0)+1
+        finally:
+            self.countlock.release()
+
+    def fail(self, n, status=503):
+        """Make the next n requests fail with the HTTP status (e.g. to
+        check that clients retry)."""
+        self.countlock.acquire()
+        try:
+            self.nfail=n
+            self.failstatus=status
+        finally:
+            self.countlock.release()
+
+    def failure(self):
+        "The status to fail the current request with, or None."
+        self.countlock.acquire()
+        try:
+            if self.nfail > 0:
+                self.nfail-=1
+                return self.failstatus
+            return None
+        finally:
+            self.countlock.release()
+
+    def requestCounts(self):
+        """Return the number of requests handled, as a dictionary keyed
+        by the method and end point, e.g. 'POST query' or 'GET statements'."""
+        self.countlock.acquire()
+        try:
+            return dict(self.counts)
+        finally:
+            self.countlock.release()
+
+    def handle_error(self, request, client_address):
+        # clients closing keep-alive connections are not worth reporting
+        if self.verbose:
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+def startServer(port=0, latency=0.0, host='127.0.0.1'):
+    """Start a server in a background thread and return it; port=0
+    picks a free port, and the URL to use is in the baseurl field.
+    Call shutdown on the server to stop it."""
+    server=SesameServer((host, port), latency)
+    t=threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return server
+
+class TestClass:
+    """Run the pysesame calls used by the load scripts against the
+    server (run with nosetests sesameserver.py)."""
+
+    def setUp(self):
+        import pysesame
+        self.server=startServer()
+        self.conn=pysesame.connection(self.server.baseurl)
+        self.conn.use_repository('test')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_statements(self):
+        nt='<http://example.org/a> <http://example.org/p> "hello" .\n'
+        rdfxml='<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:ex="http://example.org/">' + \
+            '<rdf:Description rdf:about="http://example.org/a"><ex:p rdf:resource="http://example.org/b"/>' + \
+            '</rdf:Description></rdf:RDF>'
+        self.conn.postdata(rdfxml, context=quote_plus('<http://example.org/c1>'))
+        self.server.store.load('test', nt, 'nt', [URIRef('http://example.org/c2')])
+        rows=self.conn.querypost('SELECT ?o WHERE { <http://example.org/a> ?p ?o }')
+        assert sorted([row['o']['value'] for row in rows])==['hello', 'http://example.org/b']
+        got=self.conn.query_statements({'s': '<http://example.org/a>', 'c': '<http://example.org/c2>'}, SPCNT)
+        assert got.strip()==nt.strip()
+        self.conn.deletedata(context='<http://example.org/c2>')
+        rows=self.conn.querypost('SELECT ?o WHERE { <http://example.org/a> ?p ?o }')
+        assert [row['o']['value'] for row in rows]==['http://example.org/b']
+
+    def test_transaction(self):
+        import pysesame
+        nt='<http://example.org/a> <http://example.org/p> "1.50"^^<http://www.w3.org/2001/XMLSchema#double> .\n' + \
+            '<http://example.org/a> <http://example.org/q> "old"@en .\n'
+        self.server.store.load('test', nt, 'nt', [URIRef('http://example.org/c1'), URIRef('http://example.org/c2')])
+        a={'type': 'uri', 'value': 'http://example.org/a'}
+        q={'type': 'uri', 'value': 'http://example.org/q'}
+        self.conn.transaction([(a, q, {'type': 'literal', 'value': 'old', 'xml:lang': 'en'}),
+                               (a, {'type': 'uri', 'value': 'http://example.org/p'},
+                                {'type': 'literal', 'value': '1.50', 'datatype': 'http://www.w3.org/2001/XMLSchema#double'})],
+                              [(a, q, {'type': 'literal', 'value': 'new <&>'})],
+                              ['http://example.org/c1'])
+        got=self.conn.query_statements({'c': '<http://example.org/c1>'}, SPCNT)
+        assert got.strip()=='<http://example.org/a> <http://example.org/q> "new <&>" .'
+        assert len(self.server.store.match('test', None, None, None, [URIRef('http://example.org/c2')]))==2
+
+        # nothing is changed if the document can not be read
+        try:
+            self.conn.transaction([(a, q, None)], [(a, q)], ['http://example.org/c2'])
+            assert False, "expected the transaction to fail"
+        except ValueError, e:
+            assert e.args[0]==400
+        assert len(self.server.store.match('test', None, None, None, [URIRef('http://example.org/c2')]))==2
+
+    def test_stale_connection(self):
+        import socket
+        self.conn.querypost('ASK { ?s ?p ?o }')
+        before=self.server.requestCounts()
+        # the server has closed the pooled connection
+        conn=self.conn.pool.idle.values()[0][0]
+        (a, b)=socket.socketpair()
+        b.close()
+        conn.sock.close()
+        conn.sock=a
+        assert self.conn.querypost('SELECT ?s WHERE { ?s ?p ?o }')==[]
+        after=self.server.requestCounts()
+        assert after['POST query']==before['POST query']+1
+
+    def test_timeout_not_resent(self):
+        import pysesame, urllib2
+        conn=pysesame.connection(self.server.baseurl, timeout=0.2)
+        conn.use_repository('test')
+        conn.querypost('ASK { ?s ?p ?o }')
+        self.server.latency=0.5
+        try:
+            conn.postdata('<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"/>')
+            assert False, "expected a timeout"
+        except urllib2.URLError, e:
+            assert str(e).find('timed out')!=-1
+        time.sleep(0.5)
+        assert self.server.requestCounts()['POST statements']==1
+
+if __name__=="__main__":
+    usage="Usage: python sesameserver.py [--port N] [--latency SECONDS] [--repository NAME] [rdffile ...]"
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["port=", "latency=", "repository="])
+    except getopt.error, msg:
+        print msg
+        print usage
+        sys.exit(-1)
+
+    port=8081
+    latency=0.0
+    repository='testads8'
+    for (opt, val) in opts:
+        if opt=="--port":
+            port=int(val)
+        elif opt=="--latency":
+            latency=float(val)
+        elif opt=="--repository":
+            repository=val
+
+    server=SesameServer(('', port), latency, verbose=True)
+    for fname in args:
+        print "Loading", fname
+        fmt='xml'
+        if fname.endswith('.nt'):
+            fmt='nt'
+        server.store.load(repository, open(fname).read(), fmt, [None])
+    print "Serving", server.baseurl, "with latency", latency
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -64,6 +64,14 @@ for bibcode in simbad.keys():
         gadd(g,uri_source[eleid], a, adsbase.AstronomicalSource)
         gadd(g,uri_source[eleid], adsbase.name , Literal(aobject['id']))
         gadd(g,uri_source[eleid], adsobsv.curatedAt, uri_conf['SIMBAD'])
+        # the type and position are stored as separate values so they can
+        # be queried; the metadata string is kept for older indexers
+        addVal(g,uri_source[eleid], adsbase.objectType, aobject.get('otype', ''))
+        for (pred, key) in [(adsobsv.ra, 'ra'), (adsobsv.dec, 'dec')]:
+            try:
+                addVal(g,uri_source[eleid], pred, aobject.get(key, ''), asDouble)
+            except ValueError:
+                print "Ignoring", key, "for", aobject['id'], ":", aobject[key]
         gadd(g,uri_source[eleid], adsbase.hasMetadataString, Literal(str(aobject)))
         
     serializedstuff=g.serialize()
@@ -0,0 +1,179 @@
+"""
+Buffer documents on their way to Solr so that they are sent as one
+update request per batch, rather than one request per document.
+
+A SolrBatchWriter has the same add, delete and commit methods as pysolr.Solr
+(for the arguments used by the indexers), so it can be passed to the
+putIntoSolr routines in place of the Solr connection:
+
+    solr=SolrBatchWriter(pysolr.Solr(SOLR), maxdocs=200)
+    ... solr.add([doc], commit=False) ...
+    solr.commit()
+    print solr.report()
+
+"""
+
+import threading, Queue, time
+
+import pysolr
+
+class SolrBatchWriter:
+    """Collect documents and send them to Solr in batches.
+
+    A batch is sent when it contains maxdocs documents or, if maxbytes
+    is not None, when the estimated size of the documents (the length of
+    their repr) reaches maxbytes. If commitwithin is not None then it
+    is sent as the commitWithin value (in milliseconds) of each update,
+    which requires a version of pysolr that supports it.
+
+    If nthreads is greater than zero then the batches are sent by that
+    many background threads - each with its own Solr connection - so
+    that the caller can carry on creating documents; otherwise they are
+    sent when the batch fills up. Errors from the background threads
+    are raised by the next call to flush, commit or close. If a batch
+    sent from the calling thread fails, the error is raised and the
+    documents are kept, so that they are sent again with the next batch.
+
+    If onsent is given it is called with the list of documents in each
+    batch that Solr accepts (from the sending thread, if there are
+    threads), e.g. to record them in a manifest.
+    """
+
+    def __init__(self, solr, maxdocs=100, maxbytes=None, commitwithin=None, nthreads=0, onsent=None):
+        self.solr=solr
+        self.onsent=onsent
+        self.maxdocs=maxdocs
+        self.maxbytes=maxbytes
+        self.commitwithin=commitwithin
+        self.docs=[]
+        self.nbytes=0
+        # (ndocs, nbytes, seconds) for each request sent
+        self.timings=[]
+        self.lock=threading.Lock()
+        self.errors=[]
+        self.threads=[]
+        self.queue=None
+        if nthreads > 0:
+            # the queue is bounded so that a slow Solr holds up the
+            # caller rather than letting the batches pile up in memory
+            self.queue=Queue.Queue(2*nthreads)
+            for i in range(nthreads):
+                t=threading.Thread(target=self._sender)
+                t.setDaemon(True)
+                t.start()
+                self.threads.append(t)
+
+    def __str__(self):
+        return "<SolrBatchWriter for {0}: maxdocs={1} maxbytes={2} commitWithin={3} threads={4}>".format(
+            self.solr.url, self.maxdocs, self.maxbytes, self.commitwithin, len(self.threads))
+
+    def _send(self, solr, docs, nbytes):
+        t0=time.time()
+        if self.commitwithin is None:
+            solr.add(docs, commit=False)
+        else:
+            solr.add(docs, commit=False, commitWithin=str(self.commitwithin))
+        dt=time.time()-t0
+        self.lock.acquire()
+        try:
+            self.timings.append((len(docs), nbytes, dt))
+        finally:
+            self.lock.release()
+        if self.onsent is not None:
+            self.onsent(docs)
+
+    def _sender(self):
+        solr=pysolr.Solr(self.solr.url)
+        while True:
+            item=self.queue.get()
+            try:
+                if item is None:
+                    return
+                try:
+                    self._send(solr, item[0], item[1])
+                except Exception, e:
+                    self.lock.acquire()
+                    self.errors.append(e)
+                    self.lock.release()
+            finally:
+                self.queue.task_done()
+
+    def _raiseErrors(self):
+        self.lock.acquire()
+        try:
+            errors=self.errors
+            self.errors=[]
+        finally:
+            self.lock.release()
+        if len(errors) > 0:
+            raise errors[0]
+
+    def _sendBatch(self):
+        if len(self.docs)==0:
+            return
+        (docs, nbytes)=(self.docs, self.nbytes)
+        if self.queue is None:
+            self._send(self.solr, docs, nbytes)
+            self.docs=[]
+            self.nbytes=0
+        else:
+            self.docs=[]
+            self.nbytes=0
+            self.queue.put((docs, nbytes))
+
+    def add(self, docs, commit=False):
+        """Add the documents to the current batch, sending it if it is
+        full. If commit is True then all the batches are sent and a
+        commit made."""
+        for doc in docs:
+            self.docs.append(doc)
+            if self.maxbytes is not None:
+                self.nbytes+=len(repr(doc))
+            if len(self.docs) >= self.maxdocs or \
+                    (self.maxbytes is not None and self.nbytes >= self.maxbytes):
+                self._sendBatch()
+        if commit:
+            self.commit()
+
+    def delete(self, id=None, q=None):
+        """Send all the batches and then delete the documents."""
+        self.flush()
+        self.solr.delete(id=id, q=q)
+
+    def flush(self):
+        """Send the current batch and wait for all the batches to be sent."""
+        self._sendBatch()
+        if self.queue is not None:
+            self.queue.join()
+        self._raiseErrors()
+
+    def commit(self):
+        """Send all the batches and then commit."""
+        self.flush()
+        self.solr.commit()
+
+    def close(self):
+        """Send all the batches and stop the background threads; the writer
+        should not be used after this."""
+        try:
+            self.flush()
+        finally:
+            for t in self.threads:
+                self.queue.put(None)
+            for t in self.threads:
+                t.join()
+            self.threads=[]
+
+    def report(self):
+        """Return a string summarizing the requests sent to Solr."""
+        self.lock.acquire()
+        try:
+            timings=list(self.timings)
+        finally:
+            self.lock.release()
+        if len(timings)==0:
+            return "no requests"
+        ndocs=sum([t[0] for t in timings])
+        total=sum([t[2] for t in timings])
+        return "{0} docs in {1} requests, {2:.3f}s total, {3:.3f}s mean, {4:.3f}s max per request".format(
+            ndocs, len(timings), total, total/len(timings), max([t[2] for t in timings]))
@@ -0,0 +1,56 @@
+"""
+Keep track of what has been sent to Solr, so that a rerun only needs to
+send the documents that have changed.
+
+A manifest is stored as a JSON file, one per mission/project, mapping
+each bibcode to the Solr id of its document and the SHA1 hash of the
+document contents. Since the document for a paper contains the data from
+all the missions, a bibcode can appear in several manifests; the
+document is only deleted when it is no longer listed in any of them.
+"""
+
+import os, glob, hashlib
+import simplejson
+
+def documentHash(doc):
+    """Return the hash of the Solr document (a dictionary)."""
+    return hashlib.sha1(simplejson.dumps(doc, sort_keys=True)).hexdigest()
+
+def manifestName(dirname, mission, project):
+    return os.path.join(dirname, "solr-manifest-{0}-{1}.json".format(mission, project))
+
+def loadManifest(fname):
+    """Return the manifest as a dictionary of bibcode: [id, hash];
+    the dictionary is empty if the file does not exist."""
+    if not os.path.exists(fname):
+        return {}
+    fh=open(fname)
+    try:
+        return simplejson.load(fh)
+    finally:
+        fh.close()
+
+def saveManifest(fname, manifest):
+    """Write out the manifest, replacing the file only once it has
+    been written."""
+    tmpname=fname+".tmp"
+    fh=open(tmpname, "w")
+    try:
+        simplejson.dump(manifest, fh, sort_keys=True, indent=0)
+    finally:
+        fh.close()
+    os.rename(tmpname, fname)
+
+def removedIds(oldmanifest, newmanifest, fname):
+    """Return the Solr ids of the documents that were in oldmanifest but
+    not in newmanifest, and are not listed in any of the other manifests
+    in the same directory as fname. Documents whose id has changed
+    are also included."""
+    others=set()
+    for other in glob.glob(os.path.join(os.path.dirname(fname) or '.', "solr-manifest-*.json")):
+        if os.path.abspath(other)==os.path.abspath(fname):
+            continue
+        for entry in loadManifest(other).values():
+            others.add(entry[0])
+    current=set([entry[0] for entry in newmanifest.values()])
+    return sorted(set([entry[0] for entry in oldmanifest.values()]) - current - others)